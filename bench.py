@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+# Нагрузочный прогон бота целиком, без сети: локальный фейковый VK API (+ Bots Long Poll)
+# и фейковый Gist на одном HTTP-сервере, main.py работает как обычно (INGEST_MODE=bots),
+# только с VK_API_URL / GIST_API_URL на этот сервер.
+#
+# Каждый «пользователь» ведёт себя как человек: следующее сообщение пишет, когда
+# получил ответ на предыдущее. Задержка ответа = от выдачи события через longpoll
+# до messages.send этому пользователю.
+#
+#   python bench.py --scenario rush --students 1000
+#   python bench.py --scenario mixed --json --max-p95-ms 2000 --min-eps 50   (для CI)
+#
+# Сценарии:
+#   rush   — открыли слот: students учеников одновременно идут «Выбрать» → категория → слот;
+#            мест записано больше вместимости — провал прогона
+#   roster — админы жмут все кнопки панели администратора, «Ученики» и «Незаписавшиеся»
+#            листают по members участникам
+#   views  — шквал «Расписание» / «Подробно»
+#   mixed  — всё сразу
+#
+# Исключение в любом обработчике (bot_handler_errors_total) — провал прогона.
+#
+# Настройки бота (SEND_RATE, STORAGE_MODE, DISPATCH_WORKERS, ...) берутся из окружения как обычно.
+# --runtime asyncio — тот же прогон на RUNTIME=asyncio; для сравнения в итоге есть число
+# потоков процесса и пиковая память.
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import importlib.util
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+GROUP_ID = 1
+ADMIN_IDS = [1080975674, 20158141]      # захардкожены в main.py
+STUDENT_BASE = 10_000_000
+SLOT_TITLE = "19.01 18:00-20:00"
+
+# ───────────── фейковый VK + Gist ─────────────
+class FakeVk:
+    def __init__(self, members: List[int]):
+        self.members = members
+        self.requests: Counter = Counter()     # HTTPS-запросы по методу
+        self.calls: Counter = Counter()        # методы, включая внутри execute
+        self.gist_patches = 0
+        self.gist_bytes = 0
+        self.gist_gets: Counter = Counter()    # 200 / 304
+        self.gist_files: Dict[str, str] = {}
+        self.gist_rev = 0
+        self._feed: "queue.Queue[dict]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._event_id = 0
+        # user_id -> времена выдачи ещё не отвеченных событий; user_id -> оставшиеся сообщения
+        self._waiting: Dict[int, deque] = {}
+        self._scripts: Dict[int, deque] = {}
+        self._active = 0
+        self.latencies: List[float] = []
+        self.events_served = 0
+        self.replies = 0
+        self.first_served: Optional[float] = None
+        self.last_reply: Optional[float] = None
+        self.done = threading.Event()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-vk", daemon=True).start()
+
+    # ── сценарий ──
+    def run_scripts(self, scripts: Dict[int, List[str]]):
+        """Запускает пользователей: первое сообщение каждого — сразу, остальные — по ответам."""
+        self.done.clear()
+        with self._lock:
+            for uid, texts in scripts.items():
+                if texts:
+                    self._scripts[uid] = deque(texts)
+                    self._active += 1
+            if not self._active:
+                self.done.set()
+            for uid in list(self._scripts):
+                self._push_next(uid)
+
+    def _push_next(self, uid: int):
+        texts = self._scripts.get(uid)
+        if not texts:
+            self._scripts.pop(uid, None)
+            self._active -= 1
+            if self._active <= 0:
+                self.done.set()
+            return
+        self._event_id += 1
+        self._feed.put({
+            "type": "message_new",
+            "group_id": GROUP_ID,
+            "event_id": f"bench{self._event_id}",
+            "object": {"message": {"from_id": uid, "peer_id": uid, "id": self._event_id, "text": texts.popleft()}},
+        })
+
+    def _on_send(self, uid: int):
+        now = time.perf_counter()
+        with self._lock:
+            self.replies += 1
+            self.last_reply = now
+            waiting = self._waiting.get(uid)
+            if not waiting:
+                return  # второе сообщение на то же событие (продолжение длинного текста и т.п.)
+            self.latencies.append(now - waiting.popleft())
+            self._push_next(uid)
+
+    def _poll(self, wait: float) -> List[dict]:
+        try:
+            first = self._feed.get(timeout=wait)
+        except queue.Empty:
+            return []
+        updates = [first]
+        while len(updates) < 100:
+            try:
+                updates.append(self._feed.get_nowait())
+            except queue.Empty:
+                break
+        now = time.perf_counter()
+        with self._lock:
+            if self.first_served is None:
+                self.first_served = now
+            for u in updates:
+                uid = u["object"]["message"]["from_id"]
+                self._waiting.setdefault(uid, deque()).append(now)
+            self.events_served += len(updates)
+        return updates
+
+    # ── методы API ──
+    def call(self, method: str, values: dict):
+        self.calls[method] += 1
+        if method == "groups.getById":
+            return [{"id": GROUP_ID, "name": "Bench"}]
+        if method == "users.get":
+            ids = [int(x) for x in str(values.get("user_ids", "")).split(",") if x.strip()]
+            return [{"id": i, "first_name": f"Ученик{i}", "last_name": "Бенч"} for i in ids]
+        if method == "messages.send":
+            self._on_send(int(values.get("user_id", 0)))
+            return 1
+        if method == "groups.getMembers":
+            offset, count = int(values.get("offset", 0)), int(values.get("count", 1000))
+            if values.get("filter") == "managers":
+                ids = ADMIN_IDS
+                return {"count": len(ids), "items": [{"id": i} for i in ids[offset:offset + count]]}
+            page = self.members[offset:offset + count]
+            return {"count": len(self.members),
+                    "items": [{"id": i, "first_name": f"Ученик{i}", "last_name": "Бенч"} for i in page]}
+        if method == "groups.getLongPollServer":
+            return {"key": "bench", "server": f"{self.url}/lp", "ts": "1"}
+        raise KeyError(method)
+
+    def execute(self, code: str) -> dict:
+        # формат main.execute_calls: return [API.method({...}),API.method({...})];
+        dec = json.JSONDecoder()
+        i, results, errors = len("return ["), [], []
+        while code.startswith("API.", i):
+            j = code.index("(", i)
+            values, k = dec.raw_decode(code, j + 1)
+            try:
+                results.append(self.call(code[i + 4:j], values))
+            except KeyError as e:
+                results.append(False)
+                errors.append({"method": str(e), "error_code": 3, "error_msg": "Unknown method"})
+            i = k + 1
+            if code.startswith(",", i):
+                i += 1
+        out = {"response": results}
+        if errors:
+            out["execute_errors"] = errors
+        return out
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _json(self, obj, code: int = 200, etag: Optional[str] = None):
+                body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                if etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == "/lp":
+                    q = parse_qs(url.query)
+                    wait = min(float(q.get("wait", ["25"])[0]), 0.5)
+                    self._json({"ts": str(time.time_ns()), "updates": fake._poll(wait)})
+                elif url.path.startswith("/gists/"):
+                    # начинается пустым: бот стартует с чистого состояния; дальше — что он записал
+                    with fake._lock:
+                        etag = f'W/"{fake.gist_rev}"'
+                        if self.headers.get("If-None-Match") == etag:
+                            fake.gist_gets[304] += 1
+                            self.send_response(304)
+                            self.send_header("ETag", etag)
+                            self.send_header("Content-Length", "0")
+                            self.end_headers()
+                            return
+                        fake.gist_gets[200] += 1
+                        files = {n: {"content": c, "truncated": False} for n, c in fake.gist_files.items()}
+                    self._json({"files": files}, etag=etag)
+                else:
+                    self._json({"error": "not found"}, 404)
+
+            def do_PATCH(self):
+                body = self._body()
+                with fake._lock:
+                    fake.gist_patches += 1
+                    fake.gist_bytes += len(body)
+                    for name, f in json.loads(body).get("files", {}).items():
+                        fake.gist_files[name] = f["content"]
+                    fake.gist_rev += 1
+                    etag = f'W/"{fake.gist_rev}"'
+                self._json({"ok": True}, etag=etag)
+
+            def do_POST(self):
+                path = urlsplit(self.path).path
+                if not path.startswith("/method/"):
+                    self._json({"error": "not found"}, 404)
+                    return
+                method = path[len("/method/"):]
+                values = {k: v[0] for k, v in parse_qs(self._body().decode("utf-8")).items()}
+                fake.requests[method] += 1
+                try:
+                    if method == "execute":
+                        self._json(fake.execute(values.get("code", "")))
+                    else:
+                        self._json({"response": fake.call(method, values)})
+                except KeyError:
+                    self._json({"error": {"error_code": 3, "error_msg": "Unknown method",
+                                          "request_params": []}})
+
+            def log_message(self, format, *args):
+                return
+
+        return Handler
+
+# ───────────── сценарии ─────────────
+def admin_script(bot, pages: int) -> List[str]:
+    """Все кнопки панели администратора (берутся из её клавиатуры), списки — с листанием."""
+    script = ["Админам"]
+    for line in json.loads(bot.admin_keyboard())["buttons"]:
+        for button in line:
+            label = button["action"]["label"]
+            if label == "Назад":
+                continue
+            script.append(label)
+            if label in ("Ученики", "Незаписавшиеся ученики"):
+                script += ["След. ▶"] * pages
+            elif label == "Редактировать":
+                script += ["Записать", "Отмена", "Редактировать", "Удалить", "Отмена"]
+    return script + ["Назад"]
+
+def build_scripts(args, bot) -> Dict[int, List[str]]:
+    students = [STUDENT_BASE + i for i in range(args.students)]
+    scripts: Dict[int, List[str]] = {}
+    if args.scenario in ("rush", "mixed"):
+        for uid in students:
+            scripts[uid] = ["Выбрать", "Программирование", SLOT_TITLE]
+    if args.scenario in ("roster", "mixed"):
+        for uid in ADMIN_IDS[:args.admins]:
+            scripts[uid] = admin_script(bot, args.pages)
+    if args.scenario in ("views", "mixed"):
+        viewers = students[:args.viewers] if args.scenario == "views" else students[-args.viewers:]
+        for uid in viewers:
+            scripts[uid] = scripts.get(uid, []) + ["Расписание", "Подробно"] * args.views
+    return scripts
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+# ───────────── прогон ─────────────
+def load_bot(fake: FakeVk, workdir: str, workers: int = 1, runtime: str = "threads"):
+    """
+    Импорт main.py с окружением на фейковый сервер; состояние — во временной папке.
+    workers > 1 — воркеры-процессы над общей SQLite (они получают то же окружение).
+    """
+    if workers > 1:
+        os.environ.update({"WORKERS": str(workers), "STORAGE_MODE": "sqlite"})
+    os.environ.update({
+        "VK_TOKEN": "bench-community",
+        "GROUP_ID": str(GROUP_ID),
+        "USER_TOKEN": "bench-user",
+        "ADMIN_USER_ID": "",
+        "GIST_TOKEN": "bench",
+        "GIST_ID": "bench",
+        "GIST_API_URL": fake.url,
+        "VK_API_URL": f"{fake.url}/method",
+        "INGEST_MODE": "bots",
+        "RUNTIME": runtime,
+        "PORT": "0",
+    })
+    os.chdir(workdir)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    spec = importlib.util.spec_from_file_location("main", path)
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = bot
+    spec.loader.exec_module(bot)
+    return bot
+
+def wait_done(fake: FakeVk, bot, timeout: float) -> bool:
+    """Ждём конца сценария; упавший обработчик не ответит — тогда не ждём таймаут."""
+    deadline = time.monotonic() + timeout
+    while not fake.done.wait(0.5):
+        if bot.HANDLER_ERRORS.total() or time.monotonic() > deadline:
+            return False
+    return True
+
+def booked(bot) -> int:
+    """Записей на слоты — из общей базы, если писали воркеры."""
+    bot.sync_from_store()
+    return sum(bot.booking_index.occupancy.values())
+
+def overbooked(bot) -> Dict[str, int]:
+    """Слоты, где записано больше, чем мест: "категория / слот" -> лишних записей."""
+    out = {}
+    for cat, cfg in bot.state.categories.items():
+        for s in cfg.slots:
+            extra = bot.booking_index.occupancy.get((cat, s.key), 0) - cfg.capacity
+            if extra > 0:
+                out[f"{cat} / {s.title}"] = extra
+    return out
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Офлайн-бенчмарк бота на фейковом VK API")
+    ap.add_argument("--scenario", choices=["rush", "roster", "views", "mixed"], default="mixed")
+    ap.add_argument("--students", type=int, default=1000, help="учеников в rush")
+    ap.add_argument("--capacity", type=int, default=50, help="мест в открытом слоте")
+    ap.add_argument("--members", type=int, default=5000, help="участников сообщества")
+    ap.add_argument("--admins", type=int, default=2, help=f"админов, листающих списки (до {len(ADMIN_IDS)})")
+    ap.add_argument("--pages", type=int, default=5, help="сколько раз админ жмёт «След.»")
+    ap.add_argument("--viewers", type=int, default=200, help="пользователей, смотрящих расписание")
+    ap.add_argument("--views", type=int, default=5, help="пар «Расписание»/«Подробно» на пользователя")
+    ap.add_argument("--timeout", type=float, default=600, help="секунд на весь прогон")
+    ap.add_argument("--workers", type=int, default=1, help="процессов-воркеров (>1 — STORAGE_MODE=sqlite)")
+    ap.add_argument("--runtime", choices=["threads", "asyncio"], default="threads", help="RUNTIME бота")
+    ap.add_argument("--json", action="store_true", help="результат одной строкой JSON")
+    ap.add_argument("--max-p95-ms", type=float, default=None, help="провал, если p95 задержки выше")
+    ap.add_argument("--min-eps", type=float, default=None, help="провал, если событий/с меньше")
+    args = ap.parse_args()
+
+    students = [STUDENT_BASE + i for i in range(args.students)]
+    fillers = [STUDENT_BASE + args.students + i for i in range(max(args.members - args.students, 0))]
+    fake = FakeVk(students + fillers)
+    fake.start()
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    cwd = os.getcwd()
+    bot = None
+    try:
+        bot = load_bot(fake, workdir, args.workers, args.runtime)
+        app = bot.create_app().start()
+        threading.Thread(target=app.serve, name="bot", daemon=True).start()
+
+        # подготовка: админ открывает слот (в замер не входит)
+        fake.run_scripts({ADMIN_IDS[0]: [f"/setxpr {SLOT_TITLE} {args.capacity} 1"]})
+        if not fake.done.wait(60):
+            print("❌ Бот не ответил на подготовку сценария", file=sys.stderr)
+            return 2
+        with fake._lock:
+            fake.latencies.clear()
+            fake.events_served = fake.replies = 0
+            fake.first_served = fake.last_reply = None
+        requests_before, calls_before = Counter(fake.requests), Counter(fake.calls)
+        writes_before = {t: bot.STATE_WRITE_SECONDS.count(t) for t in ("local", "journal", "sqlite", "gist")}
+        patches_before, gets_before = fake.gist_patches, Counter(fake.gist_gets)
+        gist_bytes_before = fake.gist_bytes
+
+        errors_before = bot.HANDLER_ERRORS.total()
+        scripts = build_scripts(args, bot)
+        started = time.perf_counter()
+        fake.run_scripts(scripts)
+        finished = wait_done(fake, bot, args.timeout)
+        wall = (fake.last_reply or time.perf_counter()) - (fake.first_served or started)
+
+        bot.flush_state(timeout=60)
+        writes = {t: bot.STATE_WRITE_SECONDS.count(t) - writes_before[t]
+                  for t in ("local", "journal", "sqlite", "gist")}
+        lat = list(fake.latencies)
+        result = {
+            "scenario": args.scenario,
+            "storage": bot.STORAGE_MODE,
+            "workers": bot.WORKERS,
+            "runtime": bot.RUNTIME,
+            "completed": finished,
+            "users": len(scripts),
+            "events": fake.events_served,
+            "replies": fake.replies,
+            "wall_s": round(wall, 3),
+            "events_per_s": round(fake.events_served / wall, 1) if wall > 0 else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(lat, 0.50) * 1000, 1),
+                "p95": round(percentile(lat, 0.95) * 1000, 1),
+                "p99": round(percentile(lat, 0.99) * 1000, 1),
+                "max": round(max(lat) * 1000, 1) if lat else 0.0,
+            },
+            "startup_s": dict(app.phases),
+            "threads": threading.active_count(),   # вместе с потоками самого фейкового VK
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "handler_errors": int(bot.HANDLER_ERRORS.total() - errors_before),   # с воркерами — не видно
+            "booked": booked(bot),
+            "overbooked": overbooked(bot),
+            "admission": {k: round(v * 1000, 1) if k.startswith("latency") else v
+                          for k, v in bot.admission.stats().items()},   # задержки — в мс
+            "vk_requests": dict((fake.requests - requests_before).most_common()),
+            "vk_calls": dict((fake.calls - calls_before).most_common()),
+            "persistence_writes": dict(writes, gist_patch=fake.gist_patches - patches_before,
+                                       gist_patch_bytes=fake.gist_bytes - gist_bytes_before,
+                                       gist_get=fake.gist_gets[200] - gets_before[200],
+                                       gist_not_modified=fake.gist_gets[304] - gets_before[304]),
+        }
+    finally:
+        if bot is not None and bot.workers is not None:
+            bot.workers.stop(timeout=30)   # процессы-воркеры не переживут os._exit сами
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failed = []
+    if result["handler_errors"]:
+        failed.append(f"исключений в обработчиках: {result['handler_errors']} (см. лог выше)")
+    if result["overbooked"]:
+        failed.append(f"записано больше мест, чем есть: {result['overbooked']}")
+    if not result["completed"] and not result["handler_errors"]:
+        failed.append(f"не уложились в {args.timeout:g} с")
+    if args.max_p95_ms is not None and result["latency_ms"]["p95"] > args.max_p95_ms:
+        failed.append(f"p95 {result['latency_ms']['p95']} мс > {args.max_p95_ms:g}")
+    if args.min_eps is not None and result["events_per_s"] < args.min_eps:
+        failed.append(f"{result['events_per_s']} событий/с < {args.min_eps:g}")
+    result["failed"] = failed
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        l = result["latency_ms"]
+        print(f"\n📊 {result['scenario']} ({result['storage']}, {result['runtime']}, воркеров: {result['workers']}): "
+              f"{result['users']} польз., "
+              f"{result['events']} событий, {result['replies']} ответов за {result['wall_s']} с")
+        print(f"   пропускная способность: {result['events_per_s']} событий/с")
+        print(f"   задержка ответа, мс: p50={l['p50']} p95={l['p95']} p99={l['p99']} max={l['max']}")
+        print(f"   запуск, с:          {result['startup_s']}")
+        print(f"   потоков: {result['threads']}, пик памяти: {result['max_rss_mb']} МБ")
+        a = result["admission"]
+        print(f"   записано на слоты: {result['booked']}")
+        if a["requests"]:   # с воркерами записи принимают они, здесь не видно
+            print(f"   приём записей: {a['requests']} попыток в {a['batches']} пачках (макс. {a['max_batch']}), "
+                  f"решение, мс: p50={a['latency_p50']} p95={a['latency_p95']} max={a['latency_max']}")
+        print(f"   HTTPS-запросы к VK: {result['vk_requests']}")
+        print(f"   вызовы методов VK:  {result['vk_calls']}")
+        print(f"   запись состояния:   {result['persistence_writes']}")
+        for f in failed:
+            print(f"❌ {f}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    code = main()
+    sys.stdout.flush()
+    os._exit(code)   # бот крутит longpoll в фоне — не ждём его потоков
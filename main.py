@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
-# VK-bot расписания (2 категории) + Render health-check + GitHub Gist persistence
+# VK-bot расписания по категориям + Render health-check + GitHub Gist persistence
+#
+# Категории (предметы) — данные, а не код: у каждой короткий id латиницей (для команд)
+# и название (оно же текст кнопки), вместимость слота, лимит записей на человека и любое
+# число слотов (до MAX_SLOTS_PER_CATEGORY). Пустое состояние начинается с двух прежних:
+# pr — Программирование и bh — Бухгалтерия, по 4 слота.
 #
 # ВАЖНО (фикс):
 # - "Ученики" / "Незаписавшиеся" / "Редактировать" берут список НЕ из known_users,
@@ -11,250 +16,1676 @@
 #   - Ученики
 #   - Админы
 #   - Незаписавшиеся ученики
-#   - Редактировать -> (Записать/Удалить) -> (Программирование/Бухгалтерия) -> список с номерами
+#   - Редактировать -> (Записать/Удалить) -> категория -> список с номерами
 #       Записать: выбираем ученика номером -> выбираем слот номером -> запись
-#       Удалить: выбираем ученика номером -> удаление из предмета (все слоты предмета)
+#       Удалить: выбираем ученика номером -> удаление из категории (все её слоты)
 #   - Инструкция (админ)
 #
-# Админ-команды текстом:
-#   /setxpr N d t CAP LIMIT      (точечно)
-#   /setxbh N d t CAP LIMIT
-#   /setxpr d1 t1 [d2 t2 ...] CAP LIMIT   (массово)
-#   /setxbh d1 t1 [d2 t2 ...] CAP LIMIT
-#   /delpr N   /delbh N          (удалить слот без сдвига: очищает title+users только этого слота)
-#   /clearpr   /clearbh          (очистить все записи категории)
+# Админ-команды текстом (ID — id категории):
+#   /newcat ID Название                  (новая категория, без слотов)
+#   /dropcat ID                          (удалить категорию вместе с записями)
+#   /setx ID N d t CAP LIMIT             (точечно: слот N, недостающие до N появятся пустыми)
+#   /setx ID d1 t1 [d2 t2 ...] CAP LIMIT (массово, без сброса записей)
+#   /del ID N                            (удалить слот без сдвига: очищает название и записи слота N)
+#   /clear ID                            (очистить все записи категории)
+# Прежние слитные команды — синонимы: /setxpr, /setxbh, /delpr N, /delbh N, /clearpr, /clearbh
+# (и так же для любого id: /setxeng ..., /deleng 2).
 #
 # Ученикам в расписании НЕ показываем номера слотов.
 
 import os
 import json
 import time
-from typing import Dict, List, Optional, Tuple
+import atexit
+import signal
+import functools
+import threading
+import itertools
+import queue
+import random
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from dotenv import load_dotenv
+import requests
 import vk_api
+from vk_api.vk_api import VkApiMethod
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
-from vk_api.longpoll import VkLongPoll, VkEventType
-from vk_api.exceptions import ApiError
+from vk_api.longpoll import VkLongPoll, VkEventType, Event as LongPollEvent, DEFAULT_MODE as LONGPOLL_MODE
+from vk_api.bot_longpoll import VkBotLongPoll
+from vk_api.exceptions import ApiError, TOO_MANY_RPS_CODE
 
 load_dotenv()
 
+# ───────────── метрики (Prometheus, GET /metrics) ─────────────
+# Без prometheus_client: счётчики и гистограммы в памяти, текстовый формат
+# собирается по запросу. Размеры (очереди, словари, состояние) считаются в момент запроса.
+METRICS: List["_Metric"] = []
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_value(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _labels(self, values: tuple, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        return []
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1.0):
+        key = tuple(str(v) for v in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def total(self) -> float:
+        """Сумма по всем меткам."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{self._labels(k)} {v:g}" for k, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=_LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}   # key -> [счётчики по корзинам, сумма, всего]
+
+    def observe(self, value: float, *labels):
+        key = tuple(str(v) for v in labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            h = self._values.get(tuple(str(v) for v in labels))
+            return h[2] if h else 0
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, [list(h[0]), h[1], h[2]]) for k, h in self._values.items())
+        out = []
+        for key, (counts, total, n) in items:
+            for b, c in zip(self.buckets, counts):
+                out.append(f"{self.name}_bucket{self._labels(key, (('le', f'{b:g}'),))} {c}")
+            out.append(f"{self.name}_bucket{self._labels(key, (('le', '+Inf'),))} {n}")
+            out.append(f"{self.name}_sum{self._labels(key)} {total:g}")
+            out.append(f"{self.name}_count{self._labels(key)} {n}")
+        return out
+
+class GaugeFunc(_Metric):
+    """Значение считается при запросе: fn() -> число или {(значения меток): число}."""
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], object],
+                 labels: Iterable[str] = (), kind: str = "gauge"):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self) -> List[str]:
+        value = self.fn()
+        if isinstance(value, dict):
+            return [f"{self.name}{self._labels(k if isinstance(k, tuple) else (k,))} {v:g}"
+                    for k, v in sorted(value.items())]
+        return [f"{self.name} {value:g}"]
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in METRICS:
+        try:
+            samples = m.samples()
+        except Exception:
+            continue  # источник ещё не готов (старт) — пропускаем метрику
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+EVENTS_TOTAL = Counter("bot_events_total", "Принятые события VK по типу", ["type"])
+EVENTS_DUPLICATE = Counter("bot_events_duplicate_total", "Повторно присланные события (Callback API)")
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки сообщения по обработчику", ["handler"])
+VK_REQUESTS = Counter("vk_requests_total", "HTTPS-запросы к VK API по методу", ["method"])
+VK_REQUEST_SECONDS = Histogram("vk_request_seconds", "Длительность HTTPS-запроса к VK API", ["method"])
+VK_REQUEST_ERRORS = Counter("vk_request_errors_total", "Ошибки HTTPS-запросов к VK API", ["method", "code"])
+VK_CALLS = Counter("vk_calls_total", "Вызовы методов VK API, в том числе внутри execute", ["method"])
+VK_CALL_SECONDS = Histogram("vk_call_seconds", "От вызова метода до результата (со склейкой в execute)", ["method"])
+VK_CALL_ERRORS = Counter("vk_call_errors_total", "Ошибки вызовов методов VK API", ["method", "code"])
+STATE_WRITE_SECONDS = Histogram("state_write_seconds", "Запись состояния: local / journal / sqlite / gist", ["target"])
+GIST_ERRORS = Counter("gist_errors_total", "Неудачные запросы к Gist", ["op"])
+MEMBERS_CACHE_REQUESTS = Counter("members_cache_requests_total", "Список участников: hit / stale / miss", ["result"])
+MEMBERS_REFRESH_SECONDS = Histogram("members_refresh_seconds", "Полная выгрузка участников",
+                                    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+INGEST_RECONNECTS = Counter("ingest_reconnects_total", "Переподключения к longpoll после ошибок", ["mode"])
+
+def _error_code(e: Exception) -> str:
+    return str(getattr(e, "code", None) or ("network" if not isinstance(e, ApiError) else "unknown"))
+
+def instrument_session(session: vk_api.VkApi) -> vk_api.VkApi:
+    """Считаем каждый HTTPS-запрос сессии: число, длительность, ошибки по методу."""
+    method = session.method
+
+    def measured(name, values=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(name, values, *args, **kwargs)
+        except Exception as e:
+            VK_REQUEST_ERRORS.inc(name, _error_code(e))
+            raise
+        finally:
+            VK_REQUESTS.inc(name)
+            VK_REQUEST_SECONDS.observe(time.perf_counter() - started, name)
+
+    session.method = measured
+    return session
+
 # ───────────────── Health-check HTTP server for Render ─────────────────
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Откуда берём события:
+#   longpoll — user-style VkLongPoll (как раньше)
+#   bots     — Bots Long Poll API (VkBotLongPoll)
+#   callback — Callback API: VK сам POST-ит события на CALLBACK_PATH этого же сервера
+#   replay   — локальный файл REPLAY_FILE (JSONL в формате Callback API), для проверок без VK
+# С RUNTIME=asyncio те же режимы работают задачами цикла asyncio (см. «asyncio-рантайм»).
+INGEST_MODE = os.getenv("INGEST_MODE", "longpoll").strip().lower()
+CALLBACK_PATH = os.getenv("CALLBACK_PATH", "/callback")
+CALLBACK_SECRET = os.getenv("VK_CALLBACK_SECRET", "")
+CALLBACK_CONFIRMATION = os.getenv("VK_CONFIRMATION_CODE", "")
+REPLAY_FILE = os.getenv("REPLAY_FILE", "events.jsonl")
+
+def http_route(method: str, target: str, body: bytes) -> Tuple[int, bytes, Optional[str], Optional[dict]]:
+    """
+    Ответ HTTP-сервера (общий для обоих рантаймов): код, тело, Content-Type и событие
+    Callback API, которое надо принять уже после ответа (None — нечего).
+    """
+    path = target.split("?", 1)[0]
+    if method == "GET":
+        if path == "/metrics":
+            return 200, render_metrics().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8", None
+        if path == "/ready":
+            # жив процесс — это "/" и "/live"; готов — когда состояние загружено и события принимаются
+            ready = app is not None and app.ready.is_set()
+            status = json.dumps(app.status() if app is not None else {"ready": False}, ensure_ascii=False)
+            return (200 if ready else 503), status.encode("utf-8"), "application/json", None
+        return 200, b"ok", None, None
+    if method != "POST" or INGEST_MODE != "callback" or path != CALLBACK_PATH:
+        return 404, b"not found", None, None
+    try:
+        update = json.loads(body.decode("utf-8") or "{}")
+    except Exception:
+        return 400, b"bad request", None, None
+    if not isinstance(update, dict):
+        return 400, b"bad request", None, None
+    if CALLBACK_SECRET and update.get("secret") != CALLBACK_SECRET:
+        return 403, b"forbidden", None, None
+    if update.get("type") == "confirmation":
+        return 200, CALLBACK_CONFIRMATION.encode("utf-8"), None, None
+    if app is None or not app.ready.is_set():
+        # состояние ещё грузится — VK повторит событие чуть позже
+        return 503, b"starting", None, None
+    # VK ждёт "ok" быстро, иначе пришлёт событие повторно — отвечаем до обработки
+    return 200, b"ok", None, update
 
 class _HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
+    def _reply(self, code: int, body: bytes, content_type: Optional[str] = None):
+        self.send_response(code)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(b"ok")
+        self.wfile.write(body)
+
+    def _handle(self, body: bytes = b""):
+        code, payload, content_type, update = http_route(self.command, self.path, body)
+        self._reply(code, payload, content_type)
+        if update is not None:
+            accept_update(update)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+        except Exception:
+            self._reply(400, b"bad request")
+            return
+        self._handle(body)
 
     def log_message(self, format, *args):
         return
 
+health_server: Optional[ThreadingHTTPServer] = None
+
 def _start_health_server():
+    global health_server
     try:
         port = int(os.environ.get("PORT", "10000"))
-        srv = HTTPServer(("", port), _HealthHandler)
-        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        if aio is not None:
+            port = aio.run(aio.serve_http(port))
+        else:
+            srv = ThreadingHTTPServer(("", port), _HealthHandler)
+            threading.Thread(target=srv.serve_forever, daemon=True).start()
+            health_server = srv
+            port = srv.server_address[1]
         print(f"Health server listening on :{port}")
     except Exception as e:
         print("Health server failed:", e)
 
-_start_health_server()
-
 # ───────────────── Gist persistence (optional) ─────────────────
-import urllib.request
+# Один keep-alive Session на все запросы к GitHub вместо нового HTTPS-соединения на вызов.
+#   • чтение — условное (If-None-Match по ETag): 304 не тянет тело и не тратит лимит API;
+#   • файл больше ~1 МБ GitHub отдаёт обрезанным ("truncated") — тогда дочитываем по raw_url;
+#   • запись пропускается, если sha256 содержимого совпадает с тем, что уже лежит в Gist;
+#   • перед PATCH — условный GET: если гист менялся не нами и файл в нём не тот, что мы
+#     записали последним, это конфликт (второй экземпляр бота?) — предупреждаем и считаем
+#     в gist_sync_total{result="conflict"}, но пишем своё: состояние в памяти у нас главное.
+import hashlib
 import json as _json
 
 GIST_TOKEN = os.getenv("GIST_TOKEN")
 GIST_ID = os.getenv("GIST_ID")
+GIST_API_URL = os.getenv("GIST_API_URL", "https://api.github.com").rstrip("/")
+GIST_TIMEOUT = 15
+
+GIST_SYNC = Counter("gist_sync_total", "Синхронизация с Gist по исходу: ok / not_modified / unchanged / truncated / conflict",
+                    ["op", "result"])
+
+def _sha(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class GistSync:
+    def __init__(self, token: str, gist_id: str, api_url: str = GIST_API_URL):
+        self.url = f"{api_url}/gists/{gist_id}"
+        self._http = requests.Session()
+        self._http.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github+json",
+            "User-Agent": "vk-bot-schedule"
+        })
+        self._lock = threading.Lock()
+        self._etag: Optional[str] = None
+        self._files: Dict[str, str] = {}   # имя файла -> содержимое на момент последнего чтения
+        self._hashes: Dict[str, str] = {}  # имя файла -> sha256 того, что сейчас в Gist (по нашим данным)
+
+    def _fetch(self, op: str) -> bool:
+        """Условный GET гиста. True — гист изменился с прошлого раза (кэш файлов обновлён)."""
+        headers = {"If-None-Match": self._etag} if self._etag else {}
+        r = self._http.get(self.url, headers=headers, timeout=GIST_TIMEOUT)
+        if r.status_code == 304:
+            GIST_SYNC.inc(op, "not_modified")
+            return False
+        r.raise_for_status()
+        files = {}
+        for name, f in (r.json().get("files") or {}).items():
+            content = f.get("content")
+            if f.get("truncated") or content is None:
+                GIST_SYNC.inc(op, "truncated")
+                raw = self._http.get(f["raw_url"], timeout=GIST_TIMEOUT)
+                raw.raise_for_status()
+                content = raw.content.decode("utf-8")
+            files[name] = content
+        self._files = files
+        self._etag = r.headers.get("ETag")
+        return True
+
+    def load(self, filename: str) -> Optional[dict]:
+        return self.load_many([filename]).get(filename)
+
+    def load_many(self, filenames: Iterable[str]) -> Dict[str, dict]:
+        """Несколько файлов за один (условный) GET. Отсутствующих и битых файлов в ответе нет."""
+        out = {}
+        with self._lock:
+            try:
+                self._fetch("load")
+            except Exception as e:
+                GIST_ERRORS.inc("load")
+                print("Gist load error:", e)
+                return out
+            for filename in filenames:
+                content = self._files.get(filename)
+                if content is None:
+                    continue
+                self._hashes[filename] = _sha(content)
+                GIST_SYNC.inc("load", "ok")
+                try:
+                    out[filename] = _json.loads(content or "{}")
+                except ValueError as e:
+                    GIST_ERRORS.inc("load")
+                    print("Gist load error:", e)
+        return out
+
+    def save_text(self, filename: str, content: str) -> bool:
+        """PATCH одного файла уже сериализованным текстом. True — если записано или менять нечего."""
+        return self.save_many({filename: content})
+
+    def save_many(self, contents: Dict[str, Optional[str]]) -> bool:
+        """
+        Один PATCH на все изменившиеся файлы; файлы с тем же содержимым не отправляются.
+        None вместо содержимого — удалить файл из гиста.
+        """
+        with self._lock:
+            changed = {}
+            for filename, content in contents.items():
+                if content is None and filename not in self._files and filename not in self._hashes:
+                    continue
+                if content is not None and self._hashes.get(filename) == _sha(content):
+                    GIST_SYNC.inc("save", "unchanged")
+                else:
+                    changed[filename] = content
+            if not changed:
+                return True
+            try:
+                if self._fetch("check"):
+                    for filename, content in list(changed.items()):
+                        remote = self._files.get(filename)
+                        known = self._hashes.get(filename)
+                        if remote is not None and known is not None and _sha(remote) != known:
+                            GIST_SYNC.inc("save", "conflict")
+                            print(f"⚠️ Gist: «{filename}» изменён кем-то ещё — перезаписываю своим состоянием.")
+                        if remote is not None and remote == content:
+                            self._hashes[filename] = _sha(content)
+                            GIST_SYNC.inc("save", "unchanged")
+                            del changed[filename]
+                    if not changed:
+                        return True
+                body = _json.dumps({"files": {n: {"content": c} if c is not None else None
+                                              for n, c in changed.items()}}).encode("utf-8")
+                with STATE_WRITE_SECONDS.time("gist"):
+                    r = self._http.patch(self.url, data=body, timeout=GIST_TIMEOUT)
+                    r.raise_for_status()
+            except Exception as e:
+                GIST_ERRORS.inc("save")
+                print("Gist save error:", e)
+                return False
+            # ETag из ответа на PATCH — это уже наша версия; если его нет, следующий GET будет полным
+            self._etag = r.headers.get("ETag")
+            for filename, content in changed.items():
+                if content is None:
+                    self._files.pop(filename, None)
+                    self._hashes.pop(filename, None)
+                else:
+                    self._files[filename] = content
+                    self._hashes[filename] = _sha(content)
+                GIST_SYNC.inc("save", "ok")
+            return True
 
-def _gist_headers():
-    return {
-        "Authorization": f"token {GIST_TOKEN}",
-        "Accept": "application/vnd.github+json",
-        "User-Agent": "vk-bot-schedule"
-    }
+gist: Optional[GistSync] = GistSync(GIST_TOKEN, GIST_ID) if (GIST_TOKEN and GIST_ID) else None
 
 def gist_load(filename: str) -> Optional[dict]:
-    if not (GIST_TOKEN and GIST_ID):
-        return None
-    try:
-        req = urllib.request.Request(
-            f"https://api.github.com/gists/{GIST_ID}",
-            headers=_gist_headers()
-        )
-        with urllib.request.urlopen(req, timeout=15) as r:
-            data = _json.loads(r.read().decode("utf-8"))
-        files = data.get("files", {})
-        if filename in files and "content" in files[filename]:
-            content = files[filename]["content"] or "{}"
-            return _json.loads(content)
-    except Exception as e:
-        print("Gist load error:", e)
-    return None
+    return gist.load(filename) if gist is not None else None
+
+def gist_load_many(filenames: Iterable[str]) -> Dict[str, dict]:
+    return gist.load_many(filenames) if gist is not None else {}
+
+def gist_save_text(filename: str, content: str) -> bool:
+    """PATCH одного файла гиста уже сериализованным текстом. True — если успешно (или Gist не настроен)."""
+    return gist.save_text(filename, content) if gist is not None else True
+
+def gist_save_many(contents: Dict[str, Optional[str]]) -> bool:
+    """Один PATCH на несколько файлов гиста. True — если успешно (или Gist не настроен)."""
+    return gist.save_many(contents) if gist is not None else True
 
 def gist_save(filename: str, obj: dict) -> None:
-    if not (GIST_TOKEN and GIST_ID):
-        return
-    try:
-        body = _json.dumps({
-            "files": {
-                filename: {
-                    "content": _json.dumps(obj, ensure_ascii=False, indent=2)
-                }
-            }
-        }).encode("utf-8")
-
-        req = urllib.request.Request(
-            f"https://api.github.com/gists/{GIST_ID}",
-            data=body,
-            method="PATCH",
-            headers=_gist_headers()
-        )
-        urllib.request.urlopen(req, timeout=15).read()
-    except Exception as e:
-        print("Gist save error:", e)
+    gist_save_text(filename, _json.dumps(obj, ensure_ascii=False, indent=2))
 
 # ───────────── env ─────────────
 COMMUNITY_TOKEN = os.getenv("VK_TOKEN")
 GROUP_ID = int(os.getenv("GROUP_ID", "0"))
 USER_TOKEN = os.getenv("USER_TOKEN")         # ВАЖНО: нужен для выгрузки участников
 MASTER_ID_ENV = os.getenv("ADMIN_USER_ID")   # VK user_id (число)
-
-if not COMMUNITY_TOKEN or not GROUP_ID:
-    raise RuntimeError("Нет VK_TOKEN или GROUP_ID в .env")
+# >1 — несколько процессов-воркеров над общей базой SQLite (см. «несколько воркеров»)
+WORKERS = max(int(os.getenv("WORKERS", "1")), 1)
 
 # ───────────── VK ─────────────
-vk_session = vk_api.VkApi(token=COMMUNITY_TOKEN)
-session_api = vk_session.get_api()
-longpoll = VkLongPoll(vk_session)
+# Вызовы API, пришедшие почти одновременно (из разных потоков или пачкой страниц),
+# склеиваются в один execute — до 25 методов за HTTPS-запрос. Снаружи это всё тот же
+# session_api.users.get(...), просто дешевле по лимиту запросов/с.
+EXECUTE_WINDOW = float(os.getenv("EXECUTE_WINDOW_MS", "10")) / 1000
+# другой адрес API (прокси, локальный стенд bench.py); по умолчанию — сам VK
+VK_API_URL = os.getenv("VK_API_URL", "").rstrip("/")
+_VK_METHOD_URL = "https://api.vk.com/method/"
+EXECUTE_MAX_CALLS = 25
+# сколько execute с USER_TOKEN одновременно (выгрузка участников по страницам); VK даёт
+# пользовательскому токену ~3 запроса/с, сверх — vk_api сам подождёт и повторит
+ROSTER_PARALLEL = int(os.getenv("ROSTER_PARALLEL", "3"))
+
+class _VkHttp(requests.Session):
+    def request(self, method, url, *args, **kwargs):
+        if VK_API_URL and url.startswith(_VK_METHOD_URL):
+            url = f"{VK_API_URL}/{url[len(_VK_METHOD_URL):]}"
+        return super().request(method, url, *args, **kwargs)
+
+def new_vk_session(token: str) -> vk_api.VkApi:
+    """Сессия VkApi с метриками запросов (и с VK_API_URL, если задан)."""
+    return instrument_session(vk_api.VkApi(token=token, session=_VkHttp()))
+
+def execute_code(calls: List[Tuple[str, dict]]) -> str:
+    return "return [" + ",".join(
+        f"API.{m}({json.dumps(v, ensure_ascii=False, separators=(',', ':'))})" for m, v in calls
+    ) + "];"
+
+def execute_results(raw: dict, calls: List[Tuple[str, dict]]) -> List[Tuple[object, Optional[dict]]]:
+    """Ответ execute (raw=True) -> на каждый вызов (результат, ошибка)."""
+    errors = iter(raw.get("execute_errors") or [])
+    out: List[Tuple[object, Optional[dict]]] = []
+    for res in raw.get("response") or []:
+        out.append((None, next(errors, None) or {}) if res is False else (res, None))
+    while len(out) < len(calls):
+        out.append((None, {}))
+    return out
+
+def execute_calls(session: vk_api.VkApi, calls: List[Tuple[str, dict]]) -> List[Tuple[object, Optional[dict]]]:
+    """Один execute на список (method, values). На каждый вызов — (результат, ошибка)."""
+    return execute_results(session.method("execute", {"code": execute_code(calls)}, raw=True), calls)
+
+def _observe_call(method: str, started: float, fut: Future):
+    VK_CALLS.inc(method)
+    VK_CALL_SECONDS.observe(time.perf_counter() - started, method)
+    e = fut.exception()
+    if e is not None:
+        VK_CALL_ERRORS.inc(method, _error_code(e))
+
+class ExecuteBatcher:
+    """Обёртка над VkApi: get_api() работает как обычно, но вызовы копятся и уходят пачками."""
+
+    def __init__(self, session: vk_api.VkApi, window: float = EXECUTE_WINDOW, parallel: int = 1):
+        """
+        parallel > 1 — столько execute может быть в полёте одновременно. У VkApi все запросы
+        идут под одним локом, поэтому каждому дополнительному потоку — своя сессия с тем же токеном.
+        Потоки запускаются при первом вызове, а не в конструкторе.
+        """
+        self.session = session
+        self.window = window
+        self.parallel = max(parallel, 1)
+        self._pending: deque = deque()
+        self._cv = threading.Condition()
+        self._started = False
+        self.requests = 0   # HTTPS-запросов
+        self.calls = 0      # методов API в них
+
+    def _start(self):
+        self._started = True
+        for i in range(self.parallel):
+            sess = self.session if i == 0 else new_vk_session(self.session.token["access_token"])
+            threading.Thread(target=self._loop, args=(sess,), name=f"vk-execute-{i}", daemon=True).start()
+
+    def get_api(self) -> VkApiMethod:
+        return VkApiMethod(self)
+
+    def submit(self, method: str, values: Optional[dict] = None) -> Future:
+        """Не ждёт ответа: удобно отправить сразу несколько вызовов и потом собрать результаты."""
+        fut: Future = Future()
+        fut.add_done_callback(functools.partial(_observe_call, method, time.perf_counter()))
+        with self._cv:
+            if not self._started:
+                self._start()
+            self._pending.append((method, dict(values or {}), fut))
+            self._cv.notify()
+        return fut
+
+    def method(self, method: str, values: Optional[dict] = None):
+        if method == "execute":
+            return self.session.method(method, values)
+        return self.submit(method, values).result()
+
+    def _loop(self, session: vk_api.VkApi):
+        while True:
+            with self._cv:
+                while not self._pending:
+                    self._cv.wait()
+                # чуть ждём попутчиков, но не дольше окна и не больше 25 вызовов
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < EXECUTE_MAX_CALLS:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cv.wait(left)
+                if not self._pending:
+                    continue    # пока ждали, всё забрал другой поток
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), EXECUTE_MAX_CALLS))]
+                self.requests += 1
+                self.calls += len(batch)
+                if self._pending:
+                    self._cv.notify()   # остаток — следующему свободному потоку
+            self._run(session, batch)
+
+    def _run(self, session: vk_api.VkApi, batch):
+        if len(batch) == 1:
+            method, values, fut = batch[0]
+            try:
+                fut.set_result(session.method(method, values))
+            except Exception as e:
+                fut.set_exception(e)
+            return
+        try:
+            results = execute_calls(session, [(m, v) for m, v, _ in batch])
+        except Exception as e:
+            for _m, _v, fut in batch:
+                fut.set_exception(e)
+            return
+        for (method, values, fut), (res, err) in zip(batch, results):
+            if err is None:
+                fut.set_result(res)
+            else:
+                err = dict({"error_code": 0, "error_msg": "execute: нет ответа"}, **err)
+                fut.set_exception(ApiError(self.session, method, values, {"error": err}, err))
+
+vk_session = new_vk_session(COMMUNITY_TOKEN)
+session_batcher = ExecuteBatcher(vk_session)
+session_api = session_batcher.get_api()
 
 user_api = None
+user_batcher: Optional[ExecuteBatcher] = None
 if USER_TOKEN:
+    user_session = new_vk_session(USER_TOKEN)
+    user_batcher = ExecuteBatcher(user_session, parallel=ROSTER_PARALLEL)
+    user_api = user_batcher.get_api()
+
+# Проверки токенов — при запуске (App.start), параллельно с загрузкой состояния
+def check_community_token() -> bool:
+    try:
+        gi = session_api.groups.getById(group_id=GROUP_ID)
+        print("OK: доступ к группе есть:", gi[0]["name"])
+        return True
+    except ApiError as e:
+        print("Проблема с доступом к группе:", e)
+        return False
+
+def check_user_token() -> bool:
+    if not user_api:
+        print("⚠️ USER_TOKEN не указан. Списки участников (Ученики/Незаписавшиеся/Редактировать) будут работать хуже.")
+        return False
     try:
-        user_session = vk_api.VkApi(token=USER_TOKEN)
-        user_api = user_session.get_api()
         info2 = user_api.groups.getById(group_id=GROUP_ID)
         print("OK: USER_TOKEN видит группу:", info2[0]["name"])
+        return True
     except Exception as e:
         print("Проблема с USER_TOKEN:", e)
-else:
-    print("⚠️ USER_TOKEN не указан. Списки участников (Ученики/Незаписавшиеся/Редактировать) будут работать хуже.")
+        return False
 
 # ───────────── категории / команды ─────────────
+# Категории (предметы) и их слоты — данные, а не код: админ заводит и удаляет их командами.
+# У категории короткий id латиницей — для команд (/setx pr ..., по-старому /setxpr ...)
+# и название — оно же текст кнопки. Пустое состояние начинается с двух прежних предметов
+# по 4 слота; новые категории (/newcat) — без слотов, их добавляет /setx.
+import re
+
 CAT_PR = "Программирование"
 CAT_BH = "Бухгалтерия"
-CATEGORIES = [CAT_PR, CAT_BH]
+DEFAULT_CATEGORIES = [("pr", CAT_PR), ("bh", CAT_BH)]
+DEFAULT_SLOT_KEYS = ["S1", "S2", "S3", "S4"]   # у прежних предметов слоты S1–S4 есть всегда, как раньше
+CATEGORY_ID_RE = re.compile(r"^[a-z0-9_]{1,16}$")
+MAX_SLOTS = int(os.getenv("MAX_SLOTS_PER_CATEGORY", "40"))
+
+CMD_SET = "/setx"
+CMD_CLEAR = "/clear"
+CMD_DEL = "/del"
+CMD_NEW_CAT = "/newcat"
+CMD_DROP_CAT = "/dropcat"
 
-CMD_SET_PR = "/setxpr"
-CMD_SET_BH = "/setxbh"
-CMD_CLEAR_PR = "/clearpr"
-CMD_CLEAR_BH = "/clearbh"
-CMD_DEL_PR = "/delpr"
-CMD_DEL_BH = "/delbh"
+BTN_REWRITE = "Перезапись: "        # + название категории
+BTN_REWRITE_ALL = "Перезапись: Всё"
 
-SLOT_KEYS = ["S1", "S2", "S3", "S4"]
+# листание длинных списков в админке
+BTN_PREV = "◀ Пред."
+BTN_NEXT = "След. ▶"
 
 # ───────────── state ─────────────
 STATE_FILE = "state.json"
-
-def _default_category_cfg() -> Dict:
-    return {
-        "capacity": 13,
-        "limit_per_user": 1,
-        "slots": [{"key": k, "title": "", "users": []} for k in SLOT_KEYS]
-    }
-
-def default_state() -> Dict:
-    return {
-        "known_users": {},  # "uid": {"name": "Имя Фамилия"} (оставим — полезно, но не используем как источник "учеников")
-        "categories": {
-            CAT_PR: _default_category_cfg(),
-            CAT_BH: _default_category_cfg(),
-        }
-    }
-
-def _normalize_state(data: dict) -> dict:
-    if not isinstance(data, dict):
-        return default_state()
-
-    data.setdefault("known_users", {})
-    if isinstance(data["known_users"], dict):
-        for k, v in list(data["known_users"].items()):
-            if isinstance(v, str):
-                data["known_users"][k] = {"name": v}
-            elif isinstance(v, dict):
-                v.setdefault("name", "")
-            else:
-                data["known_users"].pop(k, None)
-    else:
-        data["known_users"] = {}
-
-    data.setdefault("categories", {})
-    if not isinstance(data["categories"], dict):
-        data["categories"] = {}
-
-    for cat in CATEGORIES:
-        if cat not in data["categories"] or not isinstance(data["categories"][cat], dict):
-            data["categories"][cat] = _default_category_cfg()
-
-        cfg = data["categories"][cat]
-        cfg.setdefault("capacity", 13)
-        cfg.setdefault("limit_per_user", 1)
-        cfg.setdefault("slots", [])
-        if not isinstance(cfg["slots"], list):
-            cfg["slots"] = []
-
-        old_slots = cfg["slots"]
-        key_to_slot = {}
-        for idx, s in enumerate(old_slots):
-            if not isinstance(s, dict):
+JOURNAL_FILE = "state.journal"
+SQLITE_FILE = os.getenv("SQLITE_FILE", "state.sqlite3")
+# snapshot — файлы состояния целиком (см. «состояние по частям»); journal — журнал изменений
+# + периодический снимок; sqlite — база SQLite (WAL), файлы и Gist остаются как формат импорта/экспорта
+STORAGE_MODE = os.getenv("STORAGE_MODE", "snapshot").strip().lower()
+
+# ───────────── модель состояния ─────────────
+# В памяти расписание — объекты с __slots__, а не вложенные dict/list: форма данных
+# проверяется один раз при загрузке (State.from_json), названия слотов хранятся уже
+# обрезанными, uid записанных — в array("q"). В JSON-схему state.json / Gist / SQLite-импорта
+# состояние переводится только на границе записи (State.to_json):
+#   {"known_users": {"uid": {"name": ...}},
+#    "categories": {cat: {"id": "pr", "capacity": 13, "limit_per_user": 1,
+#                         "slots": [{"key": "S1", "title": ..., "users": [...], "uids": [...]}]}}}
+# Слот: users — имена для показа, uids — VK id тех же людей. Записи из старых state.json
+# без uid сопоставляются по known_users (если имя однозначно), иначе остаются с uid=0
+# и узнаются по имени, как раньше.
+from array import array
+
+class Slot:
+    __slots__ = ("key", "title", "users", "uids")
+
+    def __init__(self, key: str, title: str = "", users: Optional[List[str]] = None, uids: Iterable[int] = ()):
+        self.key = key
+        self.title = title.strip()
+        self.users: List[str] = users if users is not None else []
+        self.uids = array("q", uids)
+
+    def add(self, uid: int, name: str):
+        self.users.append(name)
+        self.uids.append(uid)
+
+    def remove_at(self, i: int) -> Tuple[str, int]:
+        return self.users.pop(i), self.uids.pop(i)
+
+    def positions_of(self, uid: int, name: str) -> List[int]:
+        """Где в слоте этот человек: по uid, а старые записи без uid — по имени."""
+        return [
+            i for i, (n, u) in enumerate(zip(self.users, self.uids))
+            if (uid > 0 and u == uid) or (u == 0 and n == name)
+        ]
+
+    def rename(self, uid: int, name: str):
+        for i, u in enumerate(self.uids):
+            if u == uid:
+                self.users[i] = name
+
+    def clear(self):
+        self.users = []
+        self.uids = array("q")
+
+    def to_json(self) -> dict:
+        return {"key": self.key, "title": self.title, "users": list(self.users), "uids": self.uids.tolist()}
+
+class Category:
+    """Слоты категории + индексы по ключу и названию (пересобираются в reindex())."""
+    __slots__ = ("id", "name", "capacity", "limit_per_user", "slots", "_by_key", "_by_title", "_pos")
+
+    def __init__(self, cid: str, name: str, capacity: int = 13, limit_per_user: int = 1,
+                 slots: Optional[List[Slot]] = None):
+        self.id = cid
+        self.name = name
+        self.capacity = capacity
+        self.limit_per_user = limit_per_user
+        self.slots: List[Slot] = slots if slots is not None else []
+        self.reindex()
+
+    def reindex(self):
+        """После любого изменения списка слотов или их названий."""
+        self._by_key = {s.key: s for s in self.slots}
+        self._pos = {s.key: i for i, s in enumerate(self.slots)}
+        self._by_title: Dict[str, Slot] = {}
+        for s in self.slots:
+            if s.title:
+                self._by_title.setdefault(s.title, s)
+
+    def slot(self, key: str) -> Optional[Slot]:
+        return self._by_key.get(key)
+
+    def by_title(self, title: str) -> Optional[Slot]:
+        return self._by_title.get(title)
+
+    def position(self, key: str) -> int:
+        return self._pos.get(key, len(self.slots))
+
+    def has_visible(self) -> bool:
+        return bool(self._by_title)
+
+    def retitle(self, titles: Dict[str, str]):
+        """Названия по ключам слотов; слоты с ещё не известными ключами добавляются в конец."""
+        for key, title in titles.items():
+            s = self._by_key.get(key)
+            if s is None:
+                s = self._by_key[key] = Slot(key)
+                self.slots.append(s)
+            s.title = title.strip()
+        self.reindex()
+
+    def keys_up_to(self, n: int) -> List[str]:
+        """Ключи слотов 1..n: существующие + новые для недостающих номеров."""
+        keys = [s.key for s in self.slots[:n]]
+        i = len(self.slots)
+        while len(keys) < n:
+            i += 1
+            if f"S{i}" not in self._by_key:
+                keys.append(f"S{i}")
+        return keys
+
+    def to_json(self) -> dict:
+        return {"id": self.id, "capacity": self.capacity, "limit_per_user": self.limit_per_user,
+                "slots": [s.to_json() for s in self.slots]}
+
+class KnownUser:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+class State:
+    __slots__ = ("known_users", "categories", "_by_id", "_pos")
+
+    def __init__(self, categories: Iterable[Tuple[str, str]] = DEFAULT_CATEGORIES):
+        # кто писал боту (не источник "учеников" — это участники сообщества)
+        self.known_users: Dict[int, KnownUser] = {}
+        self.categories: Dict[str, Category] = {}   # название -> категория, в порядке показа
+        self._by_id: Dict[str, Category] = {}
+        self._pos: Dict[str, int] = {}
+        for cid, name in categories:
+            self.add_category(Category(cid, name, slots=[Slot(k) for k in DEFAULT_SLOT_KEYS]))
+
+    def add_category(self, cfg: Category):
+        self.categories[cfg.name] = cfg
+        self._by_id[cfg.id] = cfg
+        self._pos[cfg.name] = len(self._pos)
+
+    def drop_category(self, name: str) -> Optional[Category]:
+        cfg = self.categories.pop(name, None)
+        if cfg is not None:
+            self._by_id.pop(cfg.id, None)
+            self._pos = {n: i for i, n in enumerate(self.categories)}
+        return cfg
+
+    def by_id(self, cid: str) -> Optional[Category]:
+        return self._by_id.get(cid)
+
+    def position(self, name: str) -> int:
+        return self._pos.get(name, len(self._pos))
+
+    def free_id(self, name: str) -> str:
+        """id для категории без него (старые state.json): прежний для прежних предметов, иначе cN."""
+        cid = dict((n, c) for c, n in DEFAULT_CATEGORIES).get(name)
+        i = len(self.categories)
+        while cid is None or cid in self._by_id:
+            i += 1
+            cid = f"c{i}"
+        return cid
+
+    @classmethod
+    def from_json(cls, data) -> "State":
+        """Из JSON-схемы; всё битое или отсутствующее заменяется значениями по умолчанию."""
+        if not isinstance(data, dict):
+            return cls()
+
+        cats = data.get("categories")
+        cats = {n: c for n, c in cats.items() if isinstance(c, dict)} if isinstance(cats, dict) else {}
+        st = cls(categories=()) if cats else cls()
+
+        known = data.get("known_users")
+        for k, v in (known.items() if isinstance(known, dict) else ()):
+            name = v if isinstance(v, str) else v.get("name") if isinstance(v, dict) else None
+            if str(k).isdigit() and isinstance(name, str):
+                st.known_users[int(k)] = KnownUser(name)
+
+        # имя -> uid, только для однозначных имён (для старых записей без uid)
+        name_to_uid: Dict[str, int] = {}
+        dup_names = set()
+        for uid, ku in st.known_users.items():
+            if not ku.name:
                 continue
-            title = s.get("title", "")
-            users = s.get("users", [])
-            if not isinstance(users, list):
-                users = []
-            key = s.get("key")
-            if not key:
-                if idx < len(SLOT_KEYS):
-                    key = SLOT_KEYS[idx]
-                else:
+            if ku.name in name_to_uid:
+                dup_names.add(ku.name)
+            name_to_uid[ku.name] = uid
+        for nm in dup_names:
+            name_to_uid.pop(nm, None)
+
+        for name, raw in cats.items():
+            cid = raw.get("id")
+            if not (isinstance(cid, str) and CATEGORY_ID_RE.match(cid)) or st.by_id(cid) is not None:
+                cid = st.free_id(name)
+            slots: List[Slot] = []
+            seen = set()
+            raw_slots = raw.get("slots")
+            for idx, s in enumerate(raw_slots if isinstance(raw_slots, list) else []):
+                if not isinstance(s, dict):
+                    continue
+                key = str(s.get("key") or f"S{idx + 1}")
+                if key in seen:
                     continue
-            key = str(key)
-            if key in SLOT_KEYS:
-                key_to_slot[key] = {"key": key, "title": str(title), "users": users}
+                seen.add(key)
+                users = s.get("users")
+                users = [str(u) for u in users] if isinstance(users, list) else []
+                uids = s.get("uids")
+                if isinstance(uids, list) and len(uids) == len(users):
+                    uids = [int(x) if str(x).isdigit() else 0 for x in uids]
+                else:
+                    uids = [name_to_uid.get(u, 0) for u in users]
+                slots.append(Slot(key, str(s.get("title") or ""), users, uids))
+            if any(name == n for _c, n in DEFAULT_CATEGORIES):
+                slots += [Slot(k) for k in DEFAULT_SLOT_KEYS if k not in seen]
+            st.add_category(Category(cid, name, _as_int(raw.get("capacity"), 13),
+                                     _as_int(raw.get("limit_per_user"), 1), slots))
+        return st
+
+    def to_json(self) -> dict:
+        return {
+            "known_users": {str(uid): {"name": ku.name} for uid, ku in self.known_users.items()},
+            "categories": {cat: cfg.to_json() for cat, cfg in self.categories.items()},
+        }
+
+def _as_int(value, default: int) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+# ───────────── состояние по частям ─────────────
+# Каждая запись на слот раньше переписывала (и отправляла в Gist) весь state.json вместе
+# с редко меняющимся known_users. Теперь у каждой части свой локальный файл и свой файл
+# в Gist, записываются только изменившиеся части:
+#   state.config.json          — вместимость, лимит и названия слотов по категориям
+#   state.users.json           — known_users
+#   state.schedule.<id>.json   — кто записан на слоты одной категории (id — хэш её имени)
+# Единый state.json по-прежнему читается, если частей ещё нет (переезд со старой версии).
+STATE_CONFIG_FILE = "state.config.json"
+STATE_USERS_FILE = "state.users.json"
+
+@functools.lru_cache(maxsize=None)
+def schedule_file(cat: str) -> str:
+    return f"state.schedule.{hashlib.sha1(cat.encode('utf-8')).hexdigest()[:10]}.json"
+
+def state_files(data: State) -> List[str]:
+    return [schedule_file(cat) for cat in data.categories] + [STATE_USERS_FILE, STATE_CONFIG_FILE]
+
+def state_part(data: State, filename: str) -> Optional[dict]:
+    """Одна часть состояния в JSON-схеме; None — такой части нет."""
+    if filename == STATE_CONFIG_FILE:
+        return {"categories": {
+            cat: {"id": cfg.id, "capacity": cfg.capacity, "limit_per_user": cfg.limit_per_user,
+                  "slots": [{"key": s.key, "title": s.title} for s in cfg.slots]}
+            for cat, cfg in data.categories.items()
+        }}
+    if filename == STATE_USERS_FILE:
+        return {"known_users": {str(uid): {"name": ku.name} for uid, ku in data.known_users.items()}}
+    for cat, cfg in data.categories.items():
+        if schedule_file(cat) == filename:
+            return {"category": cat,
+                    "slots": [{"key": s.key, "users": list(s.users), "uids": s.uids.tolist()} for s in cfg.slots]}
+    return None
 
-        new_slots = []
-        for k in SLOT_KEYS:
-            new_slots.append(key_to_slot.get(k) or {"key": k, "title": "", "users": []})
-        cfg["slots"] = new_slots
+def join_state_parts(read: Callable[[str], Optional[dict]]) -> Optional[dict]:
+    """
+    Части -> схема единого state.json (для State.from_json). None — частей нет.
+    "_journal_seq" здесь — {файл: номер последней вошедшей в него записи журнала}.
+    """
+    def part(filename: str) -> dict:
+        p = read(filename)
+        return p if isinstance(p, dict) else {}
 
+    config = read(STATE_CONFIG_FILE)
+    if not isinstance(config, dict):
+        return None
+    users = part(STATE_USERS_FILE)
+    seqs = {STATE_CONFIG_FILE: config.get("_journal_seq", 0), STATE_USERS_FILE: users.get("_journal_seq", 0)}
+    data = {"known_users": users.get("known_users"), "categories": {}, "_journal_seq": seqs}
+    cats = config.get("categories")
+    for cat, raw in (cats.items() if isinstance(cats, dict) else ()):
+        if not isinstance(raw, dict):
+            continue
+        sched = part(schedule_file(cat))
+        seqs[schedule_file(cat)] = sched.get("_journal_seq", 0)
+        booked = {b.get("key"): b for b in (sched.get("slots") or []) if isinstance(b, dict)}
+        slots = []
+        for s in (raw.get("slots") or []):
+            if isinstance(s, dict):
+                b = booked.get(s.get("key"), {})
+                slots.append({"key": s.get("key"), "title": s.get("title"),
+                              "users": b.get("users"), "uids": b.get("uids")})
+        data["categories"][cat] = dict(raw, slots=slots)
     return data
 
-def load_state() -> Dict:
-    g = gist_load(STATE_FILE)
+def _read_json(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print("State file error:", e)
+        return None
+
+def _load_local() -> Optional[dict]:
+    return join_state_parts(_read_json) or _read_json(STATE_FILE)
+
+def _load_gist() -> Optional[dict]:
+    files = gist_load_many([STATE_CONFIG_FILE, STATE_USERS_FILE, STATE_FILE])
+    config = files.get(STATE_CONFIG_FILE)
+    if not isinstance(config, dict):
+        return files.get(STATE_FILE)
+    cats = config.get("categories")
+    files.update(gist_load_many(schedule_file(cat) for cat in (cats if isinstance(cats, dict) else ())))
+    return join_state_parts(files.get)
+
+def _local_state_exists() -> bool:
+    return os.path.exists(STATE_CONFIG_FILE) or os.path.exists(STATE_FILE)
+
+def _load_snapshot(gist: bool = True) -> Optional[dict]:
+    """gist=False — только локальные файлы (Gist сверит reconcile_state_with_gist)."""
+    # в режиме журнала локальный снимок + журнал свежее Gist (туда уходят только снимки)
+    if STORAGE_MODE == "journal" and _local_state_exists():
+        data = _load_local()
+        if data is not None:
+            return data
+
+    g = _load_gist() if gist else None
     if g is not None:
         print("✓ Загружено состояние из Gist")
-        return _normalize_state(g)
+        return g
+
+    return _load_local()
+
+def load_state(gist: bool = True) -> State:
+    global _journal_seq_at_load
+    if sql_store is not None:
+        if sql_store.is_empty():
+            sql_store.import_state(State.from_json(_load_snapshot()))
+            print("✓ Состояние импортировано в SQLite")
+        data = State.from_json(sql_store.load())
+        sql_store.ensure_layout(data)
+        return data
+
+    raw = _load_snapshot(gist)
+    data = State.from_json(raw)
+    # единый state.json — один номер на всё, части — номер у каждой своей
+    seqs = raw.get("_journal_seq", 0) if isinstance(raw, dict) else 0
+    if not isinstance(seqs, dict):
+        seqs = {None: seqs}
+    seqs = {k: v if isinstance(v, int) else 0 for k, v in seqs.items()}
+    if STORAGE_MODE == "journal":
+        _journal_seq_at_load = _replay_journal(data, seqs)
+    else:
+        _journal_seq_at_load = max(seqs.values(), default=0)
+    return data
 
-    if not os.path.exists(STATE_FILE):
-        return default_state()
+# ───────────── журнал изменений (STORAGE_MODE=journal) ─────────────
+# Каждое изменение — одна короткая JSON-строка в JOURNAL_FILE, вместо перезаписи файлов
+# состояния. Периодически журнал сворачивается в снимок изменившихся частей (они же уходят
+# в Gist), в каждой части запоминается номер последней вошедшей записи ("_journal_seq"),
+# журнал очищается. При старте: части + записи журнала новее номера в своей части.
+#   {"n": 12, "op": "book",      "cat": ..., "key": "S1", "uid": 123, "name": "..."}
+#   {"n": 13, "op": "unbook",    "cat": ..., "key": "S1", "uid": 123, "name": "..."}
+#   {"n": 14, "op": "set_slots", "cat": ..., "titles": {"S1": "..."}, "capacity": 12, "limit": 1}
+#   {"n": 15, "op": "clear",     "cat": ..., "key": "S1"}   (без "key" — вся категория)
+#   {"n": 16, "op": "touch",     "uid": 123, "name": "..."}
+#   {"n": 17, "op": "add_category",  "cat": ..., "id": "pr", "capacity": 13, "limit": 1}
+#   {"n": 18, "op": "drop_category", "cat": ...}
+# set_slots с ключом, которого у категории ещё нет, добавляет слот в конец.
+_journal_seq_at_load = 0
+
+def _record_file(rec: dict) -> str:
+    """Часть состояния, которую меняет запись журнала."""
+    op = rec.get("op")
+    if op == "touch":
+        return STATE_USERS_FILE   # переименование в слотах повторять можно, оно идемпотентно
+    if op in ("set_slots", "add_category", "drop_category"):
+        return STATE_CONFIG_FILE
+    return schedule_file(rec.get("cat") or "")
+
+def _apply_record(data: State, rec: dict):
+    op = rec.get("op")
+    if op == "touch":
+        uid, name = int(rec["uid"]), rec["name"]
+        data.known_users[uid] = KnownUser(name)
+        for cfg in data.categories.values():
+            for s in cfg.slots:
+                s.rename(uid, name)
+        return
+    if op == "add_category":
+        if rec["cat"] not in data.categories and data.by_id(rec["id"]) is None:
+            data.add_category(Category(rec["id"], rec["cat"], rec.get("capacity", 13), rec.get("limit", 1)))
+        return
+    if op == "drop_category":
+        data.drop_category(rec.get("cat"))
+        return
 
-    try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return _normalize_state(data)
-    except Exception:
-        return default_state()
+    cfg = data.categories.get(rec.get("cat"))
+    if cfg is None:
+        return
 
-def save_state():
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-    gist_save(STATE_FILE, state)
+    if op == "book":
+        s = cfg.slot(rec["key"])
+        if s is not None:
+            s.add(int(rec["uid"]), rec["name"])
+    elif op == "unbook":
+        s = cfg.slot(rec["key"])
+        if s is not None:
+            for i in reversed(s.positions_of(int(rec["uid"]), rec["name"])):
+                s.remove_at(i)
+    elif op == "set_slots":
+        cfg.retitle(rec.get("titles") or {})
+        cfg.capacity = rec.get("capacity", cfg.capacity)
+        cfg.limit_per_user = rec.get("limit", cfg.limit_per_user)
+    elif op == "clear":
+        for s in cfg.slots:
+            if rec.get("key") in (None, s.key):
+                s.clear()
+
+def _replay_journal(data: State, seqs: Dict[Optional[str], int]) -> int:
+    """
+    Досыпает в data записи журнала новее снимка. seqs — {файл части: номер}, {None: номер}
+    для единого state.json. Возвращает номер последней записи.
+    """
+    base = seqs.get(None, 0)
+    seq = max(seqs.values(), default=0)
+    if not os.path.exists(JOURNAL_FILE):
+        return seq
+    applied = 0
+    with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except Exception:
+                break  # недописанная последняя строка после падения
+            n = int(rec.get("n", 0))
+            seq = max(seq, n)
+            if n <= seqs.get(_record_file(rec), base):
+                continue
+            _apply_record(data, rec)
+            applied += 1
+    if applied:
+        print(f"✓ Из журнала применено изменений: {applied}")
+    return seq
+
+# ───────────── SQLite (STORAGE_MODE=sqlite) ─────────────
+# Те же записи об изменениях, что и в журнале, сразу применяются к базе своей транзакцией;
+# запись на слот проверяет вместимость и лимит внутри одной транзакции (SqliteStore.book_many).
+# В памяти остаётся копия state + индекс — для быстрых ответов; файлы состояния и Gist
+# выгружаются по тем же правилам, что и снимок журнала.
+import sqlite3
+
+_SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (
+    name TEXT PRIMARY KEY,
+    id TEXT,
+    capacity INTEGER NOT NULL,
+    limit_per_user INTEGER NOT NULL,
+    pos INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slots (
+    cat TEXT NOT NULL,
+    key TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    pos INTEGER NOT NULL,
+    PRIMARY KEY (cat, key)
+);
+CREATE TABLE IF NOT EXISTS bookings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cat TEXT NOT NULL,
+    key TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bookings_slot ON bookings (cat, key);
+CREATE INDEX IF NOT EXISTS bookings_uid ON bookings (uid, cat);
+CREATE INDEX IF NOT EXISTS bookings_legacy ON bookings (name, cat) WHERE uid = 0;
+CREATE TABLE IF NOT EXISTS known_users (
+    uid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+"""
+
+def _sql_me(uid: int, name: str) -> Tuple[str, tuple]:
+    """Условие "это я" для bookings: по uid, а для старых записей без uid — по имени."""
+    if uid > 0:
+        return "(uid = ? OR (uid = 0 AND name = ?))", (uid, name)
+    return "(uid = 0 AND name = ?)", (name,)
+
+class SqliteStore:
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SQL_SCHEMA)
+        if "id" not in {row[1] for row in self._db.execute("PRAGMA table_info(categories)")}:
+            self._db.execute("ALTER TABLE categories ADD COLUMN id TEXT")   # база прошлой версии
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _tx(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _query(self, sql: str, args: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def is_empty(self) -> bool:
+        return not self._query("SELECT 1 FROM categories LIMIT 1")
+
+    def data_version(self) -> int:
+        """Меняется, когда базу изменило другое соединение (другой процесс); свои записи не в счёт."""
+        return self._query("PRAGMA data_version")[0][0]
+
+    def import_state(self, data: State):
+        with self._tx() as db:
+            for table in ("bookings", "slots", "categories", "known_users"):
+                db.execute(f"DELETE FROM {table}")
+            self._insert_layout(db, data)
+            for cat, cfg in data.categories.items():
+                for s in cfg.slots:
+                    db.executemany(
+                        "INSERT INTO bookings (cat, key, uid, name) VALUES (?, ?, ?, ?)",
+                        [(cat, s.key, uid, name) for name, uid in zip(s.users, s.uids)]
+                    )
+            db.executemany(
+                "INSERT INTO known_users (uid, name) VALUES (?, ?)",
+                [(uid, ku.name) for uid, ku in data.known_users.items()]
+            )
+
+    def ensure_layout(self, data: State):
+        """Категории/слоты, которых нет в базе (например, после обновления бота)."""
+        with self._tx() as db:
+            self._insert_layout(db, data)
+
+    @staticmethod
+    def _insert_layout(db, data: State):
+        for pos, (cat, cfg) in enumerate(data.categories.items()):
+            db.execute(
+                "INSERT OR IGNORE INTO categories (name, id, capacity, limit_per_user, pos) VALUES (?, ?, ?, ?, ?)",
+                (cat, cfg.id, cfg.capacity, cfg.limit_per_user, pos)
+            )
+            db.execute("UPDATE categories SET id = ? WHERE name = ? AND id IS NULL", (cfg.id, cat))
+            for spos, s in enumerate(cfg.slots):
+                db.execute(
+                    "INSERT OR IGNORE INTO slots (cat, key, title, pos) VALUES (?, ?, ?, ?)",
+                    (cat, s.key, s.title, spos)
+                )
+
+    def load(self) -> dict:
+        """Состояние в обычной JSON-схеме (как state.json) — для State.from_json."""
+        data = {"known_users": {}, "categories": {}}
+        for cat, cid, cap, lim in self._query("SELECT name, id, capacity, limit_per_user FROM categories ORDER BY pos"):
+            data["categories"][cat] = {"id": cid, "capacity": cap, "limit_per_user": lim, "slots": []}
+        slots = {}
+        for cat, key, title in self._query("SELECT cat, key, title FROM slots ORDER BY cat, pos"):
+            if cat in data["categories"]:
+                s = {"key": key, "title": title, "users": [], "uids": []}
+                data["categories"][cat]["slots"].append(s)
+                slots[(cat, key)] = s
+        for cat, key, uid, name in self._query("SELECT cat, key, uid, name FROM bookings ORDER BY id"):
+            s = slots.get((cat, key))
+            if s is not None:
+                s["users"].append(name)
+                s["uids"].append(uid)
+        for uid, name in self._query("SELECT uid, name FROM known_users"):
+            data["known_users"][str(uid)] = {"name": name}
+        return data
+
+    def book_many(self, reqs: List[Tuple[str, str, str, int, str]]) -> List[str]:
+        """
+        Пачка попыток записи (cat, key, title, uid, name) в порядке прихода — одной транзакцией.
+        Слот, вместимость и лимит берутся из самой базы, так что решение верно, даже если копия
+        state у вызывающего отстала от другого воркера. -> ["ok" | "already" | "limit" | "full" | "gone"]
+        """
+        out = []
+        with self._tx() as db:
+            for cat, key, title, uid, name in reqs:
+                row = db.execute(
+                    "SELECT s.title, c.capacity, c.limit_per_user FROM slots s JOIN categories c ON c.name = s.cat "
+                    "WHERE s.cat = ? AND s.key = ?", (cat, key)
+                ).fetchone()
+                if row is None or not row[0] or row[0] != title:
+                    out.append("gone")
+                    continue
+                _title, capacity, limit = row
+                me, args = _sql_me(uid, name)
+                if db.execute(f"SELECT 1 FROM bookings WHERE cat = ? AND key = ? AND {me} LIMIT 1",
+                              (cat, key) + args).fetchone():
+                    out.append("already")
+                    continue
+                (mine,) = db.execute(f"SELECT COUNT(*) FROM bookings WHERE cat = ? AND {me}", (cat,) + args).fetchone()
+                if mine >= limit:
+                    out.append("limit")
+                    continue
+                (taken,) = db.execute("SELECT COUNT(*) FROM bookings WHERE cat = ? AND key = ?", (cat, key)).fetchone()
+                if taken >= capacity:
+                    out.append("full")
+                    continue
+                db.execute("INSERT INTO bookings (cat, key, uid, name) VALUES (?, ?, ?, ?)", (cat, key, uid, name))
+                out.append("ok")
+        return out
+
+    def apply(self, rec: dict):
+        """Запись об изменении (см. журнал) -> одна транзакция."""
+        op = rec.get("op")
+        with self._tx() as db:
+            if op == "touch":
+                db.execute(
+                    "INSERT INTO known_users (uid, name) VALUES (?, ?) "
+                    "ON CONFLICT(uid) DO UPDATE SET name = excluded.name",
+                    (int(rec["uid"]), rec["name"])
+                )
+                db.execute("UPDATE bookings SET name = ? WHERE uid = ?", (rec["name"], int(rec["uid"])))
+            elif op == "book":
+                db.execute("INSERT INTO bookings (cat, key, uid, name) VALUES (?, ?, ?, ?)",
+                           (rec["cat"], rec["key"], int(rec["uid"]), rec["name"]))
+            elif op == "unbook":
+                me, args = _sql_me(int(rec["uid"]), rec["name"])
+                db.execute(f"DELETE FROM bookings WHERE cat = ? AND key = ? AND {me}",
+                           (rec["cat"], rec["key"]) + args)
+            elif op == "set_slots":
+                for key, title in (rec.get("titles") or {}).items():
+                    db.execute(
+                        "INSERT INTO slots (cat, key, title, pos) "
+                        "VALUES (?1, ?2, ?3, (SELECT COALESCE(MAX(pos) + 1, 0) FROM slots WHERE cat = ?1)) "
+                        "ON CONFLICT(cat, key) DO UPDATE SET title = excluded.title",
+                        (rec["cat"], key, title.strip())
+                    )
+                if "capacity" in rec:
+                    db.execute("UPDATE categories SET capacity = ?, limit_per_user = ? WHERE name = ?",
+                               (int(rec["capacity"]), int(rec["limit"]), rec["cat"]))
+            elif op == "add_category":
+                db.execute(
+                    "INSERT OR IGNORE INTO categories (name, id, capacity, limit_per_user, pos) "
+                    "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(pos) + 1, 0) FROM categories))",
+                    (rec["cat"], rec["id"], int(rec.get("capacity", 13)), int(rec.get("limit", 1)))
+                )
+            elif op == "drop_category":
+                db.execute("DELETE FROM bookings WHERE cat = ?", (rec["cat"],))
+                db.execute("DELETE FROM slots WHERE cat = ?", (rec["cat"],))
+                db.execute("DELETE FROM categories WHERE name = ?", (rec["cat"],))
+            elif op == "clear":
+                if rec.get("key") is None:
+                    db.execute("DELETE FROM bookings WHERE cat = ?", (rec["cat"],))
+                else:
+                    db.execute("DELETE FROM bookings WHERE cat = ? AND key = ?", (rec["cat"], rec["key"]))
+
+    # ── запросы по индексам ──
+    def slots_of(self, uid: int, name: str) -> Set[Tuple[str, str]]:
+        me, args = _sql_me(uid, name)
+        return set(self._query(f"SELECT cat, key FROM bookings WHERE {me}", args))
+
+    def category_roster(self, cat: str) -> List[Tuple[str, int, str]]:
+        """[(slot_key, uid, name)] в порядке записи."""
+        return self._query("SELECT key, uid, name FROM bookings WHERE cat = ? ORDER BY id", (cat,))
+
+# ───────────── фоновая запись состояния ─────────────
+# save_state() больше не пишет файл и не ходит в Gist сам: он помечает изменившиеся
+# части состояния "грязными" и возвращает номер версии. Фоновый поток раз в SAVE_COALESCE_SEC
+# сериализует только эти части, атомарно перезаписывает их файлы и делает один PATCH
+# в Gist — сколько бы save_state() ни случилось за это окно. Обработчики ответа на диск
+# не ждут; кому нужно (скрипт, выгрузка перед остановкой), тот ждёт свою версию:
+#   wait_state_durable(save_state(...)).
+# В режиме journal за окно в JOURNAL_FILE дописываются только записи об изменениях,
+# а снимок + Gist делаются раз в JOURNAL_COMPACT_SEC или после JOURNAL_COMPACT_RECORDS записей.
+# В режиме sqlite записи уже в базе к моменту save_state(), снимок выгружается так же.
+SAVE_COALESCE_SEC = float(os.getenv("SAVE_COALESCE_SEC", "2"))
+JOURNAL_COMPACT_SEC = float(os.getenv("JOURNAL_COMPACT_SEC", "60"))
+JOURNAL_COMPACT_RECORDS = int(os.getenv("JOURNAL_COMPACT_RECORDS", "500"))
+
+# все изменения state и снимок для записи — под этим локом
+state_lock = threading.RLock()
+
+def with_state_lock(fn):
+    """Декоратор: функция целиком выполняется под state_lock."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with state_lock:
+            return fn(*args, **kwargs)
+    return wrapper
+
+class StateWriter:
+    def __init__(self, window: float, mode: str = "snapshot"):
+        self.window = max(window, 0.0)
+        self.mode = mode
+        # journal/sqlite: за окно пишется только изменение, снимок — периодически
+        self.journal = mode in ("journal", "sqlite")
+        # выгружать снимок в файлы состояния/Gist; у воркеров (WORKERS > 1) — нет, это делает главный процесс
+        self.export = True
+        self._cond = threading.Condition()
+        self._version = 0    # последняя изменённая версия
+        self._durable = 0    # версия, записанная на диск и в Gist (в journal — в журнал)
+        self._flush_now = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        # файлы частей, изменившиеся с последней записи; None — все (после загрузки:
+        # переезд со state.json и досыпанный журнал должны лечь в части целиком)
+        self._dirty: Optional[Set[str]] = None
+        # файлы частей на момент последней записи (или загрузки): что из них пропало
+        # из state_files() — удалённые категории, их файлы удаляются при любом _dirty
+        self._parts: Set[str] = set()
+        # журнал: записи, ещё не дописанные в файл, и сколько записей в файле после снимка
+        self._seq = 0
+        self._pending: List[dict] = []
+        self._uncompacted = 0
+        self._last_compact = time.monotonic()
+
+    def start(self, seq: int = 0):
+        self._seq = seq
+        self._parts = set(state_files(state))
+        if self.mode == "journal" and os.path.exists(JOURNAL_FILE):
+            self._uncompacted = 1  # журнал с прошлого запуска — свернём при первой возможности
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+            self._thread.start()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def durable_version(self) -> int:
+        return self._durable
+
+    def log(self, rec: dict):
+        """Запись об изменении для журнала. Вызывать под state_lock, в порядке изменений."""
+        if self.mode == "sqlite":
+            with STATE_WRITE_SECONDS.time("sqlite"):
+                sql_store.apply(rec)
+            return
+        if self.mode != "journal":
+            return
+        self._seq += 1
+        rec["n"] = self._seq
+        self._pending.append(rec)
+
+    def mark_dirty(self, files: Optional[Iterable[str]] = None) -> int:
+        """files — какие части изменились (None — неизвестно, значит все)."""
+        with self._cond:
+            self._version += 1
+            self._redirty(files)
+            self._cond.notify_all()
+            return self._version
+
+    def _redirty(self, files: Optional[Iterable[str]]):
+        with self._cond:
+            if files is None:
+                self._dirty = None
+            elif self._dirty is not None:
+                self._dirty.update(files)
+
+    def wait_durable(self, version: int, timeout: Optional[float] = None) -> bool:
+        """Ждём, пока версия version (и все до неё) будет записана. False — по таймауту."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._durable >= version, timeout=timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Записать всё накопленное прямо сейчас, не дожидаясь конца окна."""
+        with self._cond:
+            target = self._version
+            if self._durable >= target:
+                return True
+            self._flush_now = True
+            self._cond.notify_all()
+        if self._thread is None or not self._thread.is_alive():
+            self._write(target)
+            return True
+        return self.wait_durable(target, timeout=timeout)
+
+    def stop(self, timeout: Optional[float] = 30):
+        ok = self.flush(timeout=timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        if self.journal and self._uncompacted:
+            self._compact()
+        if not ok:
+            print("⚠️ Не удалось дописать состояние перед остановкой.")
+
+    def _compact_due(self) -> Optional[float]:
+        if not (self.journal and self._uncompacted):
+            return None
+        return max(self._last_compact + JOURNAL_COMPACT_SEC - time.monotonic(), 0.0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._version > self._durable or self._stopping,
+                                    timeout=self._compact_due())
+                if self._stopping:
+                    return
+                target = None
+                if self._version > self._durable:
+                    # окно склейки: собираем все изменения, пришедшие за window секунд
+                    deadline = time.monotonic() + self.window
+                    while not self._flush_now and not self._stopping:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    self._flush_now = False
+                    target = self._version
+            if target is None:
+                self._compact()  # сработал таймер сворачивания журнала
+            else:
+                self._write(target)
 
-state = load_state()
+    def _write(self, target: int):
+        try:
+            if self.journal:
+                if self.mode == "sqlite":
+                    if self.export:
+                        self._uncompacted += 1  # изменения уже в базе, осталось выгрузить снимок
+                else:
+                    self._append_journal()
+                if self._uncompacted >= JOURNAL_COMPACT_RECORDS or self._compact_due() == 0:
+                    self._compact()
+            else:
+                with state_lock:
+                    files, contents = self._serialize()
+                try:
+                    self._write_parts(contents)
+                except Exception:
+                    self._redirty(files)
+                    raise
+                if not gist_save_many(contents):
+                    self._redirty(files)
+                    return  # Gist не принял — повторим в следующем окне
+        except Exception as e:
+            print("State write error:", e)
+            return
+        with self._cond:
+            if target > self._durable:
+                self._durable = target
+            self._cond.notify_all()
+
+    def _serialize(self, seq: Optional[int] = None) -> Tuple[List[str], Dict[str, Optional[str]]]:
+        """
+        Под state_lock: забрать список изменившихся частей и сериализовать их.
+        None — части больше нет (удалённая категория), её файл надо удалить.
+        """
+        with self._cond:
+            dirty, self._dirty = self._dirty, set()
+        files = state_files(state)
+        gone = sorted((self._parts | (dirty or set())) - set(files))
+        self._parts = set(files)
+        if dirty is not None:
+            files = [f for f in files if f in dirty]
+        # сначала файлы удалённых категорий, потом в порядке state_files()
+        files = gone + files
+        contents: Dict[str, Optional[str]] = {}
+        for name in files:
+            part = state_part(state, name)
+            if part is not None and seq is not None:
+                part["_journal_seq"] = seq
+            contents[name] = json.dumps(part, ensure_ascii=False, indent=2) if part is not None else None
+        return files, contents
+
+    def _write_parts(self, contents: Dict[str, Optional[str]]):
+        # порядок state_files(): расписания, known_users, config — см. _record_file
+        for name, content in contents.items():
+            with STATE_WRITE_SECONDS.time("local"):
+                if content is None:
+                    if os.path.exists(name):
+                        os.remove(name)
+                    continue
+                tmp = name + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(content)
+                os.replace(tmp, name)
+
+    def _append_journal(self):
+        with state_lock:
+            recs, self._pending = self._pending, []
+        if not recs:
+            return
+        with STATE_WRITE_SECONDS.time("journal"), open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in recs))
+            f.flush()
+            os.fsync(f.fileno())
+        self._uncompacted += len(recs)
+
+    def _compact(self):
+        """Снимок изменившихся частей (с номером последней записи) -> очистка журнала -> они же в Gist."""
+        files: List[str] = []
+        try:
+            with state_lock:
+                files, contents = self._serialize(self._seq if self.mode == "journal" else None)
+                # всё из _pending уже есть в снимке — в журнал это писать не нужно
+                self._pending = []
+            self._write_parts(contents)
+            if os.path.exists(JOURNAL_FILE):
+                os.remove(JOURNAL_FILE)
+            self._uncompacted = 0
+            self._last_compact = time.monotonic()
+            if not gist_save_many(contents):
+                self._redirty(files)
+                self._uncompacted = 1  # Gist не принял — повторим по таймеру
+        except Exception as e:
+            print("Journal compaction error:", e)
+            self._redirty(files)
+            self._last_compact = time.monotonic()
+
+sql_store: Optional[SqliteStore] = None   # открывается в init_state()
+state_writer = StateWriter(SAVE_COALESCE_SEC, mode=STORAGE_MODE)
+
+# Номер версии состояния: растёт при каждом изменении (все они проходят через save_state()).
+# По нему сбрасываются закэшированные тексты расписания, см. render_cached.
+state_version = 0
+
+def save_state(*records: dict, files: Iterable[str] = ()) -> int:
+    """
+    Пометить состояние изменённым. records — записи журнала об этом изменении
+    (вызывать под state_lock), files — какие ещё части оно задело; без того и другого
+    изменённым считается всё. Возвращает версию для wait_state_durable().
+    Лок берётся и здесь: зовут и не из обработчиков (наблюдатель WorkerPool, admit_batch),
+    а state_version += 1 без него теряет приращения.
+    """
+    global state_version
+    with state_lock:
+        state_version += 1
+        dirty = set(files)
+        for rec in records:
+            state_writer.log(rec)
+            dirty.add(_record_file(rec))
+        return state_writer.mark_dirty(dirty or None)
+
+def wait_state_durable(version: int, timeout: Optional[float] = None) -> bool:
+    """
+    Дождаться, пока изменение с номером version (из save_state) и все до него будут
+    записаны (файлы / журнал; Gist — по правилам режима). False — не успели за timeout.
+    """
+    return state_writer.wait_durable(version, timeout=timeout)
+
+def flush_state(timeout: Optional[float] = None) -> bool:
+    return state_writer.flush(timeout=timeout)
+
+def _on_sigterm(signum, frame):
+    # SystemExit пройдёт мимо `except Exception` в цикле, дальше atexit допишет состояние
+    raise SystemExit(0)
+
+# до App.start() — пустое состояние по умолчанию, см. init_state()
+state = State()
+
+# ───────────── индекс записей ─────────────
+# Кто где записан, без проходов по спискам слотов. Ключ человека — uid, а для старых
+# записей без uid — имя. Индекс меняется только вместе со state и под state_lock.
+Ident = Union[int, str]
+
+def _idents(uid: int, name: str) -> Tuple[Ident, ...]:
+    return (uid, name) if uid > 0 else (name,)
+
+class BookingIndex:
+    def __init__(self):
+        self.slots_of: Dict[Ident, Set[Tuple[str, str]]] = {}    # ident -> {(cat, key)}
+        self.occupancy: Dict[Tuple[str, str], int] = {}          # (cat, key) -> занято мест
+        self.booked: Dict[str, Dict[Ident, int]] = {}            # cat -> ident -> записей в категории
+
+    def rebuild(self, data: State):
+        self.slots_of.clear()
+        self.occupancy.clear()
+        self.booked.clear()
+        for cat, cfg in data.categories.items():
+            self.booked[cat] = {}
+            for s in cfg.slots:
+                self.occupancy[(cat, s.key)] = 0
+                for name, uid in zip(s.users, s.uids):
+                    self.add(cat, s.key, uid if uid > 0 else name)
+
+    def add(self, cat: str, key: str, ident: Ident):
+        self.slots_of.setdefault(ident, set()).add((cat, key))
+        self.occupancy[(cat, key)] = self.occupancy.get((cat, key), 0) + 1
+        b = self.booked.setdefault(cat, {})
+        b[ident] = b.get(ident, 0) + 1
+
+    def discard(self, cat: str, key: str, ident: Ident):
+        mine = self.slots_of.get(ident)
+        if mine is not None:
+            mine.discard((cat, key))
+            if not mine:
+                del self.slots_of[ident]
+        self.occupancy[(cat, key)] = max(self.occupancy.get((cat, key), 0) - 1, 0)
+        b = self.booked.get(cat, {})
+        if b.get(ident, 0) <= 1:
+            b.pop(ident, None)
+        else:
+            b[ident] -= 1
+
+    def count_in_category(self, cat: str, uid: int, name: str) -> int:
+        b = self.booked.get(cat, {})
+        return sum(b.get(i, 0) for i in _idents(uid, name))
+
+    def is_booked(self, cat: str, uid: int, name: str) -> bool:
+        b = self.booked.get(cat, {})
+        return any(i in b for i in _idents(uid, name))
+
+    def slots_for(self, uid: int, name: str) -> Set[Tuple[str, str]]:
+        out: Set[Tuple[str, str]] = set()
+        for i in _idents(uid, name):
+            out |= self.slots_of.get(i, set())
+        return out
+
+booking_index = BookingIndex()
 
 # ───────────── админы ─────────────
 MASTER_ID: Optional[int] = int(MASTER_ID_ENV) if (MASTER_ID_ENV and MASTER_ID_ENV.isdigit()) else None
@@ -262,6 +1693,9 @@ MASTER_ID: Optional[int] = int(MASTER_ID_ENV) if (MASTER_ID_ENV and MASTER_ID_EN
 ADMINS: List[int] = [aid for aid in [MASTER_ID, 1080975674, 20158141] if isinstance(aid, int)]
 
 # ───────────── runtime ─────────────
+# Все словари ниже ключуются user_id. Диспетчер выполняет события одного пользователя
+# строго последовательно, поэтому у каждого ключа в каждый момент ровно один писатель,
+# а сами операции dict атомарны. Общий state меняется только под state_lock.
 pending_cat: Dict[int, str] = {}
 pending_rewrite: Dict[int, str] = {}   # user_id -> "menu"
 admin_mode: Dict[int, str] = {}        # user_id -> "" | "panel" | "edit"
@@ -271,6 +1705,46 @@ admin_mode: Dict[int, str] = {}        # user_id -> "" | "panel" | "edit"
 admin_edit: Dict[int, Dict] = {}
 
 # ───────────── клавиатуры ─────────────
+# Клавиатуры меняются только вместе с настройками, поэтому собираются и сериализуются
+# один раз: функции ниже возвращают готовую JSON-строку из _kb_cache. Клавиатура слотов
+# категории сбрасывается через invalidate_slots_keyboard(), когда админ меняет слоты,
+# а все клавиатуры с категориями — через invalidate_keyboards(), когда меняется их список.
+_kb_cache: Dict[tuple, str] = {}
+
+def cached_keyboard(fn):
+    @functools.wraps(fn)
+    def wrapper(*args) -> str:
+        key = (fn.__name__,) + args
+        kb = _kb_cache.get(key)
+        if kb is None:
+            kb = fn(*args).get_keyboard()
+            _kb_cache[key] = kb
+        return kb
+    return wrapper
+
+def invalidate_slots_keyboard(cat: str):
+    _kb_cache.pop(("slots_keyboard", cat), None)
+
+def invalidate_keyboards():
+    _kb_cache.clear()
+
+KB_MAX_LINES, KB_MAX_IN_LINE = 10, 5   # ограничения VK для обычной клавиатуры
+
+def add_button_grid(kb: VkKeyboard, labels: List[str], color: VkKeyboardColor, per_line: int, reserve_lines: int = 1):
+    """
+    Кнопки сеткой по per_line в ряд (плотнее, если не влезают в KB_MAX_LINES за вычетом
+    reserve_lines рядов под служебные кнопки); что не влезло совсем — можно написать текстом.
+    """
+    lines = KB_MAX_LINES - reserve_lines
+    per_line = min(max(per_line, -(-len(labels) // lines)), KB_MAX_IN_LINE)
+    for i, label in enumerate(labels[:lines * per_line]):
+        if i and i % per_line == 0:
+            kb.add_line()
+        kb.add_button(label, color)
+    if labels:
+        kb.add_line()
+
+@cached_keyboard
 def base_keyboard(is_admin: bool) -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
     kb.add_button("Выбрать", VkKeyboardColor.POSITIVE)
@@ -283,41 +1757,41 @@ def base_keyboard(is_admin: bool) -> VkKeyboard:
     kb.add_button("Перезапись", VkKeyboardColor.PRIMARY)
     return kb
 
+@cached_keyboard
 def schedule_keyboard() -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
     kb.add_button("Подробно", VkKeyboardColor.PRIMARY)
     kb.add_button("Назад", VkKeyboardColor.SECONDARY)
     return kb
 
+@with_state_lock
+@cached_keyboard
 def choose_category_keyboard() -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
-    kb.add_button(CAT_PR, VkKeyboardColor.PRIMARY)
-    kb.add_button(CAT_BH, VkKeyboardColor.PRIMARY)
-    kb.add_line()
+    add_button_grid(kb, list(state.categories), VkKeyboardColor.PRIMARY, per_line=2)
     kb.add_button("Отмена", VkKeyboardColor.NEGATIVE)
     return kb
 
+@with_state_lock
+@cached_keyboard
 def slots_keyboard(cat: str) -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
-    for s in state["categories"][cat]["slots"]:
-        title = (s.get("title") or "").strip()
-        if title:
-            kb.add_button(title, VkKeyboardColor.SECONDARY)
-            kb.add_line()
+    cfg = state.categories.get(cat)
+    titles = [s.title for s in cfg.slots if s.title] if cfg is not None else []
+    add_button_grid(kb, titles, VkKeyboardColor.SECONDARY, per_line=1)
     kb.add_button("Отмена", VkKeyboardColor.NEGATIVE)
     return kb
 
+@with_state_lock
+@cached_keyboard
 def rewrite_keyboard() -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
-    kb.add_button("Перезапись: Программирование", VkKeyboardColor.PRIMARY)
-    kb.add_button("Перезапись: Бухгалтерия", VkKeyboardColor.PRIMARY)
-    kb.add_line()
-    kb.add_button("Перезапись: Всё", VkKeyboardColor.NEGATIVE)
+    add_button_grid(kb, [BTN_REWRITE + cat for cat in state.categories], VkKeyboardColor.PRIMARY, per_line=2)
+    kb.add_button(BTN_REWRITE_ALL, VkKeyboardColor.NEGATIVE)
     kb.add_button("Назад", VkKeyboardColor.SECONDARY)
     return kb
 
-def admin_keyboard() -> VkKeyboard:
-    kb = VkKeyboard(one_time=False)
+def _admin_panel_buttons(kb: VkKeyboard):
     kb.add_button("Ученики", VkKeyboardColor.SECONDARY)
     kb.add_button("Админы", VkKeyboardColor.SECONDARY)
     kb.add_line()
@@ -327,8 +1801,14 @@ def admin_keyboard() -> VkKeyboard:
     kb.add_button("Инструкция (админ)", VkKeyboardColor.PRIMARY)
     kb.add_line()
     kb.add_button("Назад", VkKeyboardColor.NEGATIVE)
+
+@cached_keyboard
+def admin_keyboard() -> VkKeyboard:
+    kb = VkKeyboard(one_time=False)
+    _admin_panel_buttons(kb)
     return kb
 
+@cached_keyboard
 def admin_edit_keyboard() -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
     kb.add_button("Записать", VkKeyboardColor.POSITIVE)
@@ -337,247 +1817,740 @@ def admin_edit_keyboard() -> VkKeyboard:
     kb.add_button("Назад", VkKeyboardColor.SECONDARY)
     return kb
 
+@with_state_lock
+def _admin_edit_cat_buttons(kb: VkKeyboard, reserve_lines: int = 1):
+    add_button_grid(kb, list(state.categories), VkKeyboardColor.PRIMARY, per_line=2, reserve_lines=reserve_lines)
+    kb.add_button("Отмена", VkKeyboardColor.NEGATIVE)
+    kb.add_button("Назад", VkKeyboardColor.SECONDARY)
+
+@cached_keyboard
 def admin_edit_cat_keyboard() -> VkKeyboard:
     kb = VkKeyboard(one_time=False)
-    kb.add_button(CAT_PR, VkKeyboardColor.PRIMARY)
-    kb.add_button(CAT_BH, VkKeyboardColor.PRIMARY)
+    _admin_edit_cat_buttons(kb)
+    return kb
+
+@cached_keyboard
+def paged_keyboard(has_prev: bool, has_next: bool, edit: bool) -> VkKeyboard:
+    """Листание длинного списка + обычные кнопки панели (edit=True — кнопки редактирования)."""
+    kb = VkKeyboard(one_time=False)
+    if has_prev:
+        kb.add_button(BTN_PREV, VkKeyboardColor.PRIMARY)
+    if has_next:
+        kb.add_button(BTN_NEXT, VkKeyboardColor.PRIMARY)
     kb.add_line()
-    kb.add_button("Отмена", VkKeyboardColor.NEGATIVE)
-    kb.add_button("Назад", VkKeyboardColor.SECONDARY)
+    if edit:
+        _admin_edit_cat_buttons(kb, reserve_lines=2)
+    else:
+        _admin_panel_buttons(kb)
     return kb
 
-# ───────────── сервис ─────────────
-def send_msg(user_id: int, text: str, kb: Optional[VkKeyboard] = None):
-    payload = {"user_id": user_id, "message": text, "random_id": 0}
+def _warm_keyboards():
+    base_keyboard(False)
+    base_keyboard(True)
+    for f in (schedule_keyboard, choose_category_keyboard, rewrite_keyboard,
+              admin_keyboard, admin_edit_keyboard, admin_edit_cat_keyboard):
+        f()
+    for has_prev in (False, True):
+        for has_next in (False, True):
+            paged_keyboard(has_prev, has_next, False)
+            paged_keyboard(has_prev, has_next, True)
+    for cat in list(state.categories):
+        slots_keyboard(cat)
+
+# ───────────── очередь исходящих сообщений ─────────────
+# Обработчики не ждут messages.send: сообщение кладётся в очередь и отправляется
+# воркерами с общим лимитом SEND_RATE запросов/с (token bucket под лимит VK для ключа
+# сообщества). Сообщения одного пользователя — всегда через один и тот же воркер, по порядку.
+# "Слишком много запросов" и сетевые ошибки — повтор с растущей паузой; random_id у
+# сообщения постоянный, так что повтор не продублирует его у пользователя. Пауза не держит
+# воркер: неудачные сообщения возвращаются в очередь по таймеру, а остальные тем временем
+# уходят (после "слишком много запросов" их и так придержит общий bucket).
+SEND_RATE = float(os.getenv("SEND_RATE", "20"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+VK_MESSAGE_MAX = 4096       # длина текста в messages.send
+_RETRY_API_CODES = {6, 10}   # too many requests per second / internal server error
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(rate, 0.1)
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Взять токен. 0 — взяли, иначе сколько секунд подождать до следующей попытки."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate)
+            self._ts = now
+            wait = self._paused_until - now
+            if wait <= 0:
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return 0.0
+                wait = (1 - self._tokens) / self.rate
+            return wait
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """VK сказал "слишком часто" — притормаживаем всех отправителей."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+class OutboundQueue:
+    def __init__(self, rate: float, workers: int):
+        self.bucket = TokenBucket(rate, burst=rate)
+        self._queues = [queue.PriorityQueue() for _ in range(max(workers, 1))]
+        self._seq = itertools.count()
+        self._threads: List[threading.Thread] = []
+        self._stats_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._latency: deque = deque(maxlen=2000)   # от постановки в очередь до отправки, сек
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._worker, args=(q,), name=f"sender-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def put(self, payload: dict):
+        payload.setdefault("random_id", random.getrandbits(31))
+        q = self._queues[int(payload.get("user_id", 0)) % len(self._queues)]
+        q.put((next(self._seq), time.monotonic(), 0, payload))
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lat = sorted(self._latency)
+        pct = lambda p: lat[min(int(len(lat) * p), len(lat) - 1)] if lat else 0.0
+        return {
+            "depth": self.depth(), "sent": self.sent, "failed": self.failed, "retried": self.retried,
+            "latency_p50": pct(0.50), "latency_p95": pct(0.95), "latency_max": lat[-1] if lat else 0.0,
+        }
 
-    if kb is not None:
-        payload["keyboard"] = kb.get_keyboard()
-    else:
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Ждём, пока всё из очереди будет отправлено (или отброшено)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for q in self._queues:
+            with q.all_tasks_done:
+                while q.unfinished_tasks:
+                    left = None if deadline is None else deadline - time.monotonic()
+                    if left is not None and left <= 0:
+                        return False
+                    q.all_tasks_done.wait(left)
+        return True
+
+    def _worker(self, q: "queue.PriorityQueue"):
+        # своя сессия: у VkApi общий лок на все запросы, а темп держит наш bucket
+        session = new_vk_session(COMMUNITY_TOKEN)
+        session.RPS_DELAY = 0
+        session.error_handlers.pop(TOO_MANY_RPS_CODE, None)
+        while True:
+            # всё, что накопилось в очереди (до 25), уходит одним execute — это один запрос в лимите
+            batch = [q.get()]
+            while len(batch) < EXECUTE_MAX_CALLS:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            deferred = 0
+            try:
+                self.bucket.acquire()
+                try:
+                    if len(batch) == 1:
+                        results = [(session.method("messages.send", batch[0][3]), None)]
+                    else:
+                        results = execute_calls(session, [("messages.send", item[3]) for item in batch])
+                except Exception as e:
+                    deferred = self._retry_or_fail(q, *self._send_error(batch, e), e)
+                    continue
+                deferred = self._retry_or_fail(q, *self._sent(batch, results))
+            finally:
+                for _ in range(len(batch) - deferred):
+                    q.task_done()
+
+    def _send_error(self, batch: list, e: Exception) -> Tuple[list, list]:
+        """Запрос не прошёл целиком -> (что повторить, что бросить)."""
+        code = getattr(e, "code", None)
+        if code == TOO_MANY_RPS_CODE:
+            self.bucket.pause(min(0.5 * 2 ** batch[0][2], 10.0))
+        retry = code in _RETRY_API_CODES or not isinstance(e, ApiError)
+        return (batch, []) if retry else ([], batch)
+
+    def _sent(self, batch: list, results: List[Tuple[object, Optional[dict]]]) -> Tuple[list, list, Optional[str]]:
+        """Учесть ответ на пачку -> (что повторить, что бросить, последняя ошибка)."""
+        ok, again, failed, last_err = [], [], [], None
+        for item, (_res, err) in zip(batch, results):
+            if err is None:
+                ok.append(item)
+                continue
+            last_err = f"[{err.get('error_code')}] {err.get('error_msg', '')}"
+            (again if err.get("error_code") in _RETRY_API_CODES else failed).append(item)
+        with self._stats_lock:
+            self.sent += len(ok)
+            now = time.monotonic()
+            self._latency.extend(now - item[1] for item in ok)
+        for item in ok:
+            OUTBOX_LATENCY.observe(now - item[1])
+        VK_CALLS.inc("messages.send", value=len(batch))
+        for item, (_res, err) in zip(batch, results):
+            if err is not None:
+                VK_CALL_ERRORS.inc("messages.send", err.get("error_code"))
+        return again, failed, last_err
+
+    def _give_up(self, again: list, failed: list, err) -> Tuple[list, float]:
+        """Исчерпавшие попытки — в отказ. -> (что вернуть в очередь, пауза перед этим)."""
+        failed = failed + [item for item in again if item[2] >= SEND_MAX_RETRIES]
+        again = [item for item in again if item[2] < SEND_MAX_RETRIES]
+        if failed:
+            with self._stats_lock:
+                self.failed += len(failed)
+            for item in failed:
+                print(f"⚠️ Не удалось отправить сообщение {item[3].get('user_id')}: {err}")
+        if not again:
+            return [], 0.0
+        with self._stats_lock:
+            self.retried += len(again)
+        # тот же seq — встают впереди более поздних сообщений
+        return ([(seq, enq_ts, attempt + 1, payload) for seq, enq_ts, attempt, payload in again],
+                min(0.5 * 2 ** max(item[2] for item in again), 10.0))
+
+    def _retry_or_fail(self, q: "queue.PriorityQueue", again: list, failed: list, err) -> int:
+        """
+        Повторы вернутся в очередь по таймеру, воркер тем временем шлёт остальное.
+        Возвращает, сколько сообщений пачки отложено: их task_done() сделает _requeue.
+        """
+        again, pause = self._give_up(again, failed, err)
+        if again:
+            timer = threading.Timer(pause, self._requeue, (q, again))
+            timer.daemon = True
+            timer.start()
+        return len(again)
+
+    @staticmethod
+    def _requeue(q, items: list):
+        for item in items:
+            q.put(item)
+            q.task_done()   # прежняя попытка закрывается только теперь — drain() дождётся повтора
+
+# лимит VK — на токен сообщества, а не на процесс: воркеры делят его поровну
+outbox = OutboundQueue(SEND_RATE / WORKERS, SEND_WORKERS)
+OUTBOX_LATENCY = Histogram("outbox_latency_seconds", "От постановки сообщения в очередь до отправки")
+GaugeFunc("outbox_depth", "Сообщений в очереди на отправку", lambda: outbox.depth())
+GaugeFunc("outbox_messages_total", "Исходящие сообщения: sent / failed / retried",
+          lambda: {"sent": outbox.sent, "failed": outbox.failed, "retried": outbox.retried},
+          labels=["result"], kind="counter")
+
+# ───────────── сервис ─────────────
+def send_msg(user_id: int, text: str, kb: Optional[str] = None):
+    """
+    kb — готовый JSON клавиатуры (см. *_keyboard()); без него — клавиатура текущего режима.
+    Не ждёт отправки: сообщение уходит через outbox.
+    """
+    if kb is None:
         mode = admin_mode.get(user_id, "")
         if mode == "panel":
-            payload["keyboard"] = admin_keyboard().get_keyboard()
+            kb = admin_keyboard()
         elif mode == "edit":
-            payload["keyboard"] = admin_edit_keyboard().get_keyboard()
+            kb = admin_edit_keyboard()
         else:
-            payload["keyboard"] = base_keyboard(user_id in ADMINS).get_keyboard()
-
-    session_api.messages.send(**payload)
+            kb = base_keyboard(user_id in ADMINS)
+
+    # длинный текст — несколькими сообщениями; один user_id = один воркер, порядок сохранится
+    for part in split_message(text):
+        outbox.put({"user_id": user_id, "message": part, "keyboard": kb})
+
+def split_message(text: str, limit: int = VK_MESSAGE_MAX) -> List[str]:
+    """Режем по строкам так, чтобы каждая часть влезла в лимит VK; слишком длинную строку — по символам."""
+    if len(text) <= limit:
+        return [text]
+    parts: List[str] = []
+    cur = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur:
+                parts.append(cur)
+                cur = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if cur and len(cur) + 1 + len(line) > limit:
+            parts.append(cur)
+            cur = line
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+    if cur:
+        parts.append(cur)
+    return parts
 
 def roster_with_numbers(users: List[str]) -> str:
     if not users:
         return "—"
     return "\n".join(f"{i+1}. {u}" for i, u in enumerate(users))
 
-def count_user_bookings_in_category(fullname: str, cat: str) -> int:
-    return sum(1 for s in state["categories"][cat]["slots"] if fullname in s["users"])
+@with_state_lock
+def slot_by_key(cat: str, key: str) -> Optional[Slot]:
+    cfg = state.categories.get(cat)
+    return cfg.slot(key) if cfg is not None else None
+
+def _slot_remove_at(cat: str, slot: Slot, positions: List[int]):
+    for i in sorted(positions, reverse=True):
+        name, uid = slot.remove_at(i)
+        booking_index.discard(cat, slot.key, uid if uid > 0 else name)
 
-def remove_user_from_category(fullname: str, cat: str) -> int:
+@with_state_lock
+def remove_user_from_category(uid: int, fullname: str, cat: str) -> int:
     removed = 0
-    for s in state["categories"][cat]["slots"]:
-        if fullname in s["users"]:
-            s["users"].remove(fullname)
-            removed += 1
+    for c, key in booking_index.slots_for(uid, fullname):
+        if c != cat:
+            continue
+        s = slot_by_key(cat, key)
+        if s is None:
+            continue
+        mine = s.positions_of(uid, fullname)
+        _slot_remove_at(cat, s, mine)
+        removed += len(mine)
+        if mine:
+            save_state({"op": "unbook", "cat": cat, "key": key, "uid": uid, "name": fullname})
     return removed
 
-def remove_user_from_all_categories(fullname: str) -> int:
+@with_state_lock
+def remove_user_from_all_categories(uid: int, fullname: str) -> int:
     removed = 0
-    for cat in CATEGORIES:
-        removed += remove_user_from_category(fullname, cat)
+    for cat in {c for c, _key in booking_index.slots_for(uid, fullname)}:
+        removed += remove_user_from_category(uid, fullname, cat)
     return removed
 
 # ───────────── Расписание (без номеров слотов) ─────────────
+# Расписание смотрят на порядки чаще, чем меняют: тексты и сводки по слотам
+# пересобираются, только если state_version сменилась с прошлой отрисовки.
+_render_cache: Dict[tuple, Tuple[int, object]] = {}
+
+def render_cached(fn):
+    """Результат fn(*args) живёт до следующего изменения состояния. Не изменять возвращённое!"""
+    @functools.wraps(fn)
+    def wrapper(*args):
+        key = (fn.__name__,) + args
+        hit = _render_cache.get(key)
+        if hit is not None and hit[0] == state_version:
+            return hit[1]
+        with state_lock:
+            version = state_version
+            value = fn(*args)
+        _render_cache[key] = (version, value)
+        return value
+    return wrapper
+
+@render_cached
+@with_state_lock
 def schedule_summary_text() -> str:
     lines: List[str] = ["📅 Расписание (кратко)\n"]
-    for cat in CATEGORIES:
-        cfg = state["categories"][cat]
-        cap = int(cfg.get("capacity", 13))
+    for cat, cfg in state.categories.items():
+        cap = cfg.capacity
         lines.append(f"🖥 {cat}")
         any_visible = False
-        for s in cfg.get("slots", []):
-            title = (s.get("title") or "").strip()
-            if not title:
+        for s in cfg.slots:
+            if not s.title:
                 continue
             any_visible = True
-            taken = len(s.get("users", []))
+            taken = len(s.users)
             free = max(cap - taken, 0)
-            lines.append(f"{title} | занято: {taken}/{cap} | свободно: {free}")
+            lines.append(f"{s.title} | занято: {taken}/{cap} | свободно: {free}")
         if not any_visible:
             lines.append("Слоты не настроены.\n")
         lines.append("")
     lines.append("Нажмите «Подробно», чтобы увидеть списки записанных.")
     return "\n".join(lines).strip()
 
+@render_cached
+@with_state_lock
 def schedule_detailed_text() -> str:
     lines: List[str] = ["📅 Расписание (подробно)\n"]
-    for cat in CATEGORIES:
-        cfg = state["categories"][cat]
-        cap = int(cfg.get("capacity", 13))
+    for cat, cfg in state.categories.items():
+        cap = cfg.capacity
         lines.append(f"🖥 {cat}")
         any_visible = False
-        for s in cfg.get("slots", []):
-            title = (s.get("title") or "").strip()
-            if not title:
+        for s in cfg.slots:
+            if not s.title:
                 continue
             any_visible = True
-            users = s.get("users", [])
-            taken = len(users)
+            taken = len(s.users)
             free = max(cap - taken, 0)
-            lines.append(f"{title} | занято: {taken}/{cap} | свободно: {free}\n")
-            lines.append(roster_with_numbers(users))
+            lines.append(f"{s.title} | занято: {taken}/{cap} | свободно: {free}\n")
+            lines.append(roster_with_numbers(s.users))
             lines.append("")
         if not any_visible:
             lines.append("Слоты не настроены.\n")
         lines.append("")
     return "\n".join(lines).strip()
 
-def my_bookings_text(fullname: str) -> str:
+@with_state_lock
+def my_bookings_text(uid: int, fullname: str) -> str:
+    mine = sql_store.slots_of(uid, fullname) if sql_store is not None else booking_index.slots_for(uid, fullname)
+    # слоты — только свои, без прохода по всем слотам каждой категории
+    by_cat: Dict[str, List[Tuple[int, str]]] = {}
+    for cat, key in mine:
+        cfg = state.categories.get(cat)
+        s = cfg.slot(key) if cfg is not None else None
+        if s is not None and s.title:
+            by_cat.setdefault(cat, []).append((cfg.position(key), s.title))
     blocks: List[str] = []
-    for cat in CATEGORIES:
-        my = []
-        for s in state["categories"][cat]["slots"]:
-            title = (s.get("title") or "").strip()
-            if not title:
-                continue
-            if fullname in s.get("users", []):
-                my.append("• " + title)
+    for cat in state.categories:
+        my = ["• " + title for _pos, title in sorted(by_cat.get(cat, ()))]
         blocks.append(f"🖥 {cat}")
         blocks.extend(my if my else ["—"])
         blocks.append("")
     text = "\n".join(blocks).strip()
-    return "Вы никуда не записаны.\n\n" + text if "•" not in text else "Ваши записи:\n\n" + text
+    return "Ваши записи:\n\n" + text if by_cat else "Вы никуда не записаны.\n\n" + text
 
 # ───────────── known_users (оставим как кэш кто писал) ─────────────
+@with_state_lock
 def touch_known_user(uid: int, fullname: str):
-    ku = state.setdefault("known_users", {})
-    key = str(uid)
-    entry = ku.get(key)
-    if not isinstance(entry, dict):
-        ku[key] = {"name": fullname}
-        save_state()
+    entry = state.known_users.get(uid)
+    if entry is None:
+        state.known_users[uid] = KnownUser(fullname)
+        save_state({"op": "touch", "uid": uid, "name": fullname})
         return
-    if entry.get("name") != fullname:
-        entry["name"] = fullname
-        save_state()
-
-# ───────────── ВЫГРУЗКА УЧАСТНИКОВ ЧЕРЕЗ USER_TOKEN (как в "нормальном" боте) ─────────────
-_members_cache: List[Tuple[int, str]] = []
-_members_cache_ts: float = 0.0
-MEMBERS_CACHE_TTL = 120  # секунд
+    if entry.name != fullname:
+        entry.name = fullname
+        # запись привязана к uid — поправим и имя, которое видно в списках
+        renamed = set()
+        for cat, slot_key in booking_index.slots_of.get(uid, ()):
+            slot_by_key(cat, slot_key).rename(uid, fullname)
+            renamed.add(schedule_file(cat))
+        save_state({"op": "touch", "uid": uid, "name": fullname}, files=renamed)
+
+# ───────────── кэш имён (uid -> "Имя Фамилия") ─────────────
+# Чтобы не дёргать users.get на каждое сообщение: имена живут NAME_CACHE_TTL секунд,
+# при переполнении выкидываются самые давно использованные.
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", "21600"))     # 6 часов
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", "20000"))
+
+def _fullname(u: dict) -> str:
+    return f"{u.get('first_name', '')} {u.get('last_name', '')}".strip()
+
+class NameCache:
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = max(maxsize, 1)
+        self._data: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, uid: int, allow_stale: bool = False) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(uid)
+            if item is None:
+                return None
+            name, ts = item
+            if not allow_stale and time.monotonic() - ts > self.ttl:
+                return None
+            self._data.move_to_end(uid)
+            return name
+
+    def put(self, uid: int, name: str):
+        if not name:
+            return
+        with self._lock:
+            self._data[uid] = (name, time.monotonic())
+            self._data.move_to_end(uid)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def warm(self, pairs: Iterable[Tuple[int, str]]):
+        for uid, name in pairs:
+            self.put(uid, name)
+
+    def resolve(self, uids: List[int], api=None) -> Dict[int, str]:
+        """Имена для uids: из кэша, промахи — одним users.get на пачку до 1000 id."""
+        out: Dict[int, str] = {}
+        misses: List[int] = []
+        for uid in uids:
+            name = self.get(uid)
+            if name is None:
+                misses.append(uid)
+            else:
+                out[uid] = name
+        if not misses:
+            return out
+        api = api or session_api
+        try:
+            for i in range(0, len(misses), 1000):
+                chunk = misses[i:i+1000]
+                for u in api.users.get(user_ids=",".join(map(str, chunk)), fields="first_name,last_name"):
+                    name = _fullname(u)
+                    self.put(int(u.get("id", 0)), name)
+                    out[int(u.get("id", 0))] = name
+        except Exception:
+            # API недоступно — лучше устаревшее имя, чем никакого
+            stale = {uid: self.get(uid, allow_stale=True) for uid in misses}
+            if any(v is None for v in stale.values()):
+                raise
+            out.update(stale)
+        return out
+
+    def resolve_one(self, uid: int) -> str:
+        return self.resolve([uid]).get(uid, "")
+
+name_cache = NameCache(NAME_CACHE_TTL, NAME_CACHE_SIZE)
 
-def fetch_admin_ids_via_user_token() -> List[int]:
-    """Берём managers (руководители) через user_api. Это те, кого надо исключать из учеников."""
-    if not user_api:
+def users_get_names(uids: List[int]) -> List[str]:
+    if not uids:
         return []
-    ids: List[int] = []
-    offset, total = 0, None
-    while True:
-        data = user_api.groups.getMembers(
-            group_id=GROUP_ID,
-            filter="managers",
-            fields="id",
-            count=200,
-            offset=offset
-        )
-        if total is None:
-            total = data.get("count", 0)
-        items = data.get("items", [])
-        for it in items:
-            if isinstance(it, dict) and "id" in it:
-                ids.append(int(it["id"]))
-            elif isinstance(it, int):
-                ids.append(int(it))
-        offset += len(items)
-        if offset >= total or not items:
-            break
-    return ids
+    try:
+        names = name_cache.resolve(uids, api=user_api or session_api)
+        return [names.get(uid) or str(uid) for uid in uids]
+    except Exception:
+        return [str(x) for x in uids]
 
-def fetch_members_excluding_admins(force: bool = False) -> List[Tuple[int, str]]:
-    """
-    Возвращает список [(uid, "Имя Фамилия"), ...] по реальным участникам сообщества,
-    исключая админов (managers + локальные ADMINS).
-    """
-    global _members_cache, _members_cache_ts
+@with_state_lock
+def _known_users_pairs() -> List[Tuple[int, str]]:
+    return [(uid, ku.name) for uid, ku in state.known_users.items() if ku.name]
 
-    if not user_api:
-        # без user_token не можем выгрузить всех подписчиков
+# ───────────── ВЫГРУЗКА УЧАСТНИКОВ ЧЕРЕЗ USER_TOKEN (как в "нормальном" боте) ─────────────
+# Список участников лежит на диске рядом с state.json и поднимается при старте.
+# Отдаём его сразу, даже устаревший; если он старше MEMBERS_CACHE_TTL (или просят force) —
+# обновляем в фоне, и одновременно идёт не больше одного обновления.
+# Ждать приходится только при холодном старте, когда файла ещё нет.
+MEMBERS_CACHE_FILE = os.getenv("MEMBERS_CACHE_FILE", "members.json")
+_members_cache: List[Tuple[int, str]] = []
+_members_cache_ts: float = 0.0   # когда реально выгружен (time.time())
+_members_gen = 0                 # растёт при invalidate_members_cache()
+_members_fresh_gen = -1          # поколение, которому соответствует _members_cache
+_members_lock = threading.Lock()
+_members_refresh: Optional[Future] = None
+MEMBERS_CACHE_TTL = float(os.getenv("MEMBERS_CACHE_TTL", "120"))  # секунд
+
+MEMBERS_PAGE = 1000       # максимум groups.getMembers за вызов
+
+def _rest_pages(params: dict, first_page: dict) -> List[Future]:
+    """По count первой страницы — сразу все остальные offset'ы (уйдут пачками execute параллельно)."""
+    total = int(first_page.get("count", 0))
+    got = len(first_page.get("items", []))
+    if not got:
         return []
+    return [
+        user_batcher.submit("groups.getMembers", dict(params, offset=off))
+        for off in range(got, total, MEMBERS_PAGE)
+    ]
 
-    now = time.time()
-    if (not force) and _members_cache and (now - _members_cache_ts) < MEMBERS_CACHE_TTL:
-        return _members_cache
+def _managers_params() -> dict:
+    return {"group_id": GROUP_ID, "filter": "managers", "fields": "id", "count": MEMBERS_PAGE}
 
-    admin_ids = set(fetch_admin_ids_via_user_token()) | set(ADMINS)
+def _member_ids(items) -> List[int]:
+    ids: List[int] = []
+    for it in items:
+        if isinstance(it, dict) and "id" in it:
+            ids.append(int(it["id"]))
+        elif isinstance(it, int):
+            ids.append(int(it))
+    return ids
 
-    out: List[Tuple[int, str]] = []
-    offset, total = 0, None
-    while True:
-        data = user_api.groups.getMembers(
-            group_id=GROUP_ID,
-            fields="first_name,last_name,id",
-            count=1000,
-            offset=offset
-        )
-        if total is None:
-            total = data.get("count", 0)
-        items = data.get("items", [])
+def _download_members(progress: Optional[Callable[[int, int], None]] = None) -> List[Tuple[int, str]]:
+    """Полная выгрузка участников без админов (managers + локальные ADMINS): [(uid, "Имя Фамилия")]."""
+    # первые страницы managers и участников уходят одним execute, из них узнаём count;
+    # остальные страницы запрашиваются все сразу и грузятся параллельно (ROSTER_PARALLEL)
+    mgr_params = _managers_params()
+    params = {"group_id": GROUP_ID, "fields": "first_name,last_name,id", "count": MEMBERS_PAGE}
+    mgr_first = user_batcher.submit("groups.getMembers", dict(mgr_params, offset=0))
+    first = user_batcher.submit("groups.getMembers", dict(params, offset=0))
+    mgr_page, page = mgr_first.result(), first.result()
+    mgr_rest = _rest_pages(mgr_params, mgr_page)
+    rest = _rest_pages(params, page)
+
+    admin_items = list(mgr_page.get("items", []))
+    for fut in mgr_rest:
+        admin_items.extend(fut.result().get("items", []))
+    admin_ids = set(_member_ids(admin_items)) | set(ADMINS)
+
+    total = int(page.get("count", 0))
+    loaded = 0
+    seen: Set[int] = set()
+    uniq: List[Tuple[int, str]] = []
+
+    def take(items):
+        nonlocal loaded
+        loaded += len(items)
         for it in items:
             if not isinstance(it, dict):
                 continue
             uid = int(it.get("id", 0))
-            if uid <= 0:
+            if uid <= 0 or uid in seen or uid in admin_ids:
                 continue
-            first = it.get("first_name") or ""
+            first_name = it.get("first_name") or ""
             last = it.get("last_name") or ""
-            name = f"{first} {last}".strip()
+            name = f"{first_name} {last}".strip()
             if not name:
                 continue
-            if uid in admin_ids:
-                continue
-            out.append((uid, name))
+            seen.add(uid)
+            uniq.append((uid, name))
+        if progress:
+            progress(loaded, total)
 
-        offset += len(items)
-        if offset >= total or not items:
-            break
+    # страницы разбираем в порядке прихода, дубли (сдвиг offset'ов при вступлениях) отсекаем по uid
+    take(page.get("items", []))
+    for fut in as_completed(rest):
+        take(fut.result().get("items", []))
 
-    # уникализируем по uid
-    seen = set()
-    uniq = []
-    for uid, name in out:
-        if uid in seen:
-            continue
-        seen.add(uid)
-        uniq.append((uid, name))
-
-    _members_cache = uniq
-    _members_cache_ts = now
     return uniq
 
-def users_get_names(uids: List[int]) -> List[str]:
-    if not uids:
-        return []
+def _load_members_cache():
+    global _members_cache, _members_cache_ts, _members_fresh_gen
+    if not os.path.exists(MEMBERS_CACHE_FILE):
+        return
     try:
-        api = user_api or session_api
-        chunks = [uids[i:i+900] for i in range(0, len(uids), 900)]
-        names: List[str] = []
-        for chunk in chunks:
-            res = api.users.get(user_ids=",".join(map(str, chunk)))
-            for u in res:
-                names.append(f"{u.get('first_name','')} {u.get('last_name','')}".strip())
-        return names
-    except Exception:
-        return [str(x) for x in uids]
+        with open(MEMBERS_CACHE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        members = [(int(uid), str(name)) for uid, name in data.get("members", [])]
+    except Exception as e:
+        print("⚠️ Не удалось прочитать кэш участников:", e)
+        return
+    with _members_lock:
+        _members_cache, _members_cache_ts = members, float(data.get("ts", 0))
+        _members_fresh_gen = _members_gen
+    name_cache.warm(members)
+    print(f"👥 Участники из {MEMBERS_CACHE_FILE}: {len(members)} ({_age_text(time.time() - _members_cache_ts)} назад)")
+
+def _save_members_cache(members: List[Tuple[int, str]], ts: float):
+    tmp = f"{MEMBERS_CACHE_FILE}.{os.getpid()}.tmp"   # воркеры пишут кэш одновременно
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"ts": ts, "members": members}, f, ensure_ascii=False)
+    os.replace(tmp, MEMBERS_CACHE_FILE)
+
+def _refresh_members(fut: Future, gen: int, progress: Optional[Callable[[int, int], None]]):
+    global _members_cache, _members_cache_ts, _members_fresh_gen
+    try:
+        with MEMBERS_REFRESH_SECONDS.time():
+            members = _download_members(progress)
+    except Exception as e:
+        print("⚠️ Не удалось обновить список участников:", e)
+        fut.set_exception(e)
+        return
+    ts = time.time()
+    with _members_lock:
+        _members_cache, _members_cache_ts = members, ts
+        # если за время выгрузки кто-то вступил/вышел — кэш остаётся помеченным устаревшим
+        _members_fresh_gen = gen
+    name_cache.warm(members)
+    try:
+        _save_members_cache(members, ts)
+    except Exception as e:
+        print("⚠️ Не удалось записать кэш участников:", e)
+    fut.set_result(members)
+
+def refresh_members_async(progress: Optional[Callable[[int, int], None]] = None) -> Future:
+    """Запускает обновление в фоне; если оно уже идёт — возвращает тот же Future."""
+    global _members_refresh
+    with _members_lock:
+        if _members_refresh is None or _members_refresh.done():
+            _members_refresh = Future()
+            threading.Thread(
+                target=_refresh_members, args=(_members_refresh, _members_gen, progress),
+                name="members-refresh", daemon=True,
+            ).start()
+        return _members_refresh
+
+def fetch_members_excluding_admins(
+    force: bool = False,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> List[Tuple[int, str]]:
+    """
+    Возвращает список [(uid, "Имя Фамилия"), ...] по реальным участникам сообщества,
+    исключая админов (managers + локальные ADMINS). Отвечает из кэша сразу;
+    force / устаревание только запускают фоновое обновление.
+    progress(загружено, всего) — если ждать всё же приходится (кэша ещё нет).
+    """
+    if not user_api:
+        # без user_token не можем выгрузить всех подписчиков
+        return []
+
+    with _members_lock:
+        cached, ts = _members_cache, _members_cache_ts
+        stale = _members_fresh_gen != _members_gen or (time.time() - ts) >= MEMBERS_CACHE_TTL
+
+    if not ts:
+        MEMBERS_CACHE_REQUESTS.inc("miss")
+        return refresh_members_async(progress).result()
+    MEMBERS_CACHE_REQUESTS.inc("stale" if stale else "hit")
+    if force or stale:
+        refresh_members_async()
+    return cached
+
+def _age_text(seconds: float) -> str:
+    seconds = max(0, int(seconds))
+    if seconds < 60:
+        return f"{seconds} сек"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    if seconds < 86400:
+        return f"{seconds // 3600} ч"
+    return f"{seconds // 86400} дн"
+
+def members_freshness_text() -> str:
+    """Строка для ответа админу: насколько свежий список участников."""
+    with _members_lock:
+        ts, refresh = _members_cache_ts, _members_refresh
+    if not user_api or not ts:
+        return ""
+    text = f"🕒 Список обновлён {_age_text(time.time() - ts)} назад"
+    if refresh is not None and not refresh.done():
+        text += ", обновляется в фоне"
+    return text + "."
+
+def with_freshness(text: str) -> str:
+    fresh = members_freshness_text()
+    return f"{text}\n\n{fresh}" if fresh else text
+
+def invalidate_members_cache():
+    global _members_gen
+    with _members_lock:
+        _members_gen += 1
 
 # ───────────── admin commands parsing ─────────────
-def _parse_setx_bulk(raw: str):
-    parts = raw.strip().split()
-    if len(parts) < 1 + 2 + 2:
-        return None, None, None, "Формат: /setx.. d1 t1 [d2 t2 ...] CAP LIMIT"
+def command_category(text: str, prefix: str) -> Tuple[Optional[Category], str, List[str]]:
+    """
+    "/setx pr ..." или слитно по-старому "/setxpr ..." -> (категория или None, её id, аргументы после id).
+    """
+    parts = text.split()
+    head = parts[0].lower()
+    if head == prefix:
+        cid, args = (parts[1].lower() if len(parts) > 1 else ""), parts[2:]
+    else:
+        cid, args = head[len(prefix):], parts[1:]
+    with state_lock:
+        return state.by_id(cid), cid, args
+
+def _parse_setx_bulk(args: List[str]):
+    if len(args) < 2 + 2:
+        return None, None, None, "Формат: /setx ID d1 t1 [d2 t2 ...] CAP LIMIT"
     try:
-        capacity = int(parts[-2])
-        limit = int(parts[-1])
+        capacity = int(args[-2])
+        limit = int(args[-1])
     except Exception:
         return None, None, None, "Последние два аргумента должны быть числами: CAP LIMIT"
-    mid = parts[1:-2]
+    mid = args[:-2]
     if len(mid) % 2 != 0:
         return None, None, None, "Пары дата/время должны идти строго парами."
     pairs = []
@@ -588,96 +2561,281 @@ def _parse_setx_bulk(raw: str):
             pairs.append(f"{d} {t}")
     if not pairs:
         return None, None, None, "Не удалось распознать пары."
-    if len(pairs) > 4:
-        pairs = pairs[:4]
+    if len(set(pairs)) != len(pairs):
+        return None, None, None, "Названия слотов повторяются."
+    if len(pairs) > MAX_SLOTS:
+        pairs = pairs[:MAX_SLOTS]
     return pairs, capacity, limit, None
 
-def _parse_setx_single(raw: str):
-    parts = raw.strip().split()
-    if len(parts) != 6:
-        return None, None, None, None, "Формат: /setx.. N d t CAP LIMIT"
+def _parse_setx_single(args: List[str]):
+    if len(args) != 5:
+        return None, None, None, None, "Формат: /setx ID N d t CAP LIMIT"
     try:
-        n = int(parts[1])
+        n = int(args[0])
     except Exception:
-        return None, None, None, None, "N должен быть числом 1..4."
-    if n < 1 or n > 4:
-        return None, None, None, None, "N должен быть от 1 до 4."
-    d = parts[2].strip()
-    t = parts[3].strip()
+        return None, None, None, None, f"N должен быть числом 1..{MAX_SLOTS}."
+    if n < 1 or n > MAX_SLOTS:
+        return None, None, None, None, f"N должен быть от 1 до {MAX_SLOTS}."
+    d = args[1].strip()
+    t = args[2].strip()
     if not d or not t:
         return None, None, None, None, "Дата/время не распознаны."
     try:
-        cap = int(parts[4])
-        lim = int(parts[5])
+        cap = int(args[3])
+        lim = int(args[4])
     except Exception:
         return None, None, None, None, "CAP и LIMIT должны быть числами."
     return n, f"{d} {t}", cap, lim, None
 
-def _ensure_4_slots(cat: str) -> List[dict]:
-    cfg = state["categories"][cat]
-    slots = cfg.get("slots", [])
-    key_to_slot = {s.get("key"): s for s in slots if isinstance(s, dict)}
-    fixed = []
-    for k in SLOT_KEYS:
-        s = key_to_slot.get(k) or {"key": k, "title": "", "users": []}
-        s.setdefault("users", [])
-        if not isinstance(s["users"], list):
-            s["users"] = []
-        fixed.append(s)
-    cfg["slots"] = fixed
-    return fixed
-
+@with_state_lock
 def apply_slots_bulk(cat: str, titles: List[str], capacity: int, limit: int):
-    cfg = state["categories"][cat]
-    fixed = _ensure_4_slots(cat)
-    for i in range(4):
-        fixed[i]["title"] = titles[i] if i < len(titles) else ""
-    cfg["capacity"] = capacity
-    cfg["limit_per_user"] = limit
-    save_state()
-
-def apply_slot_single(cat: str, n: int, title: str, capacity: int, limit: int):
-    cfg = state["categories"][cat]
-    fixed = _ensure_4_slots(cat)
-    fixed[n-1]["title"] = title
-    cfg["capacity"] = capacity
-    cfg["limit_per_user"] = limit
-    save_state()
+    cfg = state.categories[cat]
+    keys = cfg.keys_up_to(max(len(titles), len(cfg.slots)))
+    cfg.retitle({k: titles[i] if i < len(titles) else "" for i, k in enumerate(keys)})
+    cfg.capacity = capacity
+    cfg.limit_per_user = limit
+    invalidate_slots_keyboard(cat)
+    save_state({"op": "set_slots", "cat": cat, "titles": {s.key: s.title for s in cfg.slots},
+                "capacity": capacity, "limit": limit})
+
+@with_state_lock
+def apply_slot_single(cat: str, n: int, title: str, capacity: int, limit: int) -> Optional[str]:
+    """None — готово, иначе текст ошибки."""
+    cfg = state.categories[cat]
+    keys = cfg.keys_up_to(n)
+    other = cfg.by_title(title.strip())
+    if other is not None and other.key != keys[n-1]:
+        return f"Слот «{other.title}» уже есть (№{cfg.position(other.key) + 1})."
+    # слоты между последним и n-м (если N больше их числа) появятся пустыми
+    titles = {k: "" for k in keys[len(cfg.slots):n-1]}
+    titles[keys[n-1]] = title
+    cfg.retitle(titles)
+    cfg.capacity = capacity
+    cfg.limit_per_user = limit
+    invalidate_slots_keyboard(cat)
+    save_state({"op": "set_slots", "cat": cat, "titles": {k: cfg.slot(k).title for k in titles},
+                "capacity": capacity, "limit": limit})
+    return None
 
+@with_state_lock
 def clear_category(cat: str):
-    fixed = _ensure_4_slots(cat)
-    for s in fixed:
-        s["users"] = []
-    save_state()
+    for s in state.categories[cat].slots:
+        _slot_remove_at(cat, s, list(range(len(s.users))))
+    save_state({"op": "clear", "cat": cat})
 
+@with_state_lock
 def delete_slot_no_shift(cat: str, n: int):
-    fixed = _ensure_4_slots(cat)
-    fixed[n-1]["title"] = ""
-    fixed[n-1]["users"] = []
-    save_state()
+    cfg = state.categories[cat]
+    s = cfg.slots[n-1]
+    _slot_remove_at(cat, s, list(range(len(s.users))))
+    cfg.retitle({s.key: ""})
+    invalidate_slots_keyboard(cat)
+    save_state({"op": "clear", "cat": cat, "key": s.key},
+               {"op": "set_slots", "cat": cat, "titles": {s.key: ""}})
+
+@with_state_lock
+def add_category(cid: str, name: str) -> Category:
+    cfg = Category(cid, name)
+    state.add_category(cfg)
+    invalidate_keyboards()
+    save_state({"op": "add_category", "cat": name, "id": cid,
+                "capacity": cfg.capacity, "limit": cfg.limit_per_user})
+    return cfg
+
+@with_state_lock
+def drop_category(cat: str) -> int:
+    """Удалить категорию вместе с записями. Возвращает, сколько записей удалено."""
+    cfg = state.categories[cat]
+    removed = 0
+    for s in cfg.slots:
+        removed += len(s.users)
+        _slot_remove_at(cat, s, list(range(len(s.users))))
+        booking_index.occupancy.pop((cat, s.key), None)
+    booking_index.booked.pop(cat, None)
+    state.drop_category(cat)
+    invalidate_keyboards()
+    save_state({"op": "drop_category", "cat": cat})   # файл расписания удалит StateWriter
+    return removed
 
 # ───────────── admin edit helpers ─────────────
-def category_booked_set(cat: str) -> set:
-    booked = set()
-    for s in state["categories"][cat]["slots"]:
-        booked.update(s.get("users", []))
-    return booked
-
-def category_slots_info(cat: str) -> List[Tuple[str, int, int, int, dict]]:
-    """[(title, free, taken, cap, slot_dict)] for visible slots"""
-    cfg = state["categories"][cat]
-    cap = int(cfg.get("capacity", 13))
+@with_state_lock
+def booked_idents(cat: str) -> Set[Ident]:
+    """Кто записан в категорию: uid, а для старых записей без uid — имена."""
+    if sql_store is not None:
+        return {uid if uid > 0 else name for _key, uid, name in sql_store.category_roster(cat)}
+    return set(booking_index.booked.get(cat, {}))
+
+def _is_in(booked: Set[Ident], uid: int, name: str) -> bool:
+    return any(i in booked for i in _idents(uid, name))
+
+@with_state_lock
+def unbooked_report(members: List[Tuple[int, str]]) -> List[Tuple[str, List[str]]]:
+    """[(имя, [категории, куда не записан])] — только для тех, у кого что-то пропущено."""
+    booked = {cat: booked_idents(cat) for cat in state.categories}
+    out = []
+    for uid, name in members:
+        missing = [cat for cat, idents in booked.items() if not _is_in(idents, uid, name)]
+        if missing:
+            out.append((name, missing))
+    return out
+
+@render_cached
+@with_state_lock
+def category_slots_info(cat: str) -> List[Tuple[str, int, int, int, Slot]]:
+    """[(title, free, taken, cap, slot)] for visible slots"""
+    cfg = state.categories.get(cat)
+    if cfg is None:
+        return []
+    cap = cfg.capacity
     out = []
-    for s in cfg.get("slots", []):
-        title = (s.get("title") or "").strip()
-        if not title:
+    for s in cfg.slots:
+        if not s.title:
             continue
-        users = s.get("users", [])
-        taken = len(users)
+        taken = len(s.users)
         free = max(cap - taken, 0)
-        out.append((title, free, taken, cap, s))
+        out.append((s.title, free, taken, cap, s))
     return out
 
+# ───────────── приём записей на слоты ─────────────
+# В минуту публикации расписания на слот ломится вся группа. Попытки записи не решаются
+# каждая сама по себе: они встают в общую очередь в порядке прихода, а один поток-приёмщик
+# забирает всё накопившееся и решает по очереди — по счётчикам занятых мест и лимитам
+# (booking_index, в sqlite — сама база) за один захват state_lock. Принятые сохраняются
+# вместе: в snapshot/journal — один save_state() со всеми записями журнала, в sqlite — одна
+# транзакция на пачку. Пока пачка решается, новые попытки копятся: чем сильнее наплыв,
+# тем крупнее пачка, а одиночная попытка проходит сразу, без окна ожидания.
+# Ответ (записан / мест нет / ...) человек получает сразу после решения по его пачке.
+ADMISSION_MAX_BATCH = int(os.getenv("ADMISSION_MAX_BATCH", "256"))
+
+ADMISSION_BATCH = Histogram("admission_batch_size", "Попыток записи в одной пачке приёмщика",
+                            buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+ADMISSION_SECONDS = Histogram("admission_seconds", "От попытки записи до решения по ней")
+ADMISSION_RESULTS = Counter("admission_total", "Попытки записи на слот по исходу", ["result"])
+
+@with_state_lock
+def admit_batch(reqs: List[Tuple[str, str, str, int, str]]) -> List[str]:
+    """
+    Решения по пачке (cat, key, title, uid, fullname) в порядке прихода, каждая — с учётом
+    принятых перед ней. -> ["ok" | "already" | "limit" | "full" | "gone"] ("gone" — слот успели
+    удалить или переименовать, пока человек выбирал). Слот ищется заново по ключу и сверяется
+    по названию: state могли заменить целиком (сверка с Gist, перечитывание базы).
+    """
+    if sql_store is not None:
+        sync_from_store()
+        out = sql_store.book_many(reqs)
+        files = set()
+        for (cat, key, _title, uid, name), res in zip(reqs, out):
+            cfg = state.categories.get(cat)
+            slot = cfg.slot(key) if cfg is not None else None
+            if res == "ok" and slot is not None:
+                slot.add(uid, name)
+                booking_index.add(cat, key, uid if uid > 0 else name)
+                files.add(schedule_file(cat))
+        if files:
+            save_state(files=sorted(files))   # уже в базе
+        return out
+    out, records = [], []
+    for cat, key, title, uid, name in reqs:
+        cfg = state.categories.get(cat)
+        slot = cfg.slot(key) if cfg is not None else None
+        if slot is None or not slot.title or slot.title != title:
+            out.append("gone")
+        elif (cat, key) in booking_index.slots_for(uid, name):
+            out.append("already")
+        elif booking_index.count_in_category(cat, uid, name) >= cfg.limit_per_user:
+            out.append("limit")
+        elif booking_index.occupancy.get((cat, key), 0) >= cfg.capacity:
+            out.append("full")
+        else:
+            slot.add(uid, name)
+            booking_index.add(cat, key, uid if uid > 0 else name)
+            records.append({"op": "book", "cat": cat, "key": key, "uid": uid, "name": name})
+            out.append("ok")
+    if records:
+        save_state(*records)
+    return out
+
+class SlotAdmission:
+    """Очередь попыток записи (первым пришёл — первым решён) и поток, решающий их пачками."""
+
+    def __init__(self, max_batch: int):
+        self.max_batch = max(max_batch, 1)
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.max_seen = 0                           # самая крупная пачка
+        self._latency: deque = deque(maxlen=2000)   # от попытки до решения, сек
+
+    def submit(self, cat: str, slot: Slot, uid: int, fullname: str) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="admission", daemon=True)
+                self._thread.start()
+            # название — то, что человек выбрал сейчас: объект слота могут переименовать до решения
+            self._pending.append((cat, slot.key, slot.title, uid, fullname, time.perf_counter(), fut))
+            self._cond.notify()
+        return fut
+
+    def book(self, cat: str, slot: Slot, uid: int, fullname: str) -> str:
+        return self.submit(cat, slot, uid, fullname).result()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lat = sorted(self._latency)
+        pct = lambda p: lat[min(int(len(lat) * p), len(lat) - 1)] if lat else 0.0
+        return {
+            "requests": self.requests, "batches": self.batches, "max_batch": self.max_seen,
+            "latency_p50": pct(0.50), "latency_p95": pct(0.95), "latency_max": lat[-1] if lat else 0.0,
+        }
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch))]
+            try:
+                results = admit_batch([item[:5] for item in batch])
+            except Exception as e:
+                print(f"⚠️ Ошибка записи на слоты ({len(batch)} попыток): {e}")
+                for item in batch:
+                    item[6].set_exception(e)
+                continue
+            now = time.perf_counter()
+            ADMISSION_BATCH.observe(len(batch))
+            with self._stats_lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.max_seen = max(self.max_seen, len(batch))
+                self._latency.extend(now - item[5] for item in batch)
+            for item, res in zip(batch, results):
+                ADMISSION_SECONDS.observe(now - item[5])
+                ADMISSION_RESULTS.inc(res)
+                item[6].set_result(res)
+
+admission = SlotAdmission(ADMISSION_MAX_BATCH)
+
+def try_book(cat: str, slot: Slot, uid: int, fullname: str) -> str:
+    """
+    Записать на слот через общую очередь приёма; ждёт решения.
+    -> "ok" | "already" | "limit" | "full" | "gone"
+    """
+    return admission.book(cat, slot, uid, fullname)
+
+@with_state_lock
+def has_visible_slots(cat: str) -> bool:
+    cfg = state.categories.get(cat)
+    return cfg is not None and cfg.has_visible()
+
+@with_state_lock
+def find_slot_by_title(cat: str, title: str) -> Optional[Slot]:
+    cfg = state.categories.get(cat)
+    return cfg.by_title(title) if cfg is not None else None
+
 def start_admin_edit(user_id: int):
     admin_mode[user_id] = "edit"
     admin_edit[user_id] = {"step": "op"}
@@ -688,56 +2846,121 @@ def exit_admin_edit(user_id: int, to_panel: bool = True):
     admin_mode[user_id] = "panel" if to_panel else ""
     send_msg(user_id, "Ок.", kb=admin_keyboard() if to_panel else None)
 
-def _get_members_names_source() -> List[str]:
+ROSTER_PROGRESS_SEC = 3.0
+
+def _roster_progress(user_id: int) -> Callable[[int, int], None]:
+    """Для больших сообществ: раз в несколько секунд пишем админу, сколько уже загружено."""
+    last = [time.monotonic()]
+
+    def report(loaded: int, total: int):
+        now = time.monotonic()
+        if loaded < total and now - last[0] >= ROSTER_PROGRESS_SEC:
+            last[0] = now
+            send_msg(user_id, f"⏳ Загружаю участников: {loaded}/{total}…", kb=admin_keyboard())
+    return report
+
+def _get_members_source() -> List[Tuple[int, str]]:
     """
-    Источник "учеников" для списков.
+    Источник "учеников" для списков: [(uid, "Имя Фамилия")], по имени.
     1) Если есть USER_TOKEN -> реальные участники groups.getMembers
     2) Иначе -> fallback на known_users (кто писал боту). Без чисток.
     """
     if user_api:
         members = fetch_members_excluding_admins(force=False)
-        return sorted([name for (_uid, name) in members], key=lambda s: s.lower())
+        return sorted(members, key=lambda p: p[1].lower())
 
     # fallback (хуже, но хоть что-то)
-    ku = state.get("known_users", {}) or {}
-    names = []
-    for k, v in ku.items():
-        if not str(k).isdigit():
-            continue
-        uid = int(k)
-        if uid in ADMINS:
-            continue
-        if isinstance(v, dict):
-            nm = (v.get("name") or "").strip()
-        else:
-            nm = str(v).strip()
-        if nm:
-            names.append(nm)
-    return sorted(list(set(names)), key=lambda s: s.lower())
+    pairs = [(uid, nm.strip()) for uid, nm in _known_users_pairs() if uid not in ADMINS and nm.strip()]
+    return sorted(pairs, key=lambda p: p[1].lower())
+
+# ───────────── постраничные списки ─────────────
+# Длинный список считается один раз и хранится в сессии админа вместе с разбивкой
+# на страницы; «◀ Пред.» / «След. ▶» только перелистывают. Страница не длиннее
+# ADMIN_PAGE_SIZE строк и помещается в одно сообщение VK.
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+
+# user_id -> {"header": str, "lines": [...], "footer": str, "bounds": [(a, b)], "page": int}
+admin_pages: Dict[int, dict] = {}
+
+def page_bounds(lines: List[str], reserve: int = 0, per_line: int = 0) -> List[Tuple[int, int]]:
+    """
+    [(начало, конец)] страниц: не больше ADMIN_PAGE_SIZE строк и VK_MESSAGE_MAX - reserve символов.
+    per_line — сколько добавится к каждой строке при выводе (номер и т.п.).
+    """
+    budget = max(VK_MESSAGE_MAX - reserve, 200)
+    bounds: List[Tuple[int, int]] = []
+    start, length = 0, 0
+    for i, line in enumerate(lines):
+        size = len(line) + per_line + 1
+        if i > start and (i - start >= ADMIN_PAGE_SIZE or length + size > budget):
+            bounds.append((start, i))
+            start, length = i, 0
+        length += size
+    if start < len(lines) or not bounds:
+        bounds.append((start, len(lines)))
+    return bounds
+
+def turn_page(pages: dict, msg: str) -> bool:
+    page = pages.get("page", 0) + (1 if msg == BTN_NEXT else -1)
+    if not 0 <= page < len(pages.get("bounds") or []):
+        return False
+    pages["page"] = page
+    return True
+
+def _page_title(header: str, pages: dict) -> str:
+    total = len(pages["bounds"])
+    return f"{header}\nСтраница {pages['page'] + 1} из {total}" if total > 1 else header
+
+def _page_keyboard(pages: dict, edit: bool) -> str:
+    total = len(pages["bounds"])
+    if total <= 1:
+        return admin_edit_cat_keyboard() if edit else admin_keyboard()
+    return paged_keyboard(pages["page"] > 0, pages["page"] < total - 1, edit)
+
+def open_paged_report(user_id: int, header: str, lines: List[str], footer: str = ""):
+    """Отчёт для админа (Ученики / Незаписавшиеся): первая страница сразу, остальные — листанием."""
+    reserve = len(header) + len(footer) + 40
+    admin_pages[user_id] = {"header": header, "lines": lines, "footer": footer,
+                            "bounds": page_bounds(lines, reserve), "page": 0}
+    show_report_page(user_id)
+
+def show_report_page(user_id: int):
+    pages = admin_pages.get(user_id)
+    if not pages:
+        send_msg(user_id, "Список устарел, откройте его заново.", kb=admin_keyboard())
+        return
+    a, b = pages["bounds"][pages["page"]]
+    text = _page_title(pages["header"], pages) + "\n" + "\n".join(pages["lines"][a:b])
+    if pages["footer"]:
+        text += "\n\n" + pages["footer"]
+    send_msg(user_id, text, kb=_page_keyboard(pages, edit=False))
 
 def show_students_list_for_edit(user_id: int):
     st = admin_edit.get(user_id) or {}
     op = st.get("op")
     cat = st.get("cat")
-    if op not in {"add", "del"} or cat not in CATEGORIES:
+    if op not in {"add", "del"} or cat not in state.categories:
         send_msg(user_id, "Ошибка состояния редактирования. Нажмите «Редактировать» заново.", kb=admin_keyboard())
         admin_edit.pop(user_id, None)
         admin_mode[user_id] = "panel"
         return
 
-    names = _get_members_names_source()
-    booked = category_booked_set(cat)
+    members = _get_members_source()
+    booked = booked_idents(cat)
 
     if op == "add":
-        students = [n for n in names if n not in booked]
+        students = [p for p in members if not _is_in(booked, *p)]
         header = f"➕ Записать в «{cat}»\nВыберите ученика номером (пишете цифру):"
     else:
-        students = [n for n in names if n in booked]
+        students = [p for p in members if _is_in(booked, *p)]
         header = f"🗑 Удалить из «{cat}»\nВыберите ученика номером (пишете цифру):"
 
-    students = sorted(students, key=lambda s: s.lower())
     st["students"] = students
     st["step"] = "pick_student"
+    st["header"] = header
+    # номера на каждой странице — с 1, см. student_on_page()
+    st["bounds"] = page_bounds([n for _uid, n in students], reserve=len(header) + 200, per_line=6)
+    st["page"] = 0
     admin_edit[user_id] = st
 
     if not students:
@@ -745,16 +2968,28 @@ def show_students_list_for_edit(user_id: int):
         exit_admin_edit(user_id, to_panel=True)
         return
 
-    MAX_SHOW = 60
-    shown = students[:MAX_SHOW]
-    body = "\n".join(f"{i+1}. {n}" for i, n in enumerate(shown))
-    tail = ""
-    if len(students) > MAX_SHOW:
-        tail = f"\n\n…и ещё {len(students)-MAX_SHOW} (слишком много). Выберите номер из первых {MAX_SHOW}."
+    show_students_page(user_id)
+
+def show_students_page(user_id: int):
+    st = admin_edit.get(user_id) or {}
+    a, b = st["bounds"][st["page"]]
+    body = "\n".join(f"{i}. {n}" for i, (_uid, n) in enumerate(st["students"][a:b], start=1))
+    send_msg(
+        user_id,
+        with_freshness(f"{_page_title(st['header'], st)}\n\n{body}\n\nОтмена — кнопка «Отмена» или «Назад»."),
+        kb=_page_keyboard(st, edit=True),
+    )
+
+def student_on_page(st: dict, number: int) -> Optional[Tuple[int, str]]:
+    """Номер с текущей страницы -> (uid, имя) из полного списка."""
+    a, b = st["bounds"][st["page"]]
+    idx = a + number - 1
+    if number < 1 or idx >= b:
+        return None
+    return st["students"][idx]
 
-    send_msg(user_id, f"{header}\n\n{body}{tail}\n\nОтмена — кнопка «Отмена» или «Назад».", kb=admin_edit_cat_keyboard())
 
-def show_slots_for_admin_add(user_id: int, cat: str, student_name: str):
+def show_slots_for_admin_add(user_id: int, cat: str, student: Tuple[int, str]):
     info = category_slots_info(cat)
     if not info:
         send_msg(user_id, f"В «{cat}» нет настроенных слотов. Сначала настройте /setx..", kb=admin_keyboard())
@@ -763,7 +2998,7 @@ def show_slots_for_admin_add(user_id: int, cat: str, student_name: str):
 
     st = admin_edit.get(user_id) or {}
     st["step"] = "pick_slot"
-    st["student"] = student_name
+    st["student"] = student
     admin_edit[user_id] = st
 
     lines = []
@@ -771,429 +3006,1601 @@ def show_slots_for_admin_add(user_id: int, cat: str, student_name: str):
         lines.append(f"{i}. {t} | занято: {taken}/{cap} | свободно: {free}")
     send_msg(
         user_id,
-        f"Выберите слот номером для «{student_name}» (пишете цифру):\n\n" + "\n".join(lines),
+        f"Выберите слот номером для «{student[1]}» (пишете цифру):\n\n" + "\n".join(lines),
         kb=admin_edit_cat_keyboard()
     )
 
-# ───────────── проверка токена сообщества ─────────────
-try:
-    gi = session_api.groups.getById(group_id=GROUP_ID)
-    print("OK: доступ к группе есть:", gi[0]["name"])
-except ApiError as e:
-    print("Проблема с доступом к группе:", e)
+# ───────────── маршрутизация сообщений ─────────────
+# Вместо длинной цепочки if обработчики регистрируются по точному тексту (кнопки,
+# слова меню — по тексту в нижнем регистре), по префиксу /команды, по номеру (выбор
+# цифрой) и по состоянию диалога. Префикс /команды совпадает, только если за ним конец,
+# пробел или id категории (слитно, по-старому: "/delpr 1") — "/delivery" не уйдёт в "/del".
+# Поиск по тексту — словарь; если на один текст
+# несколько обработчиков, их различает условие when, проверяются в порядке регистрации.
+# Порядок: номер → точный текст → /команда → состояние → «Не понял команду».
+# Каждый вызов меряется (bot_handler_seconds) и учитывается в ошибках под именем обработчика.
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках сообщений", ["handler"])
+
+class Msg:
+    """Входящее сообщение и то, что про отправителя нужно всем обработчикам."""
+    __slots__ = ("user_id", "text", "low", "fullname", "is_admin")
+
+    def __init__(self, user_id: int, raw: str, fullname: str):
+        self.user_id = user_id
+        self.text = raw.strip()
+        self.low = self.text.lower()
+        self.fullname = fullname
+        self.is_admin = user_id in ADMINS
+
+Handler = Callable[[Msg], None]
+Guard = Optional[Callable[[Msg], bool]]
+
+class Router:
+    def __init__(self):
+        self._exact: Dict[str, List[Tuple[Handler, Guard]]] = {}
+        self._commands: List[Tuple[str, Handler, Guard]] = []
+        self._digits: List[Tuple[Handler, Guard]] = []
+        self._states: List[Tuple[Handler, Guard]] = []
+        self._default: Optional[Handler] = None
+
+    def text(self, *texts: str, when: Guard = None):
+        def deco(fn: Handler) -> Handler:
+            for t in texts:
+                self._exact.setdefault(t, []).append((fn, when))
+            return fn
+        return deco
+
+    def command(self, *prefixes: str, when: Guard = None):
+        def deco(fn: Handler) -> Handler:
+            self._commands.extend((p, fn, when) for p in prefixes)
+            return fn
+        return deco
+
+    def digits(self, when: Guard = None):
+        def deco(fn: Handler) -> Handler:
+            self._digits.append((fn, when))
+            return fn
+        return deco
+
+    def state(self, when: Guard):
+        def deco(fn: Handler) -> Handler:
+            self._states.append((fn, when))
+            return fn
+        return deco
+
+    def default(self, fn: Handler) -> Handler:
+        self._default = fn
+        return fn
+
+    def handles_text(self, text: str) -> bool:
+        """Занят ли текст кнопкой/командой с точным совпадением."""
+        return text in self._exact or text.lower() in self._exact
+
+    @staticmethod
+    def _command_matches(low: str, prefix: str) -> bool:
+        if not low.startswith(prefix):
+            return False
+        head = low.split(maxsplit=1)[0]
+        if head == prefix:
+            return True
+        with state_lock:
+            return state.by_id(head[len(prefix):]) is not None
+
+    def resolve(self, m: Msg) -> Handler:
+        candidates: List[Tuple[Handler, Guard]] = []
+        if m.text.isdigit():
+            candidates += self._digits
+        candidates += self._exact.get(m.text, ())
+        if m.low != m.text:
+            candidates += self._exact.get(m.low, ())
+        if m.text.startswith("/"):
+            candidates += [(fn, when) for p, fn, when in self._commands if self._command_matches(m.low, p)]
+        candidates += self._states
+        for fn, when in candidates:
+            if when is None or when(m):
+                return fn
+        return self._default
+
+    def dispatch(self, m: Msg):
+        fn = self.resolve(m)
+        name = fn.__name__
+        try:
+            with HANDLER_SECONDS.time(name):
+                fn(m)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
 
-print("Бот запущен. Нажми Ctrl+C для остановки.")
+router = Router()
+
+def _is_admin(m: Msg) -> bool:
+    return m.is_admin
+
+def _edit_step(step: str) -> Guard:
+    return lambda m: m.is_admin and (admin_edit.get(m.user_id) or {}).get("step") == step
+
+def _in_edit_mode(m: Msg) -> bool:
+    return m.is_admin and admin_mode.get(m.user_id) == "edit"
+
+@with_state_lock
+def _is_category(name: str) -> bool:
+    return name in state.categories
+
+def admin_only(fn: Handler) -> Handler:
+    """Кнопка админки от обычного пользователя — отказ, а не «Не понял команду»."""
+    @functools.wraps(fn)
+    def wrapper(m: Msg):
+        if not m.is_admin:
+            send_msg(m.user_id, "🚫 Вы не администратор.")
+            return
+        fn(m)
+    return wrapper
+
+# ───────────── обработка сообщения ─────────────
+def handle_message(user_id: int, raw: str):
+    fullname = name_cache.resolve_one(user_id)
+
+    touch_known_user(user_id, fullname)
+
+    sync_from_store()
+    router.dispatch(Msg(user_id, raw, fullname))
+    if app is not None:
+        app.mark("first_event")
+
+# ───────────── выбор цифрой в админ-редактировании ─────────────
+@router.digits(when=_edit_step("pick_student"))
+def admin_pick_student(m: Msg):
+    user_id = m.user_id
+    st = admin_edit[user_id]
+    picked = student_on_page(st, int(m.text))
+    if picked is None:
+        send_msg(user_id, "Неверный номер. Попробуйте ещё раз.", kb=_page_keyboard(st, edit=True))
+        return
 
-# ───────────── основной цикл ─────────────
-try:
-    while True:
-        try:
-            for event in longpoll.listen():
-                if event.type != VkEventType.MESSAGE_NEW or not event.to_me:
-                    continue
+    chosen_uid, chosen = picked
+    op = st.get("op")
+    cat = st.get("cat")
 
-                raw = (event.text or "").strip()
-                msg = raw
-                mlow = raw.lower()
-                user_id = event.user_id
-
-                u = session_api.users.get(user_ids=user_id, fields="first_name,last_name")[0]
-                fullname = f"{u.get('first_name', '')} {u.get('last_name','')}".strip()
-
-                touch_known_user(user_id, fullname)
-
-                # ───────────── обработка выбора цифрой в админ-редактировании ─────────────
-                if user_id in ADMINS and user_id in admin_edit and msg.isdigit():
-                    st = admin_edit[user_id]
-                    step = st.get("step")
-
-                    # выбор ученика
-                    if step == "pick_student":
-                        students = st.get("students") or []
-                        idx = int(msg) - 1
-                        if idx < 0 or idx >= len(students):
-                            send_msg(user_id, "Неверный номер. Попробуйте ещё раз.", kb=admin_edit_cat_keyboard())
-                            continue
-
-                        chosen = students[idx]
-                        op = st.get("op")
-                        cat = st.get("cat")
-
-                        if op == "del":
-                            removed = remove_user_from_category(chosen, cat)
-                            if removed:
-                                save_state()
-                                send_msg(user_id, f"🗑 Удалено записей: {removed}\n{chosen} — удалён из «{cat}».", kb=admin_keyboard())
-                            else:
-                                send_msg(user_id, f"У {chosen} нет записей в «{cat}».", kb=admin_keyboard())
-                            exit_admin_edit(user_id, to_panel=True)
-                            continue
-
-                        # op == add
-                        show_slots_for_admin_add(user_id, cat, chosen)
-                        continue
-
-                    # выбор слота
-                    if step == "pick_slot":
-                        cat = st.get("cat")
-                        student_name = st.get("student")
-                        if not cat or not student_name:
-                            send_msg(user_id, "Ошибка состояния. Начните заново.", kb=admin_keyboard())
-                            exit_admin_edit(user_id, to_panel=True)
-                            continue
-
-                        info = category_slots_info(cat)
-                        idx = int(msg) - 1
-                        if idx < 0 or idx >= len(info):
-                            send_msg(user_id, "Неверный номер слота. Попробуйте ещё раз.", kb=admin_edit_cat_keyboard())
-                            continue
-
-                        title, free, taken, cap, slot = info[idx]
-                        cfg = state["categories"][cat]
-                        lim = int(cfg.get("limit_per_user", 1))
-
-                        if count_user_bookings_in_category(student_name, cat) >= lim:
-                            send_msg(user_id, f"У {student_name} уже есть запись в «{cat}». Сначала удалите.", kb=admin_keyboard())
-                            exit_admin_edit(user_id, to_panel=True)
-                            continue
-
-                        if len(slot.get("users", [])) >= cap:
-                            send_msg(user_id, f"Слот переполнен ({cap}). Выберите другой слот.", kb=admin_edit_cat_keyboard())
-                            continue
-
-                        slot["users"].append(student_name)
-                        save_state()
-                        send_msg(user_id, f"✅ Записан: {student_name}\n{cat} → {title}", kb=admin_keyboard())
-                        exit_admin_edit(user_id, to_panel=True)
-                        continue
-
-                # ───────────── ГЛОБАЛЬНО: "Назад" / "Отмена" ─────────────
-                if msg == "Отмена":
-                    pending_cat.pop(user_id, None)
-                    pending_rewrite.pop(user_id, None)
-                    if user_id in admin_edit:
-                        exit_admin_edit(user_id, to_panel=True)
-                        continue
-                    send_msg(user_id, "Ок, отменено.")
-                    continue
+    if op == "del":
+        removed = remove_user_from_category(chosen_uid, chosen, cat)
+        if removed:
+            send_msg(user_id, f"🗑 Удалено записей: {removed}\n{chosen} — удалён из «{cat}».", kb=admin_keyboard())
+        else:
+            send_msg(user_id, f"У {chosen} нет записей в «{cat}».", kb=admin_keyboard())
+        exit_admin_edit(user_id, to_panel=True)
+        return
 
-                if msg == "Назад":
-                    if admin_mode.get(user_id) == "edit":
-                        admin_edit.pop(user_id, None)
-                        admin_mode[user_id] = "panel"
-                        send_msg(user_id, "Панель администратора:", kb=admin_keyboard())
-                        continue
-                    if admin_mode.get(user_id) == "panel":
-                        admin_mode[user_id] = ""
-                        send_msg(user_id, "Ок.")
-                        continue
-                    if pending_rewrite.get(user_id) == "menu":
-                        pending_rewrite.pop(user_id, None)
-                        send_msg(user_id, "Ок.")
-                        continue
-                    send_msg(user_id, "Ок.")
-                    continue
+    # op == add
+    show_slots_for_admin_add(user_id, cat, (chosen_uid, chosen))
 
-                # ───────────── админ-команды текстом ─────────────
-                if user_id in ADMINS:
-                    if mlow == CMD_CLEAR_PR:
-                        clear_category(CAT_PR)
-                        send_msg(user_id, "✅ Очищено: Программирование (все записи удалены).")
-                        continue
-                    if mlow == CMD_CLEAR_BH:
-                        clear_category(CAT_BH)
-                        send_msg(user_id, "✅ Очищено: Бухгалтерия (все записи удалены).")
-                        continue
-
-                    if mlow.startswith(CMD_DEL_PR) or mlow.startswith(CMD_DEL_BH):
-                        parts = raw.strip().split()
-                        if len(parts) != 2 or not parts[1].isdigit():
-                            send_msg(user_id, "Формат: /delpr N  или  /delbh N (N=1..4)")
-                            continue
-                        n = int(parts[1])
-                        if n < 1 or n > 4:
-                            send_msg(user_id, "N должен быть от 1 до 4.")
-                            continue
-                        cat = CAT_PR if mlow.startswith(CMD_DEL_PR) else CAT_BH
-                        delete_slot_no_shift(cat, n)
-                        send_msg(user_id, f"✅ Удалён слот {n} в «{cat}» (без сдвига).")
-                        continue
-
-                    if mlow.startswith(CMD_SET_PR) or mlow.startswith(CMD_SET_BH):
-                        cat = CAT_PR if mlow.startswith(CMD_SET_PR) else CAT_BH
-
-                        n, title, cap, lim, err_single = _parse_setx_single(raw)
-                        if err_single is None:
-                            apply_slot_single(cat, n, title, cap, lim)
-                            send_msg(user_id, f"✅ Обновлён слот {n} в «{cat}»: {title}\nCAP={cap}, LIMIT={lim}")
-                            continue
-
-                        titles, cap2, lim2, err_bulk = _parse_setx_bulk(raw)
-                        if err_bulk:
-                            send_msg(
-                                user_id,
-                                "⚠️ " + err_bulk + "\n\nПримеры:\n"
-                                "/setxpr 1 19.01 18:00-20:00 12 1\n"
-                                "/setxbh 4 22.01 18:00-20:00 12 1\n"
-                                "/setxpr 19.01 18:00-20:00 20.01 18:00-20:00 12 1"
-                            )
-                            continue
-                        apply_slots_bulk(cat, titles or [], cap2 or 13, lim2 or 1)
-                        send_msg(user_id, f"✅ Обновлено расписание «{cat}» (без сброса записей).")
-                        continue
-
-                # ───────────── меню ─────────────
-                if mlow in {"старт", "start", "привет", "меню"}:
-                    pending_rewrite.pop(user_id, None)
-                    pending_cat.pop(user_id, None)
-                    admin_edit.pop(user_id, None)
-                    admin_mode[user_id] = ""
-                    send_msg(user_id, "Выберите действие:")
-                    continue
+@router.digits(when=_edit_step("pick_slot"))
+def admin_pick_slot(m: Msg):
+    user_id = m.user_id
+    st = admin_edit[user_id]
+    cat = st.get("cat")
+    student_uid, student_name = st.get("student") or (0, "")
+    if not cat or not student_name:
+        send_msg(user_id, "Ошибка состояния. Начните заново.", kb=admin_keyboard())
+        exit_admin_edit(user_id, to_panel=True)
+        return
 
-                if msg == "Инструкция":
-                    send_msg(
-                        user_id,
-                        "🧾 Инструкция\n\n"
-                        "• «Выбрать» → выберите направление, затем слот.\n"
-                        "• «Перезапись» → сбросить одну категорию или всё.\n"
-                        "• «Расписание» → кратко, затем «Подробно».\n"
-                        "• «Мои записи» → ваши записи.\n"
-                    )
-                    continue
+    info = category_slots_info(cat)
+    idx = int(m.text) - 1
+    if idx < 0 or idx >= len(info):
+        send_msg(user_id, "Неверный номер слота. Попробуйте ещё раз.", kb=admin_edit_cat_keyboard())
+        return
 
-                if msg == "Расписание":
-                    send_msg(user_id, schedule_summary_text(), kb=schedule_keyboard())
-                    continue
+    title, free, taken, cap, slot = info[idx]
+    res = try_book(cat, slot, student_uid, student_name)
 
-                if msg == "Подробно":
-                    send_msg(user_id, schedule_detailed_text(), kb=schedule_keyboard())
-                    continue
+    if res == "gone":
+        send_msg(user_id, "Слот изменился, пока вы выбирали. Выберите слот заново.", kb=admin_edit_cat_keyboard())
+        return
 
-                if msg == "Мои записи":
-                    send_msg(user_id, my_bookings_text(fullname))
-                    continue
+    if res in {"already", "limit"}:
+        send_msg(user_id, f"У {student_name} уже есть запись в «{cat}». Сначала удалите.", kb=admin_keyboard())
+        exit_admin_edit(user_id, to_panel=True)
+        return
 
-                # Перезапись
-                if msg == "Перезапись":
-                    pending_rewrite[user_id] = "menu"
-                    send_msg(user_id, "Что сбросить?", kb=rewrite_keyboard())
-                    continue
+    if res == "full":
+        send_msg(user_id, f"Слот переполнен ({cap}). Выберите другой слот.", kb=admin_edit_cat_keyboard())
+        return
 
-                if pending_rewrite.get(user_id) == "menu":
-                    if msg == "Перезапись: Программирование":
-                        removed = remove_user_from_category(fullname, CAT_PR)
-                        if removed:
-                            save_state()
-                            send_msg(user_id, "✅ Сброшено: Программирование. Теперь выберите слот заново.")
-                        else:
-                            send_msg(user_id, "У вас нет записей в Программировании.")
-                        pending_rewrite.pop(user_id, None)
-                        continue
-
-                    if msg == "Перезапись: Бухгалтерия":
-                        removed = remove_user_from_category(fullname, CAT_BH)
-                        if removed:
-                            save_state()
-                            send_msg(user_id, "✅ Сброшено: Бухгалтерия. Теперь выберите слот заново.")
-                        else:
-                            send_msg(user_id, "У вас нет записей в Бухгалтерии.")
-                        pending_rewrite.pop(user_id, None)
-                        continue
-
-                    if msg == "Перезапись: Всё":
-                        removed = remove_user_from_all_categories(fullname)
-                        if removed:
-                            save_state()
-                            send_msg(user_id, "✅ Ваши записи очищены. Теперь выберите слоты заново.")
-                        else:
-                            send_msg(user_id, "У вас нет активных записей.")
-                        pending_rewrite.pop(user_id, None)
-                        continue
-
-                # ───────────── админ-панель ─────────────
-                if msg == "Админам":
-                    if user_id not in ADMINS:
-                        send_msg(user_id, "🚫 Вы не администратор.")
-                        continue
-                    admin_mode[user_id] = "panel"
-                    admin_edit.pop(user_id, None)
-                    send_msg(user_id, "Панель администратора:", kb=admin_keyboard())
-                    continue
+    send_msg(user_id, f"✅ Записан: {student_name}\n{cat} → {title}", kb=admin_keyboard())
+    exit_admin_edit(user_id, to_panel=True)
+
+# ───────────── листание длинных списков ─────────────
+@router.text(BTN_PREV, BTN_NEXT, when=_is_admin)
+def admin_turn_page(m: Msg):
+    user_id, msg = m.user_id, m.text
+    st = admin_edit.get(user_id)
+    if st and st.get("step") == "pick_student":
+        if turn_page(st, msg):
+            show_students_page(user_id)
+        else:
+            send_msg(user_id, "Дальше страниц нет.", kb=_page_keyboard(st, edit=True))
+        return
+    pages = admin_pages.get(user_id)
+    if pages and turn_page(pages, msg):
+        show_report_page(user_id)
+    else:
+        send_msg(user_id, "Дальше страниц нет.", kb=_page_keyboard(pages, edit=False) if pages else admin_keyboard())
+
+# ───────────── ГЛОБАЛЬНО: "Назад" / "Отмена" ─────────────
+@router.text("Отмена")
+def cancel(m: Msg):
+    user_id = m.user_id
+    pending_cat.pop(user_id, None)
+    pending_rewrite.pop(user_id, None)
+    if user_id in admin_edit:
+        exit_admin_edit(user_id, to_panel=True)
+        return
+    send_msg(user_id, "Ок, отменено.")
 
-                if msg == "Редактировать":
-                    if user_id not in ADMINS:
-                        send_msg(user_id, "🚫 Вы не администратор.")
-                        continue
-                    start_admin_edit(user_id)
-                    continue
+@router.text("Назад")
+def back(m: Msg):
+    user_id = m.user_id
+    if admin_mode.get(user_id) == "edit":
+        admin_edit.pop(user_id, None)
+        admin_mode[user_id] = "panel"
+        send_msg(user_id, "Панель администратора:", kb=admin_keyboard())
+        return
+    if admin_mode.get(user_id) == "panel":
+        admin_mode[user_id] = ""
+        send_msg(user_id, "Ок.")
+        return
+    if pending_rewrite.get(user_id) == "menu":
+        pending_rewrite.pop(user_id, None)
+        send_msg(user_id, "Ок.")
+        return
+    send_msg(user_id, "Ок.")
+
+# ───────────── админ-команды текстом ─────────────
+# Команды категории: "/setx pr ..." или слитно "/setxpr ..." (см. command_category)
+CATEGORY_NAME_MAX = 40 - len(BTN_REWRITE)   # VK: не больше 40 символов на кнопке
+
+def _unknown_category(user_id: int, cid: str):
+    with state_lock:
+        known = ", ".join(f"{cfg.id} — {cfg.name}" for cfg in state.categories.values()) or "—"
+    send_msg(user_id, f"Нет категории с id «{cid}». Есть: {known}")
+
+@router.command(CMD_CLEAR, when=_is_admin)
+def admin_clear_category(m: Msg):
+    cfg, cid, _args = command_category(m.text, CMD_CLEAR)
+    if cfg is None:
+        _unknown_category(m.user_id, cid)
+        return
+    clear_category(cfg.name)
+    send_msg(m.user_id, f"✅ Очищено: {cfg.name} (все записи удалены).")
+
+@router.command(CMD_DEL, when=_is_admin)
+def admin_delete_slot(m: Msg):
+    user_id = m.user_id
+    cfg, cid, args = command_category(m.text, CMD_DEL)
+    if len(args) != 1 or not args[0].isdigit():
+        send_msg(user_id, "Формат: /del ID N  (или слитно: /delpr N)")
+        return
+    if cfg is None:
+        _unknown_category(user_id, cid)
+        return
+    n = int(args[0])
+    if n < 1 or n > len(cfg.slots):
+        send_msg(user_id, f"N должен быть от 1 до {len(cfg.slots)}." if cfg.slots else f"В «{cfg.name}» нет слотов.")
+        return
+    delete_slot_no_shift(cfg.name, n)
+    send_msg(user_id, f"✅ Удалён слот {n} в «{cfg.name}» (без сдвига).")
+
+@router.command(CMD_SET, when=_is_admin)
+def admin_set_slots(m: Msg):
+    user_id = m.user_id
+    cfg, cid, args = command_category(m.text, CMD_SET)
+    if cfg is None:
+        _unknown_category(user_id, cid)
+        return
+    cat = cfg.name
+
+    n, title, cap, lim, err_single = _parse_setx_single(args)
+    if err_single is None:
+        err = apply_slot_single(cat, n, title, cap, lim)
+        if err:
+            send_msg(user_id, "⚠️ " + err)
+            return
+        send_msg(user_id, f"✅ Обновлён слот {n} в «{cat}»: {title}\nCAP={cap}, LIMIT={lim}")
+        return
 
-                if user_id in ADMINS and admin_mode.get(user_id) == "edit":
-                    if msg == "Записать":
-                        admin_edit[user_id] = {"step": "cat", "op": "add"}
-                        send_msg(user_id, "Куда записать? Выберите предмет:", kb=admin_edit_cat_keyboard())
-                        continue
-                    if msg == "Удалить":
-                        admin_edit[user_id] = {"step": "cat", "op": "del"}
-                        send_msg(user_id, "Откуда удалить? Выберите предмет:", kb=admin_edit_cat_keyboard())
-                        continue
-
-                    st = admin_edit.get(user_id) or {}
-                    if st.get("step") == "cat" and msg in {CAT_PR, CAT_BH}:
-                        st["cat"] = msg
-                        admin_edit[user_id] = st
-                        show_students_list_for_edit(user_id)
-                        continue
-
-                if msg == "Инструкция (админ)":
-                    if user_id not in ADMINS:
-                        send_msg(user_id, "🚫 Вы не администратор.")
-                        continue
-                    text = (
-                        "🛠 Инструкция для админа\n\n"
-                        "Точечная настройка слота:\n"
-                        "• /setxpr N ДАТА ВРЕМЯ CAP LIMIT\n"
-                        "  пример: /setxpr 1 19.01 18:00-20:00 12 1\n"
-                        "• /setxbh N ДАТА ВРЕМЯ CAP LIMIT\n"
-                        "  пример: /setxbh 4 22.01 18:00-20:00 12 1\n\n"
-                        "Массовая настройка (до 4 слотов):\n"
-                        "• /setxpr d1 t1 [d2 t2 ...] CAP LIMIT\n"
-                        "  пример: /setxpr 19.01 18:00-20:00 20.01 18:00-20:00 12 1\n"
-                        "• /setxbh d1 t1 [d2 t2 ...] CAP LIMIT\n\n"
-                        "Удаление слота БЕЗ сдвига:\n"
-                        "• /delpr N  — очистит только слот N в Программировании\n"
-                        "• /delbh N  — очистит только слот N в Бухгалтерии\n\n"
-                        "Полная очистка категории:\n"
-                        "• /clearpr\n"
-                        "• /clearbh\n\n"
-                        "Редактирование через кнопки:\n"
-                        "Админам → Редактировать → Записать/Удалить → Предмет → номер ученика → (для записи) номер слота"
-                    )
-                    send_msg(user_id, text, kb=admin_keyboard())
-                    continue
+    titles, cap2, lim2, err_bulk = _parse_setx_bulk(args)
+    if err_bulk:
+        send_msg(
+            user_id,
+            "⚠️ " + err_bulk + "\n\nПримеры:\n"
+            "/setx pr 1 19.01 18:00-20:00 12 1\n"
+            "/setxbh 4 22.01 18:00-20:00 12 1\n"
+            "/setx pr 19.01 18:00-20:00 20.01 18:00-20:00 12 1"
+        )
+        return
+    apply_slots_bulk(cat, titles or [], cap2 or 13, lim2 or 1)
+    send_msg(user_id, f"✅ Обновлено расписание «{cat}» (без сброса записей).")
+
+@router.command(CMD_NEW_CAT, when=_is_admin)
+def admin_new_category(m: Msg):
+    parts = m.text.split(maxsplit=2)
+    if len(parts) != 3:
+        send_msg(m.user_id, "Формат: /newcat ID Название\nпример: /newcat eng Английский язык")
+        return
+    cid, name = parts[1].lower(), " ".join(parts[2].split())
+    with state_lock:
+        if not CATEGORY_ID_RE.match(cid):
+            err = "ID — латинские буквы, цифры и _, не длиннее 16 символов."
+        elif state.by_id(cid) is not None:
+            err = f"id «{cid}» уже занят."
+        elif name in state.categories:
+            err = f"Категория «{name}» уже есть."
+        elif (len(name) > CATEGORY_NAME_MAX or name.startswith("/") or name.isdigit()
+              or BTN_REWRITE + name == BTN_REWRITE_ALL or router.handles_text(name)):
+            err = f"Название не подойдёт для кнопки (до {CATEGORY_NAME_MAX} символов, не совпадает с другими кнопками)."
+        else:
+            err = None
+            add_category(cid, name)
+    if err:
+        send_msg(m.user_id, "⚠️ " + err)
+        return
+    send_msg(m.user_id, f"✅ Добавлена категория «{name}» (id {cid}).\nСлоты: /setx {cid} d1 t1 [d2 t2 ...] CAP LIMIT")
 
-                if msg == "Админы":
-                    if user_id not in ADMINS:
-                        send_msg(user_id, "🚫 Вы не администратор.")
-                        continue
-                    ids_all = sorted(set([i for i in ADMINS if isinstance(i, int)]))
-                    names = users_get_names(ids_all)
-                    body = "\n".join(f"{i+1}. {n}" for i, n in enumerate(names)) or "—"
-                    send_msg(user_id, f"🛡 Администраторы ({len(ids_all)}):\n{body}", kb=admin_keyboard())
-                    continue
+@router.command(CMD_DROP_CAT, when=_is_admin)
+def admin_drop_category(m: Msg):
+    cfg, cid, _args = command_category(m.text, CMD_DROP_CAT)
+    if cfg is None:
+        _unknown_category(m.user_id, cid)
+        return
+    removed = drop_category(cfg.name)
+    send_msg(m.user_id, f"✅ Удалена категория «{cfg.name}» (записей удалено: {removed}).")
+
+# ───────────── меню ─────────────
+@router.text("старт", "start", "привет", "меню")
+def main_menu(m: Msg):
+    user_id = m.user_id
+    pending_rewrite.pop(user_id, None)
+    pending_cat.pop(user_id, None)
+    admin_edit.pop(user_id, None)
+    admin_mode[user_id] = ""
+    send_msg(user_id, "Выберите действие:")
 
-                if msg == "Ученики":
-                    if user_id not in ADMINS:
-                        send_msg(user_id, "🚫 Вы не администратор.")
-                        continue
-
-                    if not user_api:
-                        # fallback без user_token
-                        names = _get_members_names_source()
-                        if not names:
-                            send_msg(user_id, "👥 Ученики: — (нет USER_TOKEN и кэш пуст).", kb=admin_keyboard())
-                        else:
-                            body = "\n".join(f"{i+1}. {n}" for i, n in enumerate(names))
-                            send_msg(user_id, f"👥 Ученики ({len(names)}):\n{body}\n\n⚠️ Без USER_TOKEN список может быть неполным.", kb=admin_keyboard())
-                        continue
-
-                    try:
-                        members = fetch_members_excluding_admins(force=True)
-                        names = sorted([name for (_uid, name) in members], key=lambda s: s.lower())
-                        body = "\n".join(f"{i+1}. {n}" for i, n in enumerate(names)) or "—"
-                        send_msg(user_id, f"👥 Ученики ({len(names)}):\n{body}", kb=admin_keyboard())
-                    except Exception as e:
-                        send_msg(user_id, f"⚠️ Не удалось получить список учеников: {e}", kb=admin_keyboard())
-                    continue
+@router.text("Инструкция")
+def instructions(m: Msg):
+    send_msg(
+        m.user_id,
+        "🧾 Инструкция\n\n"
+        "• «Выбрать» → выберите направление, затем слот.\n"
+        "• «Перезапись» → сбросить одну категорию или всё.\n"
+        "• «Расписание» → кратко, затем «Подробно».\n"
+        "• «Мои записи» → ваши записи.\n"
+    )
 
-                if msg == "Незаписавшиеся ученики":
-                    if user_id not in ADMINS:
-                        send_msg(user_id, "🚫 Вы не администратор.")
-                        continue
-
-                    names = _get_members_names_source()
-                    if not names:
-                        send_msg(user_id, "📋 Незаписавшиеся: — (нет данных о подписчиках).", kb=admin_keyboard())
-                        continue
-
-                    booked_pr = category_booked_set(CAT_PR)
-                    booked_bh = category_booked_set(CAT_BH)
-
-                    lines = []
-                    for n in names:
-                        missing = []
-                        if n not in booked_pr:
-                            missing.append(CAT_PR)
-                        if n not in booked_bh:
-                            missing.append(CAT_BH)
-                        if missing:
-                            lines.append(f"• {n} — не записан(а): {', '.join(missing)}")
-
-                    if not lines:
-                        send_msg(user_id, "📋 Незаписавшиеся ученики: нет.", kb=admin_keyboard())
-                    else:
-                        send_msg(user_id, f"📋 Незаписавшиеся ученики ({len(lines)}):\n\n" + "\n".join(lines), kb=admin_keyboard())
-                    continue
+@router.text("Расписание")
+def schedule_summary(m: Msg):
+    send_msg(m.user_id, schedule_summary_text(), kb=schedule_keyboard())
+
+@router.text("Подробно")
+def schedule_detailed(m: Msg):
+    send_msg(m.user_id, schedule_detailed_text(), kb=schedule_keyboard())
+
+@router.text("Мои записи")
+def my_bookings(m: Msg):
+    send_msg(m.user_id, my_bookings_text(m.user_id, m.fullname))
+
+# Перезапись
+@router.text("Перезапись")
+def rewrite_menu(m: Msg):
+    pending_rewrite[m.user_id] = "menu"
+    send_msg(m.user_id, "Что сбросить?", kb=rewrite_keyboard())
+
+def _is_rewrite_choice(m: Msg) -> bool:
+    return (pending_rewrite.get(m.user_id) == "menu" and m.text.startswith(BTN_REWRITE)
+            and (m.text == BTN_REWRITE_ALL or _is_category(m.text[len(BTN_REWRITE):])))
+
+@router.state(when=_is_rewrite_choice)
+def rewrite_reset(m: Msg):
+    if m.text == BTN_REWRITE_ALL:
+        removed = remove_user_from_all_categories(m.user_id, m.fullname)
+        text = "✅ Ваши записи очищены. Теперь выберите слоты заново." if removed else "У вас нет активных записей."
+    else:
+        cat = m.text[len(BTN_REWRITE):]
+        removed = remove_user_from_category(m.user_id, m.fullname, cat)
+        text = f"✅ Сброшено: {cat}. Теперь выберите слот заново." if removed else f"У вас нет записей в «{cat}»."
+    send_msg(m.user_id, text)
+    pending_rewrite.pop(m.user_id, None)
+
+# ───────────── админ-панель ─────────────
+@router.text("Админам")
+@admin_only
+def admin_panel(m: Msg):
+    admin_mode[m.user_id] = "panel"
+    admin_edit.pop(m.user_id, None)
+    send_msg(m.user_id, "Панель администратора:", kb=admin_keyboard())
+
+@router.text("Редактировать")
+@admin_only
+def admin_edit_start(m: Msg):
+    start_admin_edit(m.user_id)
+
+@router.text("Записать", "Удалить", when=_in_edit_mode)
+def admin_edit_op(m: Msg):
+    if m.text == "Записать":
+        admin_edit[m.user_id] = {"step": "cat", "op": "add"}
+        send_msg(m.user_id, "Куда записать? Выберите предмет:", kb=admin_edit_cat_keyboard())
+    else:
+        admin_edit[m.user_id] = {"step": "cat", "op": "del"}
+        send_msg(m.user_id, "Откуда удалить? Выберите предмет:", kb=admin_edit_cat_keyboard())
+
+# раньше ученического выбора направления: в режиме редактирования предмет выбирает админ
+@router.state(when=lambda m: _in_edit_mode(m) and _edit_step("cat")(m) and _is_category(m.text))
+def admin_edit_pick_category(m: Msg):
+    st = admin_edit.get(m.user_id) or {}
+    st["cat"] = m.text
+    admin_edit[m.user_id] = st
+    show_students_list_for_edit(m.user_id)
+
+@router.text("Инструкция (админ)")
+@admin_only
+def admin_instructions(m: Msg):
+    with state_lock:
+        cats = "\n".join(f"• {cfg.id} — {cfg.name}" for cfg in state.categories.values()) or "• —"
+    text = (
+        "🛠 Инструкция для админа\n\n"
+        f"Категории (ID — название):\n{cats}\n"
+        "• /newcat ID Название — добавить категорию\n"
+        "  пример: /newcat eng Английский язык\n"
+        "• /dropcat ID — удалить категорию вместе с записями\n\n"
+        "Точечная настройка слота:\n"
+        "• /setx ID N ДАТА ВРЕМЯ CAP LIMIT\n"
+        "  пример: /setx pr 1 19.01 18:00-20:00 12 1\n"
+        "  (N больше числа слотов — слот добавится)\n\n"
+        f"Массовая настройка (до {MAX_SLOTS} слотов):\n"
+        "• /setx ID d1 t1 [d2 t2 ...] CAP LIMIT\n"
+        "  пример: /setx pr 19.01 18:00-20:00 20.01 18:00-20:00 12 1\n\n"
+        "Удаление слота БЕЗ сдвига:\n"
+        "• /del ID N  — очистит только слот N\n\n"
+        "Полная очистка категории:\n"
+        "• /clear ID\n\n"
+        "Слитная форма тоже работает: /setxpr, /delbh 2, /clearpr.\n\n"
+        "Редактирование через кнопки:\n"
+        "Админам → Редактировать → Записать/Удалить → Предмет → номер ученика → (для записи) номер слота"
+    )
+    send_msg(m.user_id, text, kb=admin_keyboard())
+
+@router.text("Админы")
+@admin_only
+def admin_list_admins(m: Msg):
+    ids_all = sorted(set([i for i in ADMINS if isinstance(i, int)]))
+    names = users_get_names(ids_all)
+    body = "\n".join(f"{i+1}. {n}" for i, n in enumerate(names)) or "—"
+    send_msg(m.user_id, f"🛡 Администраторы ({len(ids_all)}):\n{body}", kb=admin_keyboard())
+
+@router.text("Ученики")
+@admin_only
+def admin_list_students(m: Msg):
+    user_id = m.user_id
+    if not user_api:
+        # fallback без user_token
+        names = [n for (_uid, n) in _get_members_source()]
+        if not names:
+            send_msg(user_id, "👥 Ученики: — (нет USER_TOKEN и кэш пуст).", kb=admin_keyboard())
+        else:
+            lines = [f"{i+1}. {n}" for i, n in enumerate(names)]
+            open_paged_report(user_id, f"👥 Ученики ({len(names)}):", lines, "⚠️ Без USER_TOKEN список может быть неполным.")
+        return
 
-                # ───────────── выбор направления/слота для ученика ─────────────
-                if msg == "Выбрать":
-                    pending_cat.pop(user_id, None)
-                    send_msg(user_id, "Выберите направление:", kb=choose_category_keyboard())
-                    continue
+    try:
+        members = fetch_members_excluding_admins(force=True, progress=_roster_progress(user_id))
+        names = sorted([name for (_uid, name) in members], key=lambda s: s.lower())
+        lines = [f"{i+1}. {n}" for i, n in enumerate(names)] or ["—"]
+        open_paged_report(user_id, f"👥 Ученики ({len(names)}):", lines, members_freshness_text())
+    except Exception as e:
+        send_msg(user_id, f"⚠️ Не удалось получить список учеников: {e}", kb=admin_keyboard())
+
+@router.text("Незаписавшиеся ученики")
+@admin_only
+def admin_list_unbooked(m: Msg):
+    user_id = m.user_id
+    members = _get_members_source()
+    if not members:
+        send_msg(user_id, "📋 Незаписавшиеся: — (нет данных о подписчиках).", kb=admin_keyboard())
+        return
 
-                if msg in {CAT_PR, CAT_BH}:
-                    pending_cat[user_id] = msg
-                    visible_titles = [
-                        (s.get("title") or "").strip()
-                        for s in state["categories"][msg]["slots"]
-                        if (s.get("title") or "").strip()
-                    ]
-                    if not visible_titles:
-                        send_msg(user_id, "⚠️ Слоты пока не настроены администратором.")
-                        pending_cat.pop(user_id, None)
-                        continue
-                    send_msg(user_id, f"{msg}. Выберите слот:", kb=slots_keyboard(msg))
-                    continue
+    lines = [
+        f"• {n} — не записан(а): {', '.join(missing)}"
+        for n, missing in unbooked_report(members)
+    ]
+
+    if not lines:
+        send_msg(user_id, with_freshness("📋 Незаписавшиеся ученики: нет."), kb=admin_keyboard())
+    else:
+        open_paged_report(user_id, f"📋 Незаписавшиеся ученики ({len(lines)}):", lines, members_freshness_text())
+
+# ───────────── выбор направления/слота для ученика ─────────────
+@router.text("Выбрать")
+def choose(m: Msg):
+    pending_cat.pop(m.user_id, None)
+    send_msg(m.user_id, "Выберите направление:", kb=choose_category_keyboard())
+
+@router.state(when=lambda m: _is_category(m.text))
+def choose_category(m: Msg):
+    user_id, cat = m.user_id, m.text
+    pending_cat[user_id] = cat
+    if not has_visible_slots(cat):
+        send_msg(user_id, "⚠️ Слоты пока не настроены администратором.")
+        pending_cat.pop(user_id, None)
+        return
+    send_msg(user_id, f"{cat}. Выберите слот:", kb=slots_keyboard(cat))
+
+@router.state(when=lambda m: m.user_id in pending_cat and find_slot_by_title(pending_cat[m.user_id], m.text) is not None)
+def book_slot(m: Msg):
+    user_id = m.user_id
+    cat = pending_cat[user_id]
+    slot = find_slot_by_title(cat, m.text)
+    if slot is None:
+        send_msg(user_id, "Не удалось определить слот.")
+        return
 
-                if user_id in pending_cat:
-                    cat = pending_cat[user_id]
-                    slots_list = state["categories"][cat]["slots"]
-                    titles = [(s.get("title") or "").strip() for s in slots_list if (s.get("title") or "").strip()]
-                    if msg in titles:
-                        cfg = state["categories"][cat]
-                        cap = int(cfg.get("capacity", 13))
-                        lim = int(cfg.get("limit_per_user", 1))
+    res = try_book(cat, slot, user_id, m.fullname)
+    if res == "gone":
+        send_msg(user_id, "Не удалось определить слот.")
+        return
 
-                        slot = next((s for s in slots_list if (s.get("title") or "").strip() == msg), None)
-                        if slot is None:
-                            send_msg(user_id, "Не удалось определить слот.")
-                            continue
+    if res == "already":
+        send_msg(user_id, "Вы уже записаны на этот слот.")
+        return
 
-                        if fullname in slot["users"]:
-                            send_msg(user_id, "Вы уже записаны на этот слот.")
-                            continue
+    if res == "limit":
+        send_msg(user_id, f"У вас уже есть запись в категории «{cat}».")
+        return
 
-                        if count_user_bookings_in_category(fullname, cat) >= lim:
-                            send_msg(user_id, f"У вас уже есть запись в категории «{cat}».")
-                            continue
+    if res == "full":
+        cap = state.categories[cat].capacity
+        send_msg(user_id, f"Слот переполнен ({cap}).")
+        return
 
-                        if len(slot["users"]) >= cap:
-                            send_msg(user_id, f"Слот переполнен ({cap}).")
-                            continue
+    pending_cat.pop(user_id, None)
+    send_msg(user_id, f"✅ Записаны: {cat} → {slot.title}")
+
+@router.default
+def not_understood(m: Msg):
+    send_msg(m.user_id, "Не понял команду. Выберите действие:")
+
+# ───────────── диспетчер событий ─────────────
+# События разных пользователей обрабатываются параллельно (медленный запрос админа
+# не держит ответы ученикам), события одного user_id — строго по очереди.
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_MAX_PENDING = int(os.getenv("DISPATCH_MAX_PENDING", "1000"))
+
+class EventDispatcher:
+    def __init__(self, workers: int, max_pending: int):
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="handler")
+        self._lock = threading.Lock()
+        # user_id -> очередь ещё не выполненных событий; ключ есть, пока у пользователя что-то в работе
+        self._queues: Dict[int, deque] = {}
+        self._free = threading.BoundedSemaphore(max(max_pending, 1))
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def submit(self, key: int, fn, *args):
+        # backpressure: если очередь переполнена, чтение новых событий подождёт
+        self._free.acquire()
+        with self._lock:
+            q = self._queues.get(key)
+            if q is not None:
+                q.append((fn, args))
+                return
+            self._queues[key] = deque([(fn, args)])
+        self._pool.submit(self._drain, key)
+
+    def _drain(self, key: int):
+        while True:
+            with self._lock:
+                q = self._queues[key]
+                if not q:
+                    del self._queues[key]
+                    return
+                fn, args = q.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработки события от {key}: {e}")
+            finally:
+                self._free.release()
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+dispatcher = EventDispatcher(DISPATCH_WORKERS, DISPATCH_MAX_PENDING)
+
+GaugeFunc("dispatch_pending", "События, ждущие обработки", lambda: dispatcher.pending())
+GaugeFunc("bot_runtime_entries", "Размер словарей состояния диалогов", lambda: {
+    "pending_cat": len(pending_cat), "pending_rewrite": len(pending_rewrite),
+    "admin_mode": len(admin_mode), "admin_edit": len(admin_edit), "admin_pages": len(admin_pages),
+}, labels=["dict"])
+GaugeFunc("bot_cache_entries", "Размер кэшей", lambda: {
+    "names": len(name_cache), "members": len(_members_cache),
+    "keyboards": len(_kb_cache), "render": len(_render_cache),
+}, labels=["cache"])
+GaugeFunc("bot_state_bookings", "Записей на слоты", lambda: sum(booking_index.occupancy.values()))
+GaugeFunc("bot_state_known_users", "Пользователей в known_users", lambda: len(state.known_users))
+GaugeFunc("bot_state_version", "Номер версии состояния", lambda: state_version, kind="counter")
+GaugeFunc("bot_state_file_bytes", "Размер файлов состояния на диске", lambda: {
+    path: os.path.getsize(path)
+    for path in state_files(state) + [STATE_FILE, JOURNAL_FILE, SQLITE_FILE, MEMBERS_CACHE_FILE]
+    if os.path.exists(path)
+}, labels=["file"])
+GaugeFunc("state_unsaved_versions", "Изменения, ещё не записанные на диск/в Gist",
+          lambda: state_writer.version - state_writer.durable_version)
+
+# ───────────── приём событий ─────────────
+_seen_event_ids: "OrderedDict[str, None]" = OrderedDict()
+_seen_lock = threading.Lock()
+
+def _already_seen(event_id: Optional[str]) -> bool:
+    """Callback API повторяет событие, если не дождался "ok" — второй раз не обрабатываем."""
+    if not event_id:
+        return False
+    with _seen_lock:
+        if event_id in _seen_event_ids:
+            return True
+        _seen_event_ids[event_id] = None
+        while len(_seen_event_ids) > 5000:
+            _seen_event_ids.popitem(last=False)
+    return False
+
+def accept_update(update: dict):
+    """Общий вход для Bots Long Poll / Callback API / replay: событие в формате Callback API."""
+    if _already_seen(update.get("event_id")):
+        EVENTS_DUPLICATE.inc()
+        return
+    etype = update.get("type")
+    EVENTS_TOTAL.inc(etype or "unknown")
+    obj = update.get("object") or {}
+
+    if etype == "message_new":
+        # с API 5.103 сообщение лежит в object.message, раньше — прямо в object
+        m = obj.get("message", obj) if isinstance(obj, dict) else {}
+        uid = int(m.get("from_id") or m.get("user_id") or 0)
+        peer_id = int(m.get("peer_id") or uid)
+        if uid <= 0 or peer_id != uid:
+            return  # только личные сообщения от пользователей
+        deliver(uid, m.get("text") or "")
+        return
 
-                        slot["users"].append(fullname)
-                        save_state()
-                        pending_cat.pop(user_id, None)
-                        send_msg(user_id, f"✅ Записаны: {cat} → {slot['title']}")
-                        continue
+    if etype in ("group_join", "group_leave"):
+        # состав сообщества изменился — список учеников надо перечитать
+        if workers is not None:
+            workers.broadcast(("members",))
+        else:
+            invalidate_members_cache()
+        return
+
+def deliver(uid: int, text: str):
+    """Сообщение пользователя — в обработку: здесь же или воркеру, который отвечает за uid."""
+    if workers is not None:
+        workers.send(uid, text)
+    else:
+        dispatcher.submit(uid, handle_message, uid, text)
+
+def on_user_longpoll_event(event: LongPollEvent):
+    EVENTS_TOTAL.inc(getattr(event.type, "name", str(event.type)).lower())
+    if event.type == VkEventType.MESSAGE_NEW and event.to_me:
+        deliver(event.user_id, event.text or "")
 
-                send_msg(user_id, "Не понял команду. Выберите действие:")
+def ingest_user_longpoll():
+    longpoll = VkLongPoll(vk_session)
+    while True:
+        try:
+            for event in longpoll.listen():
+                on_user_longpoll_event(event)
+
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            INGEST_RECONNECTS.inc("longpoll")
+            print(f"⚠️ Сетевая ошибка: {e}. Повтор через 5 сек...")
+            time.sleep(5)
+
+def ingest_bots_longpoll():
+    longpoll = VkBotLongPoll(vk_session, GROUP_ID)
+    while True:
+        try:
+            for event in longpoll.listen():
+                accept_update(event.raw)
 
         except KeyboardInterrupt:
             raise
         except Exception as e:
+            INGEST_RECONNECTS.inc("bots")
             print(f"⚠️ Сетевая ошибка: {e}. Повтор через 5 сек...")
             time.sleep(5)
 
-except KeyboardInterrupt:
-    print("\n🛑 Бот остановлен пользователем (Ctrl+C). До встречи!")
+def ingest_callback():
+    if health_server is None:
+        raise RuntimeError("Callback API: HTTP-сервер не запущен (см. PORT)")
+    print(f"Callback API: жду события на {CALLBACK_PATH}")
+    while True:
+        time.sleep(3600)
+
+def ingest_replay(path: str):
+    """Прогоняет события из файла (по одному JSON на строку) и выходит, когда всё обработано."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                accept_update(json.loads(line))
+
+INGESTORS = {
+    "longpoll": ingest_user_longpoll,
+    "bots": ingest_bots_longpoll,
+    "callback": ingest_callback,
+    "replay": lambda: ingest_replay(REPLAY_FILE),
+}
+
+# ───────────── несколько воркеров (WORKERS > 1) ─────────────
+# Главный процесс только принимает события (longpoll / callback / replay), отсеивает повторы
+# и раздаёт сообщения воркерам: user_id всегда попадает к воркеру user_id % WORKERS, так что
+# диалог человека (pending_cat, admin_edit, ...) живёт в одном процессе, а его события, как
+# и раньше, идут строго по очереди.
+# Общее состояние — одна база SQLite (STORAGE_MODE=sqlite, WAL). У каждого процесса своя копия
+# state для быстрых ответов; если базу изменил другой процесс (PRAGMA data_version), копия
+# перечитывается перед обработкой сообщения. Запись на слот проверяет слот, вместимость и лимит
+# по самой базе в той же транзакции, что и вставку (SqliteStore.book_many).
+# Снимок в файлы состояния и Gist выгружает только главный процесс. Упавший воркер перезапускается:
+# очередь его событий живёт в главном процессе, теряются только его незаконченные диалоги.
+# /metrics показывает метрики главного процесса.
+import multiprocessing
+
+WORKER_RESTARTS = Counter("worker_restarts_total", "Перезапуски упавших воркеров")
+
+_store_seen = -1   # data_version базы, с которым совпадает копия state
+
+def sync_from_store() -> bool:
+    """Если базу менял другой процесс — перечитать копию state. True — если перечитали."""
+    global _store_seen
+    if sql_store is None or WORKERS == 1:
+        return False
+    if sql_store.data_version() == _store_seen:
+        return False
+    with state_lock:
+        seen = sql_store.data_version()
+        if seen == _store_seen:
+            return False
+        _adopt_state(State.from_json(sql_store.load()))
+        _store_seen = seen
+    return True
+
+class WorkerPool:
+    def __init__(self, n: int):
+        self._ctx = multiprocessing.get_context("spawn")   # воркер импортирует main.py заново, без унаследованных потоков
+        self.inboxes = [self._ctx.Queue() for _ in range(n)]
+        self.procs: list = [None] * n
+        self._stopping = False
+
+    def start(self):
+        for i in range(len(self.inboxes)):
+            self._spawn(i)
+        threading.Thread(target=self._watch, name="workers-watch", daemon=True).start()
+
+    def _spawn(self, i: int):
+        p = self._ctx.Process(target=worker_main, args=(i, self.inboxes[i]), name=f"bot-worker-{i}", daemon=True)
+        p.start()
+        self.procs[i] = p
+
+    def send(self, uid: int, text: str):
+        self.inboxes[uid % len(self.inboxes)].put(("msg", uid, text))
+
+    def broadcast(self, item):
+        for q in self.inboxes:
+            q.put(item)
+
+    def _watch(self):
+        """Раз в секунду: перезапуск упавших воркеров и выгрузка того, что они записали в базу."""
+        while not self._stopping:
+            time.sleep(1.0)
+            for i, p in enumerate(self.procs):
+                if not self._stopping and not p.is_alive():
+                    WORKER_RESTARTS.inc()
+                    print(f"⚠️ Воркер {i} завершился (код {p.exitcode}), перезапускаю")
+                    self._spawn(i)
+            with state_lock:   # между перечитыванием и пометкой никто не должен вклиниться
+                if sync_from_store():
+                    save_state()   # снимок уйдёт в файлы состояния/Gist по правилам StateWriter
+
+    def stop(self, timeout: float = 60):
+        """Воркеры дообрабатывают уже полученные события и отправляют ответы."""
+        self._stopping = True
+        self.broadcast(None)
+        for p in self.procs:
+            p.join(timeout)
+        for p, q in zip(self.procs, self.inboxes):
+            q.close()        # иначе фидер-поток и семафоры очереди живут до выхода интерпретатора
+            if p is not None and p.is_alive():
+                q.cancel_join_thread()   # зависший воркер трубу не вычитает — не ждём его
+            else:
+                q.join_thread()
+        # семафоры очередей освобождаются финализатором при сборке объекта, а не при
+        # выходе через os._exit — отпускаем ссылки сразу
+        self.inboxes = []
+
+workers: Optional[WorkerPool] = None
+
+def ingest_inbox(inbox):
+    """Воркер: события от главного процесса; None — остановка."""
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+        if item[0] == "msg":
+            _, uid, text = item
+            dispatcher.submit(uid, handle_message, uid, text)
+        elif item[0] == "members":
+            invalidate_members_cache()
+
+def worker_main(index: int, inbox):
+    """Точка входа процесса-воркера."""
+    create_app().start(worker=index, inbox=inbox).serve()
+
+# ───────────── asyncio-рантайм (RUNTIME=asyncio) ─────────────
+# По умолчанию (RUNTIME=threads) каждое ожидание сети держит поток: longpoll, отправители,
+# execute-потоки, потоки HTTP-сервера. С RUNTIME=asyncio всё это — задачи одного цикла
+# asyncio в отдельном потоке, поверх маленького HTTP/1.1-клиента на asyncio-потоках
+# (только stdlib, keep-alive соединения на каждый хост):
+#   • приём событий (Bots Long Poll / user longpoll / Callback API / replay) и HTTP-сервер
+#     (/live, /ready, /metrics, callback);
+#   • вызовы VK API — те же пачки execute (AsyncExecuteBatcher) и та же очередь отправки
+#     с token bucket и повторами (AsyncOutbox);
+#   • запросы к Gist: GistSync тот же, меняется только транспорт (LoopHttpSession).
+# Обработчики сообщений остаются обычными функциями: их выполняет пул из DISPATCH_WORKERS
+# потоков, события одного user_id — по очереди (AsyncDispatcher). session_api.users.get(...)
+# и прочее в них работает как раньше: запрос уходит в цикл, поток обработчика ждёт ответа.
+# Диалог, ждущий своей очереди, или вызов API в полёте — запись в очереди цикла, а не поток.
+# Только WORKERS=1.
+import ssl
+from http import HTTPStatus
+from urllib.parse import urlencode, urlsplit
+from requests.structures import CaseInsensitiveDict
+from vk_api.exceptions import ApiHttpError
+
+RUNTIME = os.getenv("RUNTIME", "threads").strip().lower()
+LONGPOLL_WAIT = 25          # секунд держит запрос longpoll-сервер
+VK_HTTP_TIMEOUT = 30
+VK_API_VERSION = vk_session.api_version
+
+class HttpResponse:
+    """Ответ AsyncHttp — с теми полями requests.Response, которые нужны GistSync и вызовам VK."""
+    __slots__ = ("status_code", "headers", "content", "url")
+
+    def __init__(self, status_code: int, headers: CaseInsensitiveDict, content: bytes, url: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8") or "null")
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} для {self.url}", response=self)
+
+class AsyncHttp:
+    """HTTP/1.1-клиент на asyncio: соединения к хосту переиспользуются (keep-alive)."""
+
+    def __init__(self, max_idle: int = 16):
+        self.max_idle = max_idle
+        self._idle: Dict[Tuple[str, str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+        self._ssl: Optional[ssl.SSLContext] = None
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      body: bytes = b"", timeout: float = VK_HTTP_TIMEOUT) -> HttpResponse:
+        u = urlsplit(url)
+        https = u.scheme == "https"
+        key = (u.scheme, u.hostname or "", u.port or (443 if https else 80))
+        target = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        head = [f"{method} {target} HTTP/1.1", f"Host: {u.netloc}", f"Content-Length: {len(body)}"]
+        head += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        data = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                if https and self._ssl is None:
+                    self._ssl = ssl.create_default_context()
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(key[1], key[2], ssl=self._ssl if https else None), timeout)
+            try:
+                writer.write(data)
+                await writer.drain()
+                resp, keep = await asyncio.wait_for(self._read_response(reader, method, url), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue   # сервер закрыл простаивавшее соединение — повторяем на новом
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            idle = self._idle.setdefault(key, [])
+            if keep and len(idle) < self.max_idle:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+            return resp
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader, method: str, url: str) -> Tuple[HttpResponse, bool]:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("соединение закрыто сервером")
+        version, status, *_ = line.decode("latin-1").split(" ", 2)
+        headers = CaseInsensitiveDict()
+        while True:
+            h = await reader.readline()
+            if h in (b"\r\n", b"\n"):
+                break
+            if not h:
+                raise ConnectionResetError("соединение закрыто сервером")
+            k, _, v = h.decode("latin-1").partition(":")
+            headers[k.strip()] = v.strip()
+        code = int(status)
+        keep = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        if method == "HEAD" or code in (204, 304) or code < 200:
+            body = b""
+        elif "chunked" in headers.get("Transfer-Encoding", "").lower():
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if not size:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass   # trailer
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(parts)
+        elif "Content-Length" in headers:
+            body = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            body = await reader.read()
+            keep = False
+        return HttpResponse(code, headers, body, url), keep
+
+class LoopHttpSession:
+    """Для GistSync вместо requests.Session: те же get/patch, но запрос выполняет цикл asyncio."""
+
+    def __init__(self, runtime: "AsyncRuntime", headers):
+        self.runtime = runtime
+        # без Accept-Encoding: AsyncHttp не распаковывает gzip
+        self.headers = {k: v for k, v in headers.items() if k.lower() not in ("accept-encoding", "connection")}
+
+    def request(self, method: str, url: str, headers: Optional[dict] = None, data: bytes = b"",
+                timeout: Optional[float] = None) -> HttpResponse:
+        return self.runtime.run(self.runtime.http.request(
+            method, url, dict(self.headers, **(headers or {})), data or b"", timeout or VK_HTTP_TIMEOUT))
+
+    def get(self, url: str, headers: Optional[dict] = None, timeout: Optional[float] = None) -> HttpResponse:
+        return self.request("GET", url, headers, timeout=timeout)
+
+    def patch(self, url: str, data: bytes = b"", timeout: Optional[float] = None) -> HttpResponse:
+        return self.request("PATCH", url, data=data, timeout=timeout)
+
+class AsyncVkClient:
+    """Вызов метода VK API из цикла asyncio — как VkApi.method, с той же паузой между запросами."""
+
+    def __init__(self, http: AsyncHttp, token: str, rps_delay: float = vk_api.VkApi.RPS_DELAY,
+                 retry_rps: bool = True):
+        self.http = http
+        self.token = token
+        self.rps_delay = rps_delay
+        self.retry_rps = retry_rps   # "слишком много запросов" — подождать и повторить, как vk_api
+        self._lock = asyncio.Lock()
+        self._last = 0.0
+
+    async def method(self, method: str, values: Optional[dict] = None, raw: bool = False):
+        values = {k: v for k, v in (values or {}).items() if v is not None}
+        values.setdefault("v", VK_API_VERSION)
+        values["access_token"] = self.token
+        url = (f"{VK_API_URL}/" if VK_API_URL else _VK_METHOD_URL) + method
+        body = urlencode(values).encode("utf-8")
+        while True:
+            async with self._lock:
+                delay = self.rps_delay - (time.monotonic() - self._last)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                started = time.perf_counter()
+                try:
+                    r = await self.http.request("POST", url, {"Content-Type": "application/x-www-form-urlencoded"}, body)
+                    if not r.ok:
+                        raise ApiHttpError(self, method, values, raw, r)
+                    response = r.json()
+                    if "error" in response:
+                        raise ApiError(self, method, values, raw, response["error"])
+                except Exception as e:
+                    VK_REQUEST_ERRORS.inc(method, _error_code(e))
+                    if getattr(e, "code", None) != TOO_MANY_RPS_CODE or not self.retry_rps:
+                        raise
+                    response = None
+                finally:
+                    self._last = time.monotonic()
+                    VK_REQUESTS.inc(method)
+                    VK_REQUEST_SECONDS.observe(time.perf_counter() - started, method)
+            if response is not None:
+                return response if raw else response["response"]
+            await asyncio.sleep(0.5)
+
+async def aexecute_calls(client: AsyncVkClient, calls: List[Tuple[str, dict]]) -> List[Tuple[object, Optional[dict]]]:
+    return execute_results(await client.method("execute", {"code": execute_code(calls)}, raw=True), calls)
+
+def _settle(fut: Future, result=None, error: Optional[BaseException] = None):
+    # ожидающий мог уже отказаться (отмена задачи при остановке) — тогда результат никому не нужен
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+class AsyncExecuteBatcher:
+    """ExecuteBatcher в цикле asyncio: тот же get_api()/submit(), а пачки отправляют задачи, не потоки."""
+
+    def __init__(self, runtime: "AsyncRuntime", token: str, window: float = EXECUTE_WINDOW, parallel: int = 1):
+        self.runtime = runtime
+        self.window = window
+        # parallel — сколько execute в полёте одновременно, у каждой «полосы» своя пауза между запросами
+        self._clients = [AsyncVkClient(runtime.http, token) for _ in range(max(parallel, 1))]
+        self._pending: deque = deque()
+        self._wake = asyncio.Event()
+        self._started = False
+        self.requests = 0   # HTTPS-запросов
+        self.calls = 0      # методов API в них
+
+    def get_api(self) -> VkApiMethod:
+        return VkApiMethod(self)
+
+    def submit(self, method: str, values: Optional[dict] = None) -> Future:
+        """Из любого потока; результат — concurrent.futures.Future, как у ExecuteBatcher."""
+        fut: Future = Future()
+        fut.add_done_callback(functools.partial(_observe_call, method, time.perf_counter()))
+        self.runtime.call_soon(self._enqueue, (method, dict(values or {}), fut))
+        return fut
+
+    async def call(self, method: str, values: Optional[dict] = None):
+        """Для кода в самом цикле."""
+        return await asyncio.wrap_future(self.submit(method, values))
+
+    def method(self, method: str, values: Optional[dict] = None):
+        if method == "execute":
+            return self.runtime.run(self._clients[0].method(method, values))
+        return self.runtime.wait(self.submit(method, values))
+
+    def _enqueue(self, item):
+        if not self._started:
+            self._started = True
+            for client in self._clients:
+                self.runtime.loop.create_task(self._lane(client))
+        self._pending.append(item)
+        self._wake.set()
+
+    async def _wait_wake(self, timeout: Optional[float] = None) -> bool:
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _lane(self, client: AsyncVkClient):
+        loop = self.runtime.loop
+        while True:
+            while not self._pending:
+                await self._wait_wake()
+            # чуть ждём попутчиков, но не дольше окна и не больше 25 вызовов
+            deadline = loop.time() + self.window
+            while len(self._pending) < EXECUTE_MAX_CALLS:
+                left = deadline - loop.time()
+                if left <= 0 or not await self._wait_wake(left):
+                    break
+            if not self._pending:
+                continue    # пока ждали, всё забрала другая полоса
+            batch = [self._pending.popleft() for _ in range(min(len(self._pending), EXECUTE_MAX_CALLS))]
+            self.requests += 1
+            self.calls += len(batch)
+            await self._run(client, batch)
+
+    async def _run(self, client: AsyncVkClient, batch):
+        if len(batch) == 1:
+            method, values, fut = batch[0]
+            try:
+                _settle(fut, await client.method(method, values))
+            except Exception as e:
+                _settle(fut, error=e)
+            return
+        try:
+            results = await aexecute_calls(client, [(m, v) for m, v, _ in batch])
+        except Exception as e:
+            for _m, _v, fut in batch:
+                _settle(fut, error=e)
+            return
+        for (method, values, fut), (res, err) in zip(batch, results):
+            if err is None:
+                _settle(fut, res)
+            else:
+                err = dict({"error_code": 0, "error_msg": "execute: нет ответа"}, **err)
+                _settle(fut, error=ApiError(client, method, values, {"error": err}, err))
+
+class AsyncOutbox(OutboundQueue):
+    """OutboundQueue, где отправители — задачи цикла asyncio: тот же bucket, пачки и повторы."""
+
+    def __init__(self, runtime: "AsyncRuntime", rate: float, workers: int):
+        super().__init__(rate, workers)
+        self.runtime = runtime
+        self._queues = [asyncio.PriorityQueue() for _ in range(max(workers, 1))]
+
+    def start(self):
+        for q in self._queues:
+            self.runtime.call_soon(self.runtime.loop.create_task, self._sender(q))
+
+    def put(self, payload: dict):
+        payload.setdefault("random_id", random.getrandbits(31))
+        q = self._queues[int(payload.get("user_id", 0)) % len(self._queues)]
+        self.runtime.call_soon(q.put_nowait, (next(self._seq), time.monotonic(), 0, payload))
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        async def join():
+            for q in self._queues:
+                await q.join()
+        try:
+            self.runtime.run(join(), timeout)
+            return True
+        except FutureTimeout:
+            return False
+
+    async def _sender(self, q: asyncio.PriorityQueue):
+        # без своей паузы между запросами: темп держит общий bucket
+        client = AsyncVkClient(self.runtime.http, COMMUNITY_TOKEN, rps_delay=0, retry_rps=False)
+        while True:
+            batch = [await q.get()]
+            while len(batch) < EXECUTE_MAX_CALLS and not q.empty():
+                batch.append(q.get_nowait())
+            deferred = 0
+            try:
+                await self.bucket.acquire_async()
+                try:
+                    if len(batch) == 1:
+                        results = [(await client.method("messages.send", batch[0][3]), None)]
+                    else:
+                        results = await aexecute_calls(client, [("messages.send", item[3]) for item in batch])
+                except Exception as e:
+                    deferred = self._retry_or_fail(q, *self._send_error(batch, e), e)
+                    continue
+                deferred = self._retry_or_fail(q, *self._sent(batch, results))
+            finally:
+                for _ in range(len(batch) - deferred):
+                    q.task_done()
+
+    def _retry_or_fail(self, q: asyncio.PriorityQueue, again: list, failed: list, err) -> int:
+        again, pause = self._give_up(again, failed, err)
+        if again:
+            self.runtime.loop.call_later(pause, self._requeue_nowait, q, again)
+        return len(again)
+
+    @staticmethod
+    def _requeue_nowait(q: asyncio.PriorityQueue, items: list):
+        for item in items:
+            q.put_nowait(item)
+            q.task_done()
+
+class AsyncDispatcher:
+    """EventDispatcher для asyncio: очереди по user_id живут в цикле, обработчики — в пуле потоков."""
+
+    def __init__(self, runtime: "AsyncRuntime", workers: int, max_pending: int):
+        self.runtime = runtime
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="handler")
+        # user_id -> очередь ещё не выполненных событий; ключ есть, пока у пользователя что-то в работе
+        self._queues: Dict[int, deque] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._pending = 0
+        self._max_pending = max(max_pending, 1)
+        self._room = asyncio.Event()
+
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, key: int, fn, *args):
+        self.runtime.call_soon(self._submit, key, fn, args)
+
+    def _submit(self, key: int, fn, args):
+        self._pending += 1
+        q = self._queues.get(key)
+        if q is not None:
+            q.append((fn, args))
+            return
+        self._queues[key] = deque([(fn, args)])
+        task = self.runtime.loop.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key: int):
+        q = self._queues[key]
+        while q:
+            fn, args = q.popleft()
+            try:
+                await self.runtime.loop.run_in_executor(self._pool, fn, *args)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработки события от {key}: {e}")
+            finally:
+                self._pending -= 1
+                if self._pending < self._max_pending:
+                    self._room.set()
+        del self._queues[key]
+
+    async def wait_room(self):
+        """
+        Backpressure: приём событий ждёт, пока в очереди меньше max_pending. Проверяется перед
+        каждым запросом к longpoll, так что сверху может набежать одна пачка событий.
+        """
+        while self._pending >= self._max_pending:
+            self._room.clear()
+            await self._room.wait()
+
+    async def _join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def shutdown(self, wait: bool = True):
+        if wait:
+            self.runtime.run(self._join())
+        self._pool.shutdown(wait=wait)
+
+async def _http_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Соединение с HTTP-сервером (keep-alive): запрос -> http_route -> ответ."""
+    try:
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                return
+            method, target, version = line.decode("latin-1").split()
+            headers = CaseInsensitiveDict()
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = h.decode("latin-1").partition(":")
+                headers[k.strip()] = v.strip()
+            body = await reader.readexactly(int(headers.get("Content-Length") or 0))
+            code, payload, content_type, update = http_route(method, target, body)
+            close = version != "HTTP/1.1" or headers.get("Connection", "").lower() == "close"
+            head = [f"HTTP/1.1 {code} {HTTPStatus(code).phrase}", f"Content-Length: {len(payload)}"]
+            if content_type:
+                head.append(f"Content-Type: {content_type}")
+            if close:
+                head.append("Connection: close")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+            await writer.drain()
+            if update is not None:
+                accept_update(update)
+            if close:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        return
+    finally:
+        writer.close()
+
+class AsyncRuntime:
+    """Цикл asyncio в своём потоке и мост к нему из обычного кода (обработчики, StateWriter, App)."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.http = AsyncHttp()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._thread = threading.Thread(target=self._run_loop, name="asyncio", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def call_soon(self, fn, *args):
+        """Выполнить fn в цикле: сразу, если мы уже в нём, иначе — потокобезопасно."""
+        if self.in_loop():
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def wait(self, fut: Future, timeout: Optional[float] = None):
+        """Дождаться результата из обычного потока. Из самого цикла нельзя — он бы встал."""
+        if self.in_loop():
+            raise RuntimeError("блокирующее ожидание внутри цикла asyncio")
+        try:
+            return fut.result(timeout)
+        except BaseException:
+            fut.cancel()   # таймаут или Ctrl+C — корутину в цикле тоже останавливаем
+            raise
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Выполнить корутину в цикле и дождаться результата."""
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("блокирующее ожидание внутри цикла asyncio")
+        return self.wait(asyncio.run_coroutine_threadsafe(coro, self.loop), timeout)
+
+    async def serve_http(self, port: int) -> int:
+        self.server = await asyncio.start_server(_http_connection, "0.0.0.0", port)   # как ("", port) у ThreadingHTTPServer
+        return self.server.sockets[0].getsockname()[1]
+
+aio: Optional[AsyncRuntime] = None
+
+def start_asyncio_runtime() -> AsyncRuntime:
+    """Запустить цикл и подменить потоковые части (VK-вызовы, отправку, диспетчер, Gist) на asyncio."""
+    global aio, session_batcher, session_api, user_batcher, user_api, outbox, dispatcher
+    aio = AsyncRuntime()
+    aio.start()
+    session_batcher = AsyncExecuteBatcher(aio, COMMUNITY_TOKEN)
+    session_api = session_batcher.get_api()
+    if USER_TOKEN:
+        user_batcher = AsyncExecuteBatcher(aio, USER_TOKEN, parallel=ROSTER_PARALLEL)
+        user_api = user_batcher.get_api()
+    outbox = AsyncOutbox(aio, SEND_RATE / WORKERS, SEND_WORKERS)
+    dispatcher = AsyncDispatcher(aio, DISPATCH_WORKERS, DISPATCH_MAX_PENDING)
+    if gist is not None:
+        gist._http = LoopHttpSession(aio, gist._http.headers)
+    return aio
+
+async def _longpoll(mode: str, server_method: str, server_values: dict, params: dict,
+                    on_update: Callable[[object], None]):
+    """Запросы a_check к longpoll-серверу VK — то же, что listen() в vk_api, только без потока."""
+    lp: Optional[dict] = None
+    while True:
+        try:
+            if lp is None:
+                lp = await session_batcher.call(server_method, server_values)
+            await dispatcher.wait_room()
+            server = lp["server"] if "://" in lp["server"] else "https://" + lp["server"]
+            query = urlencode(dict(params, act="a_check", key=lp["key"], ts=lp["ts"], wait=LONGPOLL_WAIT))
+            r = await aio.http.request("GET", f"{server}?{query}", timeout=LONGPOLL_WAIT + 10)
+            r.raise_for_status()
+            response = r.json()
+            if "failed" not in response:
+                lp["ts"] = response["ts"]
+                for raw in response.get("updates") or []:
+                    on_update(raw)
+            elif response["failed"] == 1:
+                lp["ts"] = response["ts"]
+            elif response["failed"] == 2:
+                fresh = await session_batcher.call(server_method, server_values)
+                lp.update(key=fresh["key"], server=fresh["server"])
+            else:
+                lp = None
+        except Exception as e:
+            INGEST_RECONNECTS.inc(mode)
+            print(f"⚠️ Сетевая ошибка: {e}. Повтор через 5 сек...")
+            await asyncio.sleep(5)
+
+async def aingest_user_longpoll():
+    await _longpoll("longpoll", "messages.getLongPollServer", {"lp_version": 3, "need_pts": 0},
+                    {"mode": int(LONGPOLL_MODE), "version": 3},
+                    lambda raw: on_user_longpoll_event(LongPollEvent(raw)))
+
+async def aingest_bots_longpoll():
+    await _longpoll("bots", "groups.getLongPollServer", {"group_id": GROUP_ID}, {}, accept_update)
+
+async def aingest_callback():
+    if aio.server is None:
+        raise RuntimeError("Callback API: HTTP-сервер не запущен (см. PORT)")
+    print(f"Callback API: жду события на {CALLBACK_PATH}")
+    while True:
+        await asyncio.sleep(3600)
+
+async def aingest_replay(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                await dispatcher.wait_room()
+                accept_update(json.loads(line))
+
+AINGESTORS = {
+    "longpoll": aingest_user_longpoll,
+    "bots": aingest_bots_longpoll,
+    "callback": aingest_callback,
+    "replay": lambda: aingest_replay(REPLAY_FILE),
+}
+
+# ───────────── запуск ─────────────
+# Импорт main.py ничего не запускает: ни HTTP-сервера, ни потоков, ни запросов к VK/Gist —
+# модуль можно импортировать из тестов и утилит. Всё это делает App.start():
+#   1. HTTP-сервер (/live сразу отвечает ok, /ready — 503, пока бот не готов);
+#   2. проверки токенов — в фоне, параллельно со следующим шагом;
+#   3. состояние: если файлы состояния лежат на диске, берём их сразу, а Gist сверяем в фоне
+#      (reconcile_state_with_gist); без локального файла ждём Gist, как раньше;
+#   4. App.serve() — приём событий, /ready начинает отвечать 200.
+# Длительность этапов (от создания App) — в bot_startup_seconds и в /ready.
+def _local_state_first() -> bool:
+    """Можно ли стартовать с локальных файлов состояния, не дожидаясь Gist."""
+    return STORAGE_MODE == "snapshot" and gist is not None and _local_state_exists()
+
+def _adopt_state(data: State):
+    """Подменить состояние целиком (под state_lock) и сбросить всё, что из него посчитано."""
+    global state, state_version
+    with state_lock:
+        state = data
+        booking_index.rebuild(state)
+        state_version += 1   # сбрасывает render_cached, но не пишет на диск/в Gist
+        invalidate_keyboards()
+
+def init_state(gist: bool = True):
+    global sql_store
+    if STORAGE_MODE == "sqlite" and sql_store is None:
+        sql_store = SqliteStore(SQLITE_FILE)
+    _adopt_state(load_state(gist))
+    state_writer.start(_journal_seq_at_load)
+    atexit.register(state_writer.stop)
+    name_cache.warm(_known_users_pairs())
+    _warm_keyboards()
+
+def reconcile_state_with_gist(base_version: int):
+    """
+    Gist главнее локального файла (как и при обычной загрузке), но только пока
+    локально ничего не менялось: иначе оставляем своё — в Gist оно уйдёт со следующей записью.
+    """
+    g = _load_gist()
+    if g is None:
+        return
+    data = State.from_json(g)
+    with state_lock:
+        if state_version != base_version:
+            print("⚠️ Gist пришёл после первых изменений — оставляю локальное состояние.")
+            return
+        if data.to_json() == state.to_json():
+            return
+        _adopt_state(data)
+    name_cache.warm(_known_users_pairs())
+    print("✓ Состояние сверено с Gist: взята версия из Gist")
+
+class App:
+    def __init__(self):
+        self.created = time.perf_counter()
+        self.phases: Dict[str, float] = {}   # этап -> секунд от создания App
+        self.checks: Dict[str, bool] = {}    # vk_token / user_token / gist_reconcile -> прошло ли
+        self.ready = threading.Event()
+        self.worker: Optional[int] = None   # номер воркера (WORKERS > 1), None — главный процесс
+        self._ingest: Optional[Callable[[], object]] = None   # с asyncio — корутина
+        self._started = False
+
+    def mark(self, phase: str):
+        if phase not in self.phases:
+            self.phases[phase] = round(time.perf_counter() - self.created, 3)
+
+    def status(self) -> dict:
+        return {"ready": self.ready.is_set(), "phases": dict(self.phases), "checks": dict(self.checks)}
+
+    def _background(self, pool: ThreadPoolExecutor, name: str, fn, *args):
+        def job():
+            try:
+                res = fn(*args)
+                self.checks[name] = res is not False
+            except Exception as e:
+                self.checks[name] = False
+                print(f"⚠️ {name}: {e}")
+            self.mark(name)
+        pool.submit(job)
+
+    def start(self, worker: Optional[int] = None, inbox=None) -> "App":
+        global workers
+        if self._started:
+            return self
+        self._started = True
+        if not COMMUNITY_TOKEN or not GROUP_ID:
+            raise RuntimeError("Нет VK_TOKEN или GROUP_ID в .env")
+        if WORKERS > 1 and STORAGE_MODE != "sqlite":
+            raise RuntimeError("WORKERS > 1 работает только с STORAGE_MODE=sqlite")
+        if RUNTIME not in ("threads", "asyncio"):
+            raise RuntimeError(f"Неизвестный RUNTIME={RUNTIME!r}, варианты: threads, asyncio")
+        if RUNTIME == "asyncio" and WORKERS > 1:
+            raise RuntimeError("RUNTIME=asyncio работает только с WORKERS=1")
+
+        if worker is not None:
+            # HTTP-сервер, проверки токенов и выгрузку в Gist делает главный процесс
+            self.worker = worker
+            self._ingest = lambda: ingest_inbox(inbox)
+            state_writer.export = False
+            try:
+                signal.signal(signal.SIGTERM, _on_sigterm)
+            except ValueError:
+                pass
+            init_state()
+            self.mark("state")
+            if user_api:
+                _load_members_cache()
+            outbox.start()
+            return self
+
+        ingestors = AINGESTORS if RUNTIME == "asyncio" else INGESTORS
+        self._ingest = ingestors.get(INGEST_MODE)
+        if self._ingest is None:
+            raise RuntimeError(f"Неизвестный INGEST_MODE={INGEST_MODE!r}, варианты: {', '.join(ingestors)}")
+        if RUNTIME == "asyncio":
+            start_asyncio_runtime()
+        _start_health_server()
+        try:
+            signal.signal(signal.SIGTERM, _on_sigterm)
+        except ValueError:
+            pass  # не главный поток
+
+        pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup")
+        self._background(pool, "vk_token", check_community_token)
+        self._background(pool, "user_token", check_user_token)
+        if _local_state_first():
+            init_state(gist=False)
+            self._background(pool, "gist_reconcile", reconcile_state_with_gist, state_version)
+        else:
+            init_state()
+        self.mark("state")
+        pool.shutdown(wait=False)
+
+        if WORKERS > 1:
+            # база уже создана/импортирована здесь — воркеры только открывают её
+            workers = WorkerPool(WORKERS)
+            workers.start()
+            print(f"Воркеров: {WORKERS}, события распределяются по user_id % {WORKERS}")
+            return self
+        if user_api:
+            _load_members_cache()
+        outbox.start()
+        return self
+
+    def serve(self):
+        self.ready.set()
+        self.mark("ready")
+        who = "Бот" if self.worker is None else f"Воркер {self.worker}"
+        print(f"{who} запущен за {self.phases['ready']:.2f} с. Нажми Ctrl+C для остановки.")
+        try:
+            if aio is not None:
+                aio.run(self._ingest())
+            else:
+                self._ingest()
+        except KeyboardInterrupt:
+            if self.worker is None:
+                print("\n🛑 Бот остановлен пользователем (Ctrl+C). До встречи!")
+        finally:
+            self.ready.clear()
+            if workers is not None:
+                workers.stop()
+            # дообрабатываем уже принятые события и отправляем ответы, затем atexit допишет состояние
+            dispatcher.shutdown(wait=True)
+            if not outbox.drain(timeout=30):
+                print(f"⚠️ Не отправлено сообщений: {outbox.depth()}")
+
+app: Optional[App] = None
+
+def create_app() -> App:
+    """Единственный экземпляр бота на процесс: состояние и очереди модульные."""
+    global app
+    if app is None:
+        app = App()
+    return app
+
+GaugeFunc("bot_startup_seconds", "Время от запуска до этапа (state, ready, first_event, проверки)",
+          lambda: dict(app.phases) if app is not None else {}, labels=["phase"])
+
+# ───────────── основной цикл ─────────────
+def run():
+    create_app().start().serve()
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,30 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def load_bot(tmp_path, monkeypatch):
+    """
+    Свежий импорт main.py: настройки (STORAGE_MODE и др.) читаются при импорте, а файлы
+    состояния лежат в текущей папке — она временная. Без Gist, USER_TOKEN и сети.
+    Повторный вызов — как перезапуск бота в той же папке.
+    """
+    monkeypatch.chdir(tmp_path)
+    for name in ("GIST_TOKEN", "GIST_ID", "USER_TOKEN", "WORKERS", "SQLITE_FILE"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("VK_TOKEN", "test")
+    monkeypatch.setenv("GROUP_ID", "1")
+
+    def load(mode: str = "snapshot"):
+        monkeypatch.setenv("STORAGE_MODE", mode)
+        sys.modules.pop("main", None)
+        return importlib.import_module("main")
+
+    yield load
+    sys.modules.pop("main", None)
@@ -0,0 +1,80 @@
+import pytest
+
+STUDENT = 555
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    bot.state.by_id("pr").retitle({"S1": "Пн 10:00"})
+    return bot
+
+
+def resolve(bot, uid, text):
+    return bot.router.resolve(bot.Msg(uid, text, "Имя Фамилия")).__name__
+
+
+@pytest.mark.parametrize("text, handler", [
+    ("/clearpr", "admin_clear_category"),
+    ("/CLEAR bh", "admin_clear_category"),
+    ("/delbh 2", "admin_delete_slot"),
+    ("/del pr 2", "admin_delete_slot"),
+    ("/setxpr 1 Пн 10:00 13 1", "admin_set_slots"),
+    ("/newcat eng Английский", "admin_new_category"),
+    ("/dropcat eng", "admin_drop_category"),
+    ("/delivery", "not_understood"),
+    ("/deletes", "not_understood"),
+    ("/clearx", "not_understood"),
+])
+def test_admin_commands(bot, text, handler):
+    assert resolve(bot, bot.ADMINS[0], text) == handler
+
+
+def test_commands_are_admin_only(bot):
+    for text in ("/clearpr", "/delpr 1", "/setxpr 1 Пн 10:00 13 1"):
+        assert resolve(bot, STUDENT, text) == "not_understood"
+
+
+@pytest.mark.parametrize("text, handler", [
+    ("Старт", "main_menu"),
+    ("МЕНЮ", "main_menu"),
+    ("Расписание", "schedule_summary"),
+    ("Мои записи", "my_bookings"),
+    ("Выбрать", "choose"),
+    ("Админам", "admin_panel"),   # отказ не-админу, а не «Не понял команду»
+    ("Программирование", "choose_category"),
+    ("что-то", "not_understood"),
+])
+def test_menu_texts(bot, text, handler):
+    assert resolve(bot, STUDENT, text) == handler
+
+
+def test_admin_digits_come_first(bot):
+    admin = bot.ADMINS[0]
+    bot.admin_edit[admin] = {"step": "pick_student"}
+    assert resolve(bot, admin, "2") == "admin_pick_student"
+    bot.admin_edit[admin] = {"step": "pick_slot"}
+    assert resolve(bot, admin, "2") == "admin_pick_slot"
+    assert resolve(bot, STUDENT, "2") == "not_understood"
+
+
+def test_buttons_before_dialog_state(bot):
+    bot.pending_rewrite[STUDENT] = "menu"
+    assert resolve(bot, STUDENT, "Назад") == "back"
+    assert resolve(bot, STUDENT, "Перезапись: Всё") == "rewrite_reset"
+    assert resolve(bot, STUDENT, "Перезапись: Программирование") == "rewrite_reset"
+    del bot.pending_rewrite[STUDENT]
+    assert resolve(bot, STUDENT, "Перезапись: Всё") == "not_understood"
+
+
+def test_category_and_slot_choice(bot):
+    admin = bot.ADMINS[0]
+    bot.admin_mode[admin] = "edit"
+    bot.admin_edit[admin] = {"step": "cat", "op": "add"}
+    assert resolve(bot, admin, bot.CAT_PR) == "admin_edit_pick_category"
+    assert resolve(bot, STUDENT, bot.CAT_PR) == "choose_category"
+
+    bot.pending_cat[STUDENT] = bot.CAT_PR
+    assert resolve(bot, STUDENT, "Пн 10:00") == "book_slot"
+    assert resolve(bot, STUDENT, "Вт 10:00") == "not_understood"
+    assert resolve(bot, STUDENT, "Отмена") == "cancel"
@@ -0,0 +1,99 @@
+import json
+import os
+
+
+def test_journal_replay_after_crash(load_bot):
+    bot = load_bot("journal")
+    bot._adopt_state(bot.load_state(gist=False))
+    bot.apply_slots_bulk(bot.CAT_PR, ["Пн 10:00", "Вт 12:00"], 2, 1)
+    assert bot.admit_batch([(bot.CAT_PR, "S1", "Пн 10:00", 101, "Иван Иванов")]) == ["ok"]
+    assert bot.flush_state(timeout=5)
+    with open(bot.JOURNAL_FILE, encoding="utf-8") as f:
+        logged = f.read()
+
+    # снимок частей записан, но удалить журнал процесс не успел — и вдобавок оборвал запись
+    bot.state_writer.stop(timeout=5)
+    assert os.path.exists(bot.STATE_CONFIG_FILE) and not os.path.exists(bot.JOURNAL_FILE)
+    bot.admit_batch([(bot.CAT_PR, "S2", "Вт 12:00", 102, "Пётр Петров")])
+    bot.flush_state(timeout=5)
+    with open(bot.JOURNAL_FILE, encoding="utf-8") as f:
+        tail = f.read()
+    with open(bot.JOURNAL_FILE, "w", encoding="utf-8") as f:
+        f.write(logged + tail + '{"n": 999, "op": "bo')
+
+    bot = load_bot("journal")
+    data = bot.load_state(gist=False)
+    cfg = data.categories[bot.CAT_PR]
+    assert cfg.slot("S1").users == ["Иван Иванов"]   # из снимка и не продублирован журналом
+    assert cfg.slot("S1").uids.tolist() == [101]
+    assert cfg.slot("S2").users == ["Пётр Петров"]   # только из журнала
+    assert [s.title for s in cfg.slots[:2]] == ["Пн 10:00", "Вт 12:00"]
+    assert cfg.capacity == 2
+
+
+def test_legacy_state_json_moves_to_parts(load_bot):
+    legacy = {
+        "known_users": {"101": "Иван Иванов", "102": {"name": "Пётр Петров"}, "103": {"name": "Пётр Петров"}},
+        "categories": {
+            "Программирование": {"capacity": 3, "limit_per_user": 1, "slots": [
+                {"key": "S1", "title": "Пн 10:00", "users": ["Иван Иванов", "Пётр Петров"]},
+            ]},
+            "Английский": {"capacity": 5, "slots": [{"key": "S1", "title": "Ср 18:00", "users": []}]},
+        },
+    }
+    bot = load_bot("snapshot")
+    with open(bot.STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(legacy, f, ensure_ascii=False)
+
+    bot._adopt_state(bot.load_state(gist=False))
+    pr = bot.state.by_id("pr")
+    assert pr.name == bot.CAT_PR
+    assert [s.key for s in pr.slots] == bot.DEFAULT_SLOT_KEYS   # досыпаны S2–S4
+    assert pr.slot("S1").uids.tolist() == [101, 0]            # однофамильцы остаются без uid
+    assert bot.state.categories["Английский"].id == "c2"
+    assert bot.state.known_users[101].name == "Иван Иванов"
+
+    bot.save_state()
+    assert bot.flush_state(timeout=5)
+    for name in bot.state_files(bot.state):
+        assert os.path.exists(name), name
+    before = bot.state.to_json()
+
+    bot = load_bot("snapshot")
+    os.remove(bot.STATE_FILE)   # дальше читаются только части
+    assert bot.load_state(gist=False).to_json() == before
+
+
+def test_sqlite_book_many_checks_capacity_and_limit(load_bot):
+    bot = load_bot("sqlite")
+    st = bot.State()
+    pr, bh = st.by_id("pr"), st.by_id("bh")
+    pr.retitle({"S1": "Пн 10:00", "S2": "Вт 12:00"})
+    pr.capacity, pr.limit_per_user = 2, 1
+    bh.retitle({"S1": "Ср", "S2": "Чт", "S3": "Пт"})
+    bh.capacity, bh.limit_per_user = 5, 2
+    store = bot.SqliteStore("t.sqlite3")
+    store.import_state(st)
+
+    PR, BH = bot.CAT_PR, bot.CAT_BH
+    assert store.book_many([
+        (PR, "S1", "Пн 10:00", 1, "Один"),
+        (PR, "S1", "Пн 10:00", 2, "Два"),
+        (PR, "S1", "Пн 10:00", 3, "Три"),       # мест 2
+        (PR, "S2", "Вт 12:00", 1, "Один"),      # лимит 1 на категорию
+        (PR, "S1", "Пн 10:00", 2, "Два"),       # уже записан
+        (PR, "S2", "Вт 13:00", 4, "Четыре"),    # слот переименовали
+        (PR, "S3", "", 5, "Пять"),              # слот без названия
+        (BH, "S1", "Ср", 1, "Один"),
+        (BH, "S2", "Чт", 1, "Один"),
+        (BH, "S3", "Пт", 1, "Один"),            # лимит 2
+    ]) == ["ok", "ok", "full", "limit", "already", "gone", "gone", "ok", "ok", "limit"]
+
+    # другой процесс со своим соединением видит занятые места, а не свою копию state
+    other = bot.SqliteStore("t.sqlite3")
+    assert other.book_many([(PR, "S1", "Пн 10:00", 6, "Шесть"), (PR, "S2", "Вт 12:00", 6, "Шесть")]) == ["full", "ok"]
+
+    loaded = bot.State.from_json(store.load())
+    assert loaded.by_id("pr").slot("S1").uids.tolist() == [1, 2]
+    assert loaded.by_id("pr").slot("S2").users == ["Шесть"]
+    assert loaded.by_id("bh").slot("S3").users == []